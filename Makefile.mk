@@ -25,7 +25,11 @@ PROMETHEUS_IMAGE = ${REGISTRY}/blog-obsv-prometheus:${BRANCH}-${TAG}
 
 upper := $(shell echo $(SERVICE) | tr a-z A-Z)
 get_image := $(call $(call upper,$(SERVICE))_IMAGE)
-build_image := docker build -t $(call get_image) ./$(SERVICE)
+# Images that need the shared python modules in ./common are built with ./
+# as their context instead of ./$(SERVICE)
+SHARED_CONTEXT_SERVICES = dashboard counter consul envoy
+build_context := $(if $(filter $(SERVICE),$(SHARED_CONTEXT_SERVICES)),-f ./$(SERVICE)/Dockerfile .,./$(SERVICE))
+build_image := docker build -t $(call get_image) $(build_context)
 push_image := docker push $(call get_image)
 
 # -----------------------
@@ -0,0 +1,109 @@
+import math
+import time
+import asyncio
+from collections import Counter
+
+import aiohttp
+
+
+def percentile(sorted_values, pct):
+    """ Nearest rank percentile of an already sorted list """
+    if not sorted_values:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(sorted_values))) - 1
+    return sorted_values[min(max(rank, 0), len(sorted_values) - 1)]
+
+
+def summarize(latencies_s, statuses, elapsed_s):
+    latencies_ms = sorted(l * 1000.0 for l in latencies_s)
+    completed = len(latencies_ms)
+    return {
+        "requests": completed + statuses.get("error", 0),
+        "rps": round(completed / elapsed_s, 1) if elapsed_s else 0.0,
+        "status": dict((str(k), v) for k, v in sorted(statuses.items(), key=str)),
+        "latency_ms": dict(
+            [(name, _round(percentile(latencies_ms, pct)))
+             for name, pct in (("p50", 50), ("p90", 90), ("p99", 99), ("p999", 99.9))] +
+            [("max", _round(latencies_ms[-1] if latencies_ms else None)),
+             ("mean", _round(sum(latencies_ms) / completed if completed else None))]
+        ),
+    }
+
+
+def _round(value):
+    return None if value is None else round(value, 3)
+
+
+class LoadGenerator(object):
+    """ Drives one URL and records the latency of every request.
+
+    With a `rate` the load is open loop: requests are scheduled at fixed
+    intervals whether or not earlier ones have completed, and latency is
+    measured from the scheduled time, so queueing in front of a slow server
+    shows up in the tail instead of silently lowering the request rate.
+    At most `concurrency` requests are in flight. Without a rate the load is
+    closed loop, with `concurrency` clients sending back to back.
+    """
+
+    def __init__(self, url, rate=None, concurrency=32, timeout_s=10.0):
+        self.url = url
+        self.rate = rate
+        self.concurrency = concurrency
+        self.timeout_s = timeout_s
+
+    def run(self, duration_s, warmup_s=0.0):
+        return asyncio.run(self._run(duration_s, warmup_s))
+
+    async def _run(self, duration_s, warmup_s):
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        timeout = aiohttp.ClientTimeout(total=self.timeout_s)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            if warmup_s:
+                await self._drive(session, warmup_s)
+            return await self._drive(session, duration_s)
+
+    async def _drive(self, session, duration_s):
+        latencies, statuses = [], Counter()
+        start = time.perf_counter()
+        if self.rate:
+            await self._open_loop(session, start, duration_s, latencies, statuses)
+        else:
+            await self._closed_loop(session, start, duration_s, latencies, statuses)
+        return summarize(latencies, statuses, time.perf_counter() - start)
+
+    async def _request(self, session, sent, latencies, statuses):
+        try:
+            async with session.get(self.url) as resp:
+                await resp.read()
+                status = resp.status
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            statuses["error"] += 1
+            return
+        latencies.append(time.perf_counter() - sent)
+        statuses[status] += 1
+
+    async def _open_loop(self, session, start, duration_s, latencies, statuses):
+        slots = asyncio.Semaphore(self.concurrency)
+
+        async def scheduled(at):
+            async with slots:
+                await self._request(session, at, latencies, statuses)
+
+        tasks = []
+        interval = 1.0 / self.rate
+        for i in range(int(duration_s * self.rate)):
+            at = start + i * interval
+            delay = at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(scheduled(at)))
+        await asyncio.gather(*tasks)
+
+    async def _closed_loop(self, session, start, duration_s, latencies, statuses):
+        deadline = start + duration_s
+
+        async def client():
+            while time.perf_counter() < deadline:
+                await self._request(session, time.perf_counter(), latencies, statuses)
+
+        await asyncio.gather(*[client() for _ in range(self.concurrency)])
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# ------------------------------------------------------------------------------
+# Benchmarks the counter and dashboard services locally, without Fargate.
+#
+# Every service is started in each of its serving modes with its traces sent
+# to a local X-Ray sink. The dashboard calls a locally started counter
+# directly, which stands in for the Envoy upstream listener. Each path is
+# then driven at a fixed request rate and concurrency and the throughput and
+# latency percentiles are reported.
+#
+# To run from ./src and save the results as a baseline:
+#
+#       python -m bench.run -save baseline.json
+#
+# To compare a later run against it, exiting with code 2 on a regression:
+#
+#       python -m bench.run -compare baseline.json -tolerance 0.2
+# ------------------------------------------------------------------------------
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+
+from common.xray_sink import XRaySink
+from bench.loadgen import LoadGenerator
+from bench.services import MODES, ServiceProcess
+
+
+# Exit code of a comparison run that found a regression
+EXIT_REGRESSION = 2
+
+
+def run_scenarios(args):
+    """ Returns {"<service> <mode> <path>": result} """
+    sink = XRaySink("127.0.0.1:0").start()
+    env = {
+        "AWS_XRAY_DAEMON_ADDRESS": sink.address,
+        "FAIL_TIMEOUT_S": str(args.fail_timeout_s),
+        "LOG_LEVEL": args.log_level,
+    }
+    results = {}
+    try:
+        for service in args.services:
+            modes = [m for m in args.modes or sorted(MODES[service]) if m in MODES[service]]
+            for mode in modes:
+                results.update(_run_service(service, mode, env, args))
+    finally:
+        sink.stop()
+    return results
+
+
+def _run_service(service, mode, env, args):
+    upstream = None
+    log_path = os.path.join(args.outdir, "%s-%s.log" % (service, mode))
+    try:
+        if service == "dashboard":
+            upstream = ServiceProcess(
+                "counter", args.upstream_mode, env,
+                os.path.join(args.outdir, "counter-upstream.log")
+            ).start()
+            env = dict(env, COUNTER_ENDPOINT=upstream.endpoint)
+        with ServiceProcess(service, mode, env, log_path) as process:
+            results = {}
+            for path in args.paths:
+                name = "%s %s %s" % (service, mode, path)
+                sys.stderr.write("Running %s\n" % name)
+                results[name] = LoadGenerator(
+                    process.endpoint + path,
+                    rate=args.rate,
+                    concurrency=args.concurrency,
+                    timeout_s=args.timeout_s
+                ).run(args.duration_s, args.warmup_s)
+            return results
+    finally:
+        if upstream is not None:
+            upstream.stop()
+
+
+def compare(baseline, results, tolerance, slack_ms):
+    """ Returns the regressions of `results` against `baseline`.
+
+    A scenario regresses when its throughput drops, or its p50 or p99 latency
+    grows, by more than `tolerance`. Latency changes within `slack_ms` are
+    ignored, since they are noise at sub-millisecond latencies.
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result["rps"] < base["rps"] * (1 - tolerance):
+            regressions.append("%s: rps %.1f < baseline %.1f" % (name, result["rps"], base["rps"]))
+        for pct in ("p50", "p99"):
+            now, then = result["latency_ms"][pct], base["latency_ms"][pct]
+            if now is None or then is None:
+                continue
+            if now > then * (1 + tolerance) and now - then > slack_ms:
+                regressions.append("%s: %s %.3fms > baseline %.3fms" % (name, pct, now, then))
+        errors, base_errors = result["status"].get("error", 0), base["status"].get("error", 0)
+        if errors > base_errors * (1 + tolerance):
+            regressions.append("%s: %d errors > baseline %d" % (name, errors, base_errors))
+    return regressions
+
+
+def format_table(results, baseline=None):
+    header = ("scenario", "rps", "p50", "p90", "p99", "p999", "status")
+    rows = [header]
+    for name, result in sorted(results.items()):
+        latency = result["latency_ms"]
+        row = [name, "%.1f" % result["rps"]]
+        row += ["-" if latency[p] is None else "%.2f" % latency[p]
+                for p in ("p50", "p90", "p99", "p999")]
+        row.append(",".join("%s=%s" % item for item in result["status"].items()))
+        rows.append(row)
+        base = (baseline or {}).get(name)
+        if base is not None:
+            base_latency = base["latency_ms"]
+            row = ["  baseline", "%.1f" % base["rps"]]
+            row += ["-" if base_latency[p] is None else "%.2f" % base_latency[p]
+                    for p in ("p50", "p90", "p99", "p999")]
+            row.append(",".join("%s=%s" % item for item in base["status"].items()))
+            rows.append(row)
+    widths = [max(len(r[i]) for r in rows) for i in range(len(header))]
+    return "\n".join(
+        "  ".join(col.ljust(widths[i]) for i, col in enumerate(row)).rstrip()
+        for row in rows
+    )
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(
+        prog='bench',
+        description='Benchmarks the counter and dashboard services locally.'
+    )
+    parser.add_argument('-services', nargs='+', default=["counter", "dashboard"],
+                        choices=sorted(MODES))
+    parser.add_argument('-modes', nargs='+', default=None,
+                        help='Serving modes to compare, all modes of each service by default. '
+                             'Counter: %s. Dashboard: %s.' % (
+                                 ", ".join(sorted(MODES["counter"])),
+                                 ", ".join(sorted(MODES["dashboard"]))))
+    parser.add_argument('-upstream-mode', dest='upstream_mode', default="multiprocess",
+                        choices=sorted(MODES["counter"]),
+                        help='Serving mode of the counter that the dashboard calls.')
+    parser.add_argument('-paths', nargs='+', default=["/", "/health", "/fail?code=500"])
+    parser.add_argument('-rate', type=float, default=200.0,
+                        help='Requests per second, 0 to send back to back instead.')
+    parser.add_argument('-concurrency', type=int, default=32)
+    parser.add_argument('-duration', dest='duration_s', type=float, default=10.0)
+    parser.add_argument('-warmup', dest='warmup_s', type=float, default=2.0)
+    parser.add_argument('-timeout', dest='timeout_s', type=float, default=10.0)
+    parser.add_argument('-fail-timeout', dest='fail_timeout_s', type=float, default=1.0,
+                        help='How long the counter delays /fail?code=504.')
+    parser.add_argument('-log-level', dest='log_level', default="INFO")
+    parser.add_argument('-outdir', default=None, help='Directory for the service logs, created if missing.')
+    parser.add_argument('-save', default=None, help='Saves the results as a JSON baseline.')
+    parser.add_argument('-compare', default=None, help='JSON baseline to compare against.')
+    parser.add_argument('-tolerance', type=float, default=0.2)
+    parser.add_argument('-slack-ms', dest='slack_ms', type=float, default=1.0)
+    return parser
+
+
+def main():
+    args = _parse_args().parse_args()
+    args.outdir = args.outdir or tempfile.mkdtemp(prefix="bench-")
+    os.makedirs(args.outdir, exist_ok=True)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+
+    results = run_scenarios(args)
+    print(format_table(results, baseline))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({
+                "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "host": {
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "cpus": os.cpu_count(),
+                },
+                "settings": {
+                    "rate": args.rate,
+                    "concurrency": args.concurrency,
+                    "duration_s": args.duration_s,
+                    "upstream_mode": args.upstream_mode,
+                },
+                "results": results,
+            }, f, indent=2, sort_keys=True)
+        print("Saved baseline to %s" % args.save)
+
+    if baseline is not None:
+        regressions = compare(baseline, results, args.tolerance, args.slack_ms)
+        for regression in regressions:
+            print("REGRESSION %s" % regression)
+        if regressions:
+            sys.exit(EXIT_REGRESSION)
+        print("No regressions against %s" % args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+import os
+import sys
+import time
+import socket
+import subprocess
+import multiprocessing
+
+import requests
+
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Environment of every serving mode, see counter/server.py and dashboard/app.py
+MODES = {
+    "counter": {
+        "dev": {"SERVER_MODE": "dev"},
+        "threaded": {"SERVER_MODE": "gunicorn", "WORKER_CLASS": "gthread",
+                     "WORKERS": "1", "THREADS": "8"},
+        "multiprocess": {"SERVER_MODE": "gunicorn", "WORKER_CLASS": "gthread",
+                         "WORKERS": str(multiprocessing.cpu_count()), "THREADS": "1"},
+        "gevent": {"SERVER_MODE": "gunicorn", "WORKER_CLASS": "gevent", "WORKERS": "2"},
+    },
+    "dashboard": {
+        "dev": {},
+        "async": {"SERVER_MODE": "async"},
+    },
+}
+
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+class ServiceProcess(object):
+    """ Runs one of the services locally in the given serving mode, with its
+    output written to `log_path`.
+    """
+
+    def __init__(self, service, mode, env=None, log_path=os.devnull):
+        if mode not in MODES[service]:
+            raise ValueError("Unknown mode=%s for service=%s, expected one of %s" % (
+                mode, service, ", ".join(sorted(MODES[service]))))
+        self.service = service
+        self.mode = mode
+        self.port = free_port()
+        self.env = dict(os.environ)
+        self.env.update(env or {})
+        self.env.update(MODES[service][mode])
+        self.env["PORT"] = str(self.port)
+        self.env["PYTHONPATH"] = SRC_DIR
+        self.log_path = log_path
+        self._process = None
+        self._log = None
+
+    @property
+    def endpoint(self):
+        return "http://127.0.0.1:%s" % self.port
+
+    def start(self, ready_timeout_s=30.0):
+        self._log = open(self.log_path, "ab")
+        self._process = subprocess.Popen(
+            [sys.executable, "app.py"],
+            cwd=os.path.join(SRC_DIR, self.service),
+            env=self.env,
+            stdout=self._log,
+            stderr=subprocess.STDOUT
+        )
+        deadline = time.time() + ready_timeout_s
+        while time.time() < deadline:
+            if self._process.poll() is not None:
+                raise RuntimeError("%s exited with code=%s, see %s" % (
+                    self.service, self._process.returncode, self.log_path))
+            try:
+                if requests.get(self.endpoint + "/health", timeout=1).status_code == 200:
+                    return self
+            except requests.exceptions.RequestException:
+                pass
+            time.sleep(0.2)
+        self.stop()
+        raise RuntimeError("%s not ready after %ss, see %s" % (
+            self.service, ready_timeout_s, self.log_path))
+
+    def stop(self):
+        if self._process is not None and self._process.poll() is None:
+            self._process.terminate()
+            try:
+                self._process.wait(10)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+                self._process.wait()
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
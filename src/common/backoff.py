@@ -0,0 +1,9 @@
+import random
+
+
+def backoff_delays(initial_s=1.0, max_s=30.0):
+    """ Exponential backoff delays with full jitter """
+    delay_s = initial_s
+    while True:
+        yield random.uniform(0, delay_s)
+        delay_s = min(delay_s * 2, max_s)
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# ------------------------------------------------------------------------------
+# A local stand-in for the Consul KV HTTP API, so that services keeping state
+# in Consul KV can be run and load tested offline. It supports reads, blocking
+# queries, check-and-set writes and deletes of single keys, transactions of
+# "set" and "cas" operations, and counts the writes it received.
+#
+# To run it and print the number of writes every second:
+#
+#       python -m common.consul_kv_stub -address 127.0.0.1:8500
+# ------------------------------------------------------------------------------
+
+import json
+import time
+import base64
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+
+KV_PREFIX = "/v1/kv/"
+TXN_PATH = "/v1/txn"
+
+
+def _parse_wait(wait):
+    """ Parses a Consul duration such as "30s" or "500ms" into seconds """
+    if wait.endswith("ms"):
+        return float(wait[:-2]) / 1000.0
+    if wait.endswith("m"):
+        return float(wait[:-1]) * 60
+    return float(wait.rstrip("s"))
+
+
+class ConsulKVStub(object):
+    """ Serves Consul KV over HTTP from a dict, with a single raft index
+    that every write moves forward.
+    """
+
+    def __init__(self, address="127.0.0.1:8500", max_wait_s=600.0):
+        self.max_wait_s = max_wait_s
+        self.index = 1
+        self.entries = {}
+        self.writes = 0
+        self.cas_failures = 0
+        self._changed = threading.Condition()
+        host, port = address.rsplit(":", 1)
+        self._server = ThreadingHTTPServer((host, int(port)), self._handler_class())
+        self._server.daemon_threads = True
+        self.address = "%s:%s" % self._server.server_address[:2]
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="consul-kv-stub")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def get(self, key, index=0, wait_s=None):
+        """ Returns (entry or None, index), blocking until the key changes
+        past `index`, for at most `wait_s`
+        """
+        deadline = time.time() + min(wait_s or 300.0, self.max_wait_s)
+        with self._changed:
+            while index and self._key_index(key) <= index:
+                remaining_s = deadline - time.time()
+                if remaining_s <= 0:
+                    break
+                self._changed.wait(remaining_s)
+            return self.entries.get(key), max(self._key_index(key), 1)
+
+    def put(self, key, value, cas=None):
+        """ Returns whether `value` was written """
+        return self.txn([(key, value, cas)])
+
+    def txn(self, writes):
+        """ Makes all the (key, value, cas) writes at one index, or none of
+        them if a cas doesn't match. Returns whether they were made.
+        """
+        with self._changed:
+            for key, _, cas in writes:
+                entry = self.entries.get(key)
+                if cas is not None and cas != (entry["ModifyIndex"] if entry else 0):
+                    self.cas_failures += 1
+                    return False
+            self.index += 1
+            self.writes += 1
+            for key, value, _ in writes:
+                entry = self.entries.get(key)
+                self.entries[key] = {
+                    "Key": key,
+                    "Flags": 0,
+                    "LockIndex": 0,
+                    "CreateIndex": entry["CreateIndex"] if entry else self.index,
+                    "ModifyIndex": self.index,
+                    "Value": base64.b64encode(value).decode("ascii") if value else None,
+                }
+            self._changed.notify_all()
+        return True
+
+    def delete(self, key):
+        with self._changed:
+            self.index += 1
+            self.entries.pop(key, None)
+            self._changed.notify_all()
+
+    def _key_index(self, key):
+        # A missing key reports the raft index, like Consul
+        entry = self.entries.get(key)
+        return entry["ModifyIndex"] if entry else self.index
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, status, body, index):
+                raw = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(raw)))
+                self.send_header("X-Consul-Index", str(index))
+                self.end_headers()
+                self.wfile.write(raw)
+
+            def _key(self):
+                url = urlsplit(self.path)
+                if not url.path.startswith(KV_PREFIX):
+                    self._reply(404, {"message": "Only %s is supported" % KV_PREFIX}, stub.index)
+                    return None, None
+                return url.path[len(KV_PREFIX):], dict(
+                    (k, v[0]) for k, v in parse_qs(url.query).items()
+                )
+
+            def do_GET(self):
+                key, params = self._key()
+                if key is None:
+                    return
+                wait = params.get("wait")
+                entry, index = stub.get(
+                    key, index=int(params.get("index", 0)),
+                    wait_s=_parse_wait(wait) if wait else None
+                )
+                if entry is None:
+                    self._reply(404, None, index)
+                else:
+                    self._reply(200, [entry], index)
+
+            def _txn(self):
+                ops = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                writes = []
+                for op in ops:
+                    kv = op.get("KV", {})
+                    if kv.get("Verb") not in ("set", "cas"):
+                        self._reply(400, {"message": "Only set and cas are supported"}, stub.index)
+                        return
+                    writes.append((
+                        kv["Key"],
+                        base64.b64decode(kv["Value"]) if kv.get("Value") else b"",
+                        int(kv.get("Index", 0)) if kv["Verb"] == "cas" else None
+                    ))
+                if stub.txn(writes):
+                    self._reply(200, {"Results": [{"KV": stub.entries[k]} for k, _, _ in writes],
+                                      "Errors": None}, stub.index)
+                else:
+                    self._reply(409, {"Results": None,
+                                      "Errors": [{"What": "cas failed, the index is stale"}]}, stub.index)
+
+            def do_PUT(self):
+                if urlsplit(self.path).path == TXN_PATH:
+                    self._txn()
+                    return
+                key, params = self._key()
+                if key is None:
+                    return
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                cas = params.get("cas")
+                written = stub.put(key, body, cas=int(cas) if cas is not None else None)
+                self._reply(200, written, stub.index)
+
+            def do_DELETE(self):
+                key, _ = self._key()
+                if key is None:
+                    return
+                stub.delete(key)
+                self._reply(200, True, stub.index)
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='consul_kv_stub',
+        description='Local stand-in for the Consul KV HTTP API.'
+    )
+    parser.add_argument('-address', type=str, default="127.0.0.1:8500")
+    args = parser.parse_args()
+
+    stub = ConsulKVStub(args.address).start()
+    last = 0
+    while True:
+        time.sleep(1)
+        print(json.dumps({"address": stub.address, "writes_per_s": stub.writes - last,
+                          "cas_failures": stub.cas_failures, "keys": len(stub.entries)}))
+        last = stub.writes
+
+
+if __name__ == '__main__':
+    main()
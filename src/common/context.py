@@ -0,0 +1,223 @@
+import os
+import time
+import binascii
+import logging
+import contextvars
+
+
+TRACE_HEADER = "X-Amzn-Trace-Id"
+TRACEPARENT_HEADER = "traceparent"
+REQUEST_ID_HEADER = "X-Request-Id"
+# The time Envoy will wait for the response, set on every request it routes
+DEADLINE_HEADER = "X-Envoy-Expected-Rq-Timeout-Ms"
+# Overrides the route timeout of the local Envoy for one outbound call
+UPSTREAM_TIMEOUT_HEADER = "X-Envoy-Upstream-Rq-Timeout-Ms"
+# When the public listener received the request, as "t=<epoch seconds>"
+REQUEST_START_HEADER = "X-Request-Start"
+
+_current = contextvars.ContextVar("request_context", default=None)
+
+
+class RequestContext(object):
+    """ The trace and request ids of a request, parsed once from its headers.
+
+    The X-Ray `X-Amzn-Trace-Id` header is preferred and the W3C `traceparent`
+    header is used when it's absent, with its trace id converted to the X-Ray
+    format so both can be correlated.
+
+    When Envoy says how long it will wait for the response, in
+    `X-Envoy-Expected-Rq-Timeout-Ms`, that becomes the deadline of the
+    request. Outbound calls are only given what's left of it, and pass it on.
+    The deadline counts from `X-Request-Start`, when the public listener
+    sets it, so the time spent queued in front of the app is included.
+    """
+
+    __slots__ = ("trace_id", "parent_id", "sampled", "request_id", "deadline")
+
+    def __init__(self, trace_id=None, parent_id=None, sampled=None, request_id=None, deadline=None):
+        self.trace_id = trace_id
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.request_id = request_id
+        # In time.monotonic() seconds
+        self.deadline = deadline
+
+    @classmethod
+    def from_headers(cls, headers):
+        ctx = cls(request_id=headers.get(REQUEST_ID_HEADER))
+        timeout_ms = headers.get(DEADLINE_HEADER)
+        if timeout_ms:
+            try:
+                ctx.deadline = time.monotonic() + int(timeout_ms) / 1000.0
+            except ValueError:
+                pass
+            else:
+                ctx._subtract_queue_time(headers.get(REQUEST_START_HEADER))
+        amzn = headers.get(TRACE_HEADER)
+        if amzn:
+            ctx._parse_amzn(amzn)
+        else:
+            traceparent = headers.get(TRACEPARENT_HEADER)
+            if traceparent:
+                ctx._parse_traceparent(traceparent)
+        return ctx
+
+    def _subtract_queue_time(self, value):
+        if not value:
+            return
+        try:
+            queued_s = time.time() - float(value[2:] if value.startswith("t=") else value)
+        except ValueError:
+            return
+        if queued_s > 0:
+            self.deadline -= queued_s
+
+    def _parse_amzn(self, value):
+        for part in value.split(";"):
+            key, _, val = part.strip().partition("=")
+            if key == "Root":
+                self.trace_id = val
+            elif key == "Parent":
+                self.parent_id = val
+            elif key == "Sampled":
+                self.sampled = {"1": True, "0": False}.get(val)
+
+    def _parse_traceparent(self, value):
+        parts = value.strip().split("-")
+        if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+            return
+        trace_id = parts[1]
+        self.trace_id = "1-%s-%s" % (trace_id[:8], trace_id[8:])
+        self.parent_id = parts[2]
+        try:
+            self.sampled = bool(int(parts[3][:2], 16) & 1)
+        except ValueError:
+            pass
+
+    def remaining_s(self):
+        """ Seconds left until the deadline, None when there's no deadline """
+        if self.deadline is None:
+            return None
+        return self.deadline - time.monotonic()
+
+    def timeout_s(self, default_s):
+        """ The timeout of an outbound call: `default_s`, capped by what's
+        left until the deadline. Never zero, which clients take as no timeout
+        or reject.
+        """
+        remaining_s = self.remaining_s()
+        if remaining_s is None:
+            return default_s
+        return max(min(default_s, remaining_s), 0.001)
+
+    def outbound_headers(self):
+        """ Headers that continue this trace, and its deadline, on an
+        outbound call
+        """
+        headers = {}
+        if self.request_id:
+            headers[REQUEST_ID_HEADER] = self.request_id
+        remaining_s = self.remaining_s()
+        if remaining_s is not None:
+            remaining_ms = str(max(int(remaining_s * 1000), 1))
+            headers[DEADLINE_HEADER] = remaining_ms
+            headers[UPSTREAM_TIMEOUT_HEADER] = remaining_ms
+        if self.trace_id:
+            amzn = "Root=%s" % self.trace_id
+            if self.parent_id:
+                amzn += ";Parent=%s" % self.parent_id
+            if self.sampled is not None:
+                amzn += ";Sampled=%d" % self.sampled
+            headers[TRACE_HEADER] = amzn
+            parts = self.trace_id.split("-")
+            if len(parts) == 3 and len(parts[1]) + len(parts[2]) == 32:
+                headers[TRACEPARENT_HEADER] = "00-%s%s-%s-%02x" % (
+                    parts[1], parts[2],
+                    self.parent_id or binascii.hexlify(os.urandom(8)).decode("ascii"),
+                    1 if self.sampled else 0
+                )
+        return headers
+
+    def response_headers(self):
+        headers = {}
+        if self.request_id:
+            headers[REQUEST_ID_HEADER] = self.request_id
+        if self.trace_id:
+            headers[TRACE_HEADER] = "Root=%s" % self.trace_id
+        return headers
+
+
+EMPTY_CONTEXT = RequestContext()
+
+
+def current_context():
+    """ The context of the request being handled, in this thread or task """
+    return _current.get() or EMPTY_CONTEXT
+
+
+def bind_context(ctx):
+    """ Makes `ctx` the current context, returns a token for `unbind_context` """
+    return _current.set(ctx)
+
+
+def unbind_context(token):
+    _current.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    """ Adds the trace and request ids of the current request to records
+    that don't already carry them.
+    """
+
+    def filter(self, record):
+        ctx = _current.get()
+        if ctx is not None:
+            if not hasattr(record, "trace_id"):
+                record.trace_id = ctx.trace_id
+            if not hasattr(record, "request_id"):
+                record.request_id = ctx.request_id
+        return True
+
+
+def init_flask(app):
+    """ Parses the context once per request in a Flask app and echoes the
+    ids back on the response.
+    """
+    from flask import g, request
+
+    @app.before_request
+    def _bind_request_context():
+        g.request_context = RequestContext.from_headers(request.headers)
+        g.request_context_token = bind_context(g.request_context)
+
+    @app.after_request
+    def _add_context_headers(response):
+        ctx = current_context()
+        for key, value in ctx.response_headers().items():
+            response.headers.setdefault(key, value)
+        return response
+
+    @app.teardown_request
+    def _unbind_request_context(exc):
+        token = g.pop("request_context_token", None)
+        if token is not None:
+            unbind_context(token)
+
+
+def aiohttp_middleware():
+    """ The aiohttp counterpart of `init_flask` """
+    from aiohttp import web
+
+    @web.middleware
+    async def request_context_middleware(request, handler):
+        ctx = RequestContext.from_headers(request.headers)
+        token = bind_context(ctx)
+        try:
+            response = await handler(request)
+        finally:
+            unbind_context(token)
+        for key, value in ctx.response_headers().items():
+            response.headers.setdefault(key, value)
+        return response
+
+    return request_context_middleware
@@ -0,0 +1,180 @@
+import os
+import json
+import time
+import logging
+import threading
+
+
+LIVENESS_PATH = "/health"
+READINESS_PATH = "/ready"
+
+log = logging.getLogger(__name__)
+
+
+class DeepHealthCheck(object):
+    """ Checks the dependencies of a service in a background thread.
+
+    `checks` maps a name to a function that raises when the dependency is
+    unhealthy. They all run every `interval_s` and the encoded result is
+    cached, so a probe only ever reads it. A result older than `ttl_s`, e.g.
+    because a check hangs, is reported as unhealthy.
+    """
+
+    def __init__(self, checks, interval_s=5.0, ttl_s=15.0):
+        self.checks = checks
+        self.interval_s = interval_s
+        self.ttl_s = ttl_s
+        self._result = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, checks):
+        return cls(
+            checks,
+            interval_s=float(os.environ.get("HEALTH_CHECK_INTERVAL_S", 5.0)),
+            ttl_s=float(os.environ.get("HEALTH_CHECK_TTL_S", 15.0))
+        )
+
+    def ensure_started(self):
+        """ Starts the checks in the current process, if needed. Threads
+        don't survive a fork, so each worker runs its own.
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._result = None
+            thread = threading.Thread(target=self._run_forever, name="deep-health-check")
+            thread.daemon = True
+            thread.start()
+
+    def _run_forever(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            self._result = self.run_checks()
+            time.sleep(self.interval_s)
+
+    def run_checks(self):
+        """ Runs every check, returns (checked_at, healthy, body) """
+        results = {}
+        for name, check in self.checks.items():
+            start = time.perf_counter()
+            try:
+                check()
+                results[name] = {"ok": True}
+            except Exception as ex:
+                log.warning("Health check failed, check=%s, %s" % (name, ex))
+                results[name] = {"ok": False, "error": str(ex)}
+            results[name]["latency_ms"] = round((time.perf_counter() - start) * 1000, 3)
+        healthy = all(r["ok"] for r in results.values())
+        checked_at = time.time()
+        body = json.dumps({
+            "status": "READY" if healthy else "NOT_READY",
+            "checked_at": checked_at,
+            "checks": results,
+        }).encode("utf-8")
+        return checked_at, healthy, body
+
+    def result(self):
+        """ Returns (healthy, body) of the last run, without running anything """
+        result = self._result
+        if result is None:
+            return False, b'{"status": "STARTING"}'
+        checked_at, healthy, body = result
+        if time.time() - checked_at > self.ttl_s:
+            return False, json.dumps({
+                "status": "STALE",
+                "checked_at": checked_at,
+            }).encode("utf-8")
+        return healthy, body
+
+
+class HealthMiddleware(object):
+    """ Answers health probes ahead of a WSGI app.
+
+    The liveness path returns pre-built bytes, and the readiness path the
+    cached result of the deep check, without going through the app's
+    tracing, logging or routing. Everything else is passed to the app.
+    """
+
+    def __init__(self, wsgi_app, liveness_body, deep_check=None,
+                 liveness_path=LIVENESS_PATH, readiness_path=READINESS_PATH):
+        self.wsgi_app = wsgi_app
+        self.liveness_body = liveness_body
+        self.deep_check = deep_check
+        self.liveness_path = liveness_path
+        self.readiness_path = readiness_path
+        self._liveness_headers = [
+            ("Content-Type", "application/json"),
+            ("Content-Length", str(len(liveness_body))),
+        ]
+
+    def __call__(self, environ, start_response):
+        path = environ.get("PATH_INFO")
+        if path == self.liveness_path and environ.get("REQUEST_METHOD") == "GET":
+            start_response("200 OK", self._liveness_headers)
+            return [self.liveness_body]
+        if self.deep_check is None:
+            return self.wsgi_app(environ, start_response)
+        self.deep_check.ensure_started()
+        if path == self.readiness_path and environ.get("REQUEST_METHOD") == "GET":
+            healthy, body = self.deep_check.result()
+            start_response("200 OK" if healthy else "503 Service Unavailable", [
+                ("Content-Type", "application/json"),
+                ("Content-Length", str(len(body))),
+            ])
+            return [body]
+        return self.wsgi_app(environ, start_response)
+
+
+class _ProbeAccessLogFilter(logging.Filter):
+    """ Drops the development server's access log lines of health probes """
+
+    def __init__(self, paths):
+        super(_ProbeAccessLogFilter, self).__init__()
+        self.paths = paths
+
+    def filter(self, record):
+        # The request line, e.g. "GET /health HTTP/1.1"
+        request_line = record.args[0] if isinstance(record.args, tuple) and record.args else None
+        if isinstance(request_line, str):
+            parts = request_line.split(" ")
+            if len(parts) > 1 and parts[1] in self.paths:
+                return False
+        return True
+
+
+def init_flask(app, liveness_body, deep_check=None):
+    """ Serves the liveness and readiness probes of a Flask app ahead of it.
+    `liveness_body` is encoded up front, so liveness probes skip tracing,
+    logging and JSON encoding.
+    """
+    app.wsgi_app = HealthMiddleware(app.wsgi_app, liveness_body, deep_check)
+    logging.getLogger("werkzeug").addFilter(
+        _ProbeAccessLogFilter((LIVENESS_PATH, READINESS_PATH))
+    )
+    if deep_check is not None:
+        deep_check.ensure_started()
+
+
+def aiohttp_middleware(liveness_body, deep_check=None):
+    """ The aiohttp counterpart of `init_flask`, to be the first middleware """
+    from aiohttp import web
+
+    @web.middleware
+    async def health_middleware(request, handler):
+        if request.method == "GET":
+            if request.path == LIVENESS_PATH:
+                return web.Response(body=liveness_body, content_type="application/json")
+            if deep_check is not None and request.path == READINESS_PATH:
+                healthy, body = deep_check.result()
+                return web.Response(status=200 if healthy else 503, body=body,
+                                    content_type="application/json")
+        return await handler(request)
+
+    if deep_check is not None:
+        deep_check.ensure_started()
+    return health_middleware
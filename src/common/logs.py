@@ -0,0 +1,205 @@
+import os
+import sys
+import json
+import time
+import queue
+import random
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+from common.context import ContextFilter
+
+
+log_levels = {
+    'DEBUG': logging.DEBUG,
+    'INFO': logging.INFO,
+    'WARNING': logging.WARNING,
+    'ERROR': logging.ERROR,
+    'CRITICAL': logging.CRITICAL
+}
+
+LOG_FORMAT_JSON = "json"
+LOG_FORMAT_TEXT = "text"
+
+# Record attributes that are emitted as top level JSON fields when set
+# through `extra`
+CONTEXT_FIELDS = ("trace_id", "request_id", "route", "status_code", "duration_ms")
+
+_STANDARD_ATTRS = frozenset(
+    logging.LogRecord("", 0, "", 0, "", (), None).__dict__
+) | frozenset(("message", "asctime"))
+
+
+class JsonFormatter(logging.Formatter):
+    """ Formats a record as a single line JSON object """
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _STANDARD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """ The original plain text format with the context fields appended """
+
+    def __init__(self):
+        super(TextFormatter, self).__init__('%(asctime)s %(levelname)-8s %(message)s')
+
+    def format(self, record):
+        line = super(TextFormatter, self).format(record)
+        fields = [
+            "%s=%s" % (key, getattr(record, key))
+            for key in CONTEXT_FIELDS if hasattr(record, key)
+        ]
+        return "%s %s" % (line, ", ".join(fields)) if fields else line
+
+
+class SamplingFilter(logging.Filter):
+    """ Samples records that carry a `status_code`, e.g. request logs.
+
+    `rates` maps a status class ("2xx", "5xx", ...) to the fraction of records
+    to keep and `route_rates` overrides it for a route. Records that are kept
+    are then rate limited per route to `max_per_s`. Records without a status
+    code, e.g. startup or error logs, are always kept.
+    """
+
+    def __init__(self, rates=None, route_rates=None, max_per_s=None):
+        super(SamplingFilter, self).__init__()
+        self.rates = rates or {}
+        self.route_rates = route_rates or {}
+        self.max_per_s = max_per_s
+        self.dropped = 0
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        status_code = getattr(record, "status_code", None)
+        if status_code is None:
+            return True
+        route = getattr(record, "route", None)
+        rate = self.route_rates.get(route)
+        if rate is None:
+            rate = self.rates.get("%dxx" % (int(status_code) // 100), 1.0)
+        if rate < 1.0 and random.random() >= rate:
+            self.dropped += 1
+            return False
+        if self.max_per_s is not None and not self._take_token(route):
+            self.dropped += 1
+            return False
+        return True
+
+    def _take_token(self, route):
+        now = time.time()
+        with self._lock:
+            tokens, last = self._buckets.get(route, (self.max_per_s, now))
+            tokens = min(self.max_per_s, tokens + (now - last) * self.max_per_s)
+            if tokens < 1:
+                self._buckets[route] = (tokens, now)
+                return False
+            self._buckets[route] = (tokens - 1, now)
+            return True
+
+
+class DeferredQueueHandler(QueueHandler):
+    """ Hands records to a background thread that formats and writes them,
+    so the caller never pays for formatting or a blocking write.
+
+    The listener thread is started lazily in each process, which keeps it
+    working in workers forked after logging was set up.
+    """
+
+    def __init__(self, handler, maxsize=10000):
+        super(DeferredQueueHandler, self).__init__(queue.Queue(maxsize))
+        self.handler = handler
+        self.dropped = 0
+        self._pid = None
+        self._listener = None
+        self._start_lock = threading.Lock()
+
+    def prepare(self, record):
+        # Formatting is deferred to the listener thread
+        return record
+
+    def enqueue(self, record):
+        if self._pid != os.getpid():
+            self._start_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _start_listener(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # Anything queued before a fork belongs to the parent
+            self.queue = queue.Queue(self.queue.maxsize)
+            self._listener = QueueListener(self.queue, self.handler, respect_handler_level=True)
+            self._listener.start()
+            self._pid = os.getpid()
+
+    def close(self):
+        if self._listener is not None and self._pid == os.getpid():
+            self._listener.stop()
+            self._listener = None
+            self._pid = None
+        super(DeferredQueueHandler, self).close()
+
+
+def _parse_rates(value):
+    """ Parses "2xx=0.01,5xx=1" into {"2xx": 0.01, "5xx": 1.0} """
+    rates = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            key, rate = item.rsplit("=", 1)
+            rates[key.strip()] = float(rate)
+    return rates
+
+
+def setup_logging(log_level, name=None):
+    """ Configures the root logger and returns the logger for `name`.
+
+    The trace and request ids of the current request are added to every
+    record. The output format is set with LOG_FORMAT (json or text), sampling with
+    LOG_SAMPLE_RATES (e.g. "2xx=0.01,5xx=1"), LOG_SAMPLE_ROUTES
+    (e.g. "/health=0") and LOG_MAX_PER_S per route.
+    """
+    log_level = log_level or logging.INFO
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setLevel(log_level)
+    if os.environ.get("LOG_FORMAT", LOG_FORMAT_JSON) == LOG_FORMAT_TEXT:
+        stream_handler.setFormatter(TextFormatter())
+    else:
+        stream_handler.setFormatter(JsonFormatter())
+
+    max_per_s = os.environ.get("LOG_MAX_PER_S")
+    handler = DeferredQueueHandler(stream_handler)
+    handler.setLevel(log_level)
+    handler.addFilter(ContextFilter())
+    handler.addFilter(SamplingFilter(
+        rates=_parse_rates(os.environ.get("LOG_SAMPLE_RATES")),
+        route_rates=_parse_rates(os.environ.get("LOG_SAMPLE_ROUTES")),
+        max_per_s=float(max_per_s) if max_per_s else None
+    ))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+        existing.close()
+    root.addHandler(handler)
+    root.setLevel(log_level)
+    return logging.getLogger(name)
+
+
+def log_level_from_env():
+    return log_levels.get(os.environ.get("LOG_LEVEL", "INFO"))
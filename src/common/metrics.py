@@ -0,0 +1,419 @@
+import os
+import sys
+import glob
+import json
+import time
+import bisect
+import weakref
+import threading
+
+
+# Seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _green_threads():
+    monkey = sys.modules.get("gevent.monkey")
+    return monkey is not None and monkey.is_module_patched("threading")
+
+
+class _SharedLocal(object):
+    """ Stands in for a thread local that all threads share """
+
+
+class _ShardOwner(object):
+    """ Kept in the thread local next to a shard. It's dropped with the
+    thread local when its thread exits, which retires the shard.
+    """
+
+
+class _Metric(object):
+    """ A metric whose samples are recorded into per-thread shards.
+
+    Every thread writes to its own shard without taking a lock. Shards are
+    only read and merged when the metric is scraped. When a thread exits,
+    e.g. one of the development server's per-request threads, its shard is
+    folded into a retired shard, so there are only as many as live threads.
+    """
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._reset()
+
+    def _reset(self):
+        self._local = None
+        self._shards = {}
+        self._retired = {}
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        if self._local is None:
+            self._init_local()
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards[id(shard)] = shard
+            if not isinstance(self._local, _SharedLocal):
+                owner = self._local.owner = _ShardOwner()
+                weakref.finalize(owner, self._retire, shard)
+            return shard
+
+    def _retire(self, shard):
+        """ Folds the shard of an exited thread into the retired shard """
+        with self._lock:
+            # Shards from before a reset were dropped with it
+            if self._shards.get(id(shard)) is not shard:
+                return
+            del self._shards[id(shard)]
+            for labels, value in shard.items():
+                self._retired[labels] = self._merge(self._retired.get(labels), value)
+
+    def _init_local(self):
+        # Under gevent a thread local is per greenlet, which would leave a
+        # shard behind for every request. Greenlets never run in parallel, so
+        # they all share one shard instead.
+        if _green_threads():
+            self._local = _SharedLocal()
+        else:
+            self._local = threading.local()
+
+    def collect(self):
+        """ Merges all shards into {labelvalues: value} """
+        with self._lock:
+            shards = [dict(s) for s in self._shards.values()]
+            shards.append(dict(self._retired))
+        merged = {}
+        for shard in shards:
+            for labels, value in shard.items():
+                merged[labels] = self._merge(merged.get(labels), value)
+        return merged
+
+    def _merge(self, a, b):
+        return b if a is None else a + b
+
+
+class Counter(_Metric):
+
+    type = "counter"
+
+    def inc(self, amount=1, labels=()):
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    """ A gauge that is either moved with inc()/dec() or, when a function is
+    set, computed at scrape time.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super(Gauge, self).__init__(name, documentation, labelnames)
+        self._function = function
+
+    def set_function(self, function):
+        self._function = function
+
+    def inc(self, amount=1, labels=()):
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+    def collect(self):
+        if self._function is not None:
+            return {(): self._function()}
+        return super(Gauge, self).collect()
+
+
+class Histogram(_Metric):
+    """ A histogram with fixed bucket upper bounds. Each sample holds the
+    count per bucket followed by the sum and count of all observations.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        shard = self._shard()
+        sample = shard.get(labels)
+        if sample is None:
+            sample = shard[labels] = [0] * (len(self.buckets) + 3)
+        sample[bisect.bisect_left(self.buckets, value)] += 1
+        sample[-2] += value
+        sample[-1] += 1
+
+    def _merge(self, a, b):
+        if a is None:
+            return list(b)
+        return [x + y for x, y in zip(a, b)]
+
+
+class Registry(object):
+    """ Holds the metrics of a process and renders them for Prometheus.
+
+    With several worker processes, set `metrics_dir` to a directory shared
+    by the workers. Each worker then publishes a snapshot of its metrics
+    there every `publish_interval_s`, and a scrape on any worker merges its
+    live metrics with the snapshots of the others.
+    """
+
+    def __init__(self, metrics_dir=None, publish_interval_s=1.0, stale_after_s=60.0):
+        self.metrics_dir = metrics_dir
+        self.publish_interval_s = publish_interval_s
+        self.stale_after_s = stale_after_s
+        self._metrics = {}
+        self._pid = None
+        self._lock = threading.Lock()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # Samples recorded before the fork belong to the parent
+        for metric in self._metrics.values():
+            metric._reset()
+        self._pid = None
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), function=None):
+        return self._register(Gauge(name, documentation, labelnames, function))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def start_publishing(self):
+        """ Starts publishing snapshots for the current process, if needed """
+        if self.metrics_dir is None or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            if not os.path.isdir(self.metrics_dir):
+                os.makedirs(self.metrics_dir, exist_ok=True)
+            thread = threading.Thread(target=self._publish_forever, name="metrics-publisher")
+            thread.daemon = True
+            thread.start()
+
+    def _snapshot(self):
+        return dict(
+            (name, dict((json.dumps(labels), value)
+                        for labels, value in metric.collect().items()))
+            for name, metric in self._metrics.items()
+            if not (isinstance(metric, Gauge) and metric._function is not None)
+        )
+
+    def _publish_forever(self):
+        pid = os.getpid()
+        path = os.path.join(self.metrics_dir, "%s.json" % pid)
+        while self._pid == pid:
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self._snapshot(), f)
+            os.replace(tmp_path, path)
+            time.sleep(self.publish_interval_s)
+
+    def _other_workers(self):
+        own = "%s.json" % os.getpid()
+        now = time.time()
+        for path in glob.glob(os.path.join(self.metrics_dir, "*.json")):
+            if os.path.basename(path) == own:
+                continue
+            try:
+                if now - os.path.getmtime(path) > self.stale_after_s:
+                    continue
+                with open(path) as f:
+                    yield json.load(f)
+            except (IOError, OSError, ValueError):
+                continue
+
+    def collect(self):
+        """ Returns {name: (metric, {labelvalues: value})} merged across workers """
+        collected = dict(
+            (name, (metric, metric.collect())) for name, metric in self._metrics.items()
+        )
+        if self.metrics_dir is None:
+            return collected
+        for snapshot in self._other_workers():
+            for name, samples in snapshot.items():
+                if name not in collected:
+                    continue
+                metric, merged = collected[name]
+                for labels, value in samples.items():
+                    labels = tuple(json.loads(labels))
+                    merged[labels] = metric._merge(merged.get(labels), value)
+        return collected
+
+    def render(self):
+        """ Renders all metrics in the Prometheus text exposition format """
+        lines = []
+        for name, (metric, samples) in sorted(self.collect().items()):
+            lines.append("# HELP %s %s" % (name, metric.documentation))
+            lines.append("# TYPE %s %s" % (name, metric.type))
+            for labels, value in sorted(samples.items()):
+                pairs = list(zip(metric.labelnames, labels))
+                if metric.type != "histogram":
+                    lines.append("%s%s %s" % (name, _labels(pairs), _number(value)))
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric.buckets + (float("inf"),), value[:-2]):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else _number(bound)
+                    lines.append("%s_bucket%s %s" % (name, _labels(pairs + [("le", le)]), cumulative))
+                lines.append("%s_sum%s %s" % (name, _labels(pairs), _number(value[-2])))
+                lines.append("%s_count%s %s" % (name, _labels(pairs), value[-1]))
+        return "\n".join(lines) + "\n"
+
+
+def _labels(pairs):
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in pairs
+    )
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+REGISTRY = Registry(os.environ.get("METRICS_DIR"))
+
+
+class HttpMetrics(object):
+    """ The standard request metrics of an HTTP service and its upstreams """
+
+    def __init__(self, registry=REGISTRY):
+        self.requests = registry.counter(
+            "http_requests_total", "Requests handled", ("route", "method", "code")
+        )
+        self.latency = registry.histogram(
+            "http_request_duration_seconds", "Time spent in the handler", ("route",)
+        )
+        self.in_flight = registry.gauge(
+            "http_requests_in_flight", "Requests being handled"
+        )
+        self.upstream_latency = registry.histogram(
+            "upstream_request_duration_seconds", "Time spent calling an upstream",
+            ("upstream", "code")
+        )
+
+    def record(self, route, method, code, duration_s):
+        self.requests.inc(1, (route, method, code))
+        self.latency.observe(duration_s, (route,))
+
+    def record_upstream(self, upstream, code, duration_s):
+        """ Records an upstream call, `code` is "error" when it failed """
+        self.upstream_latency.observe(duration_s, (upstream, code))
+
+
+def init_flask(app, registry=REGISTRY):
+    """ Records request metrics for a Flask app and serves them on /metrics """
+    from flask import g, request, Response
+
+    metrics = HttpMetrics(registry)
+
+    @app.before_request
+    def _start_request_metrics():
+        registry.start_publishing()
+        g.metrics_start = time.perf_counter()
+        metrics.in_flight.inc()
+
+    @app.after_request
+    def _record_request_metrics(response):
+        start = g.pop("metrics_start", None)
+        if start is not None:
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            metrics.record(route, request.method, response.status_code,
+                           time.perf_counter() - start)
+        return response
+
+    @app.teardown_request
+    def _end_request_metrics(exc):
+        metrics.in_flight.dec()
+
+    @app.route("/metrics")
+    def metrics_endpoint():
+        return Response(registry.render(), content_type=CONTENT_TYPE)
+
+    return metrics
+
+
+def aiohttp_middleware(app, registry=REGISTRY):
+    """ The aiohttp counterpart of `init_flask`, returns the middleware """
+    from aiohttp import web
+
+    metrics = HttpMetrics(registry)
+
+    @web.middleware
+    async def metrics_middleware(request, handler):
+        start = time.perf_counter()
+        metrics.in_flight.inc()
+        status = 500
+        try:
+            response = await handler(request)
+            status = response.status
+            return response
+        except web.HTTPException as ex:
+            status = ex.status
+            raise
+        finally:
+            metrics.in_flight.dec()
+            resource = request.match_info.route.resource
+            route = resource.canonical if resource is not None else "unmatched"
+            metrics.record(route, request.method, status, time.perf_counter() - start)
+
+    async def metrics_endpoint(request):
+        return web.Response(body=registry.render().encode("utf-8"),
+                            headers={"Content-Type": CONTENT_TYPE})
+
+    app.router.add_get("/metrics", metrics_endpoint)
+    return metrics_middleware
+
+
+def aiohttp_trace_config(upstream, registry=REGISTRY):
+    """ Records the calls of an aiohttp client session to `upstream` """
+    import aiohttp
+
+    metrics = HttpMetrics(registry)
+
+    async def on_request_start(session, trace_ctx, params):
+        trace_ctx.metrics_start = time.perf_counter()
+
+    async def on_request_end(session, trace_ctx, params):
+        metrics.record_upstream(upstream, params.response.status,
+                                time.perf_counter() - trace_ctx.metrics_start)
+
+    async def on_request_exception(session, trace_ctx, params):
+        metrics.record_upstream(upstream, "error",
+                                time.perf_counter() - trace_ctx.metrics_start)
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+    return trace_config
@@ -0,0 +1,262 @@
+import io
+import sys
+import time
+import pstats
+import cProfile
+import threading
+import itertools
+import tracemalloc
+from collections import Counter, OrderedDict
+
+
+PATH_PREFIX = "/debug/"
+# Requests with this header are profiled with cProfile
+PROFILE_HEADER = "X-Profile-Request"
+# Required on every debug request when a token is configured
+TOKEN_HEADER = "X-Debug-Token"
+
+MAX_PROFILE_S = 60.0
+
+
+class SamplingProfiler(object):
+    """ Samples the stacks of all other threads every `interval_s`.
+
+    Nothing is installed in the profiled threads, which just keep running,
+    so the overhead is one walk of every stack per sample. Stacks are folded
+    into the collapsed format that flamegraph.pl and speedscope read.
+
+    Only OS threads are visible, so under gevent the greenlets waiting in
+    the hub are not sampled.
+    """
+
+    def __init__(self, interval_s=0.01):
+        self.interval_s = interval_s
+        self._labels = {}
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = "%s (%s:%d)" % (
+                code.co_name, code.co_filename, code.co_firstlineno
+            )
+        return label
+
+    def sample(self, duration_s):
+        """ Samples for `duration_s`, returns {stack: samples} """
+        stacks = Counter()
+        own_id = threading.get_ident()
+        deadline = time.time() + duration_s
+        while time.time() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self._label(frame.f_code))
+                    frame = frame.f_back
+                stacks[tuple(reversed(stack))] += 1
+            time.sleep(self.interval_s)
+        return stacks
+
+
+def collapse(stacks):
+    """ Renders {stack: samples} as collapsed stack lines """
+    return "".join(
+        "%s %d\n" % (";".join(stack), count)
+        for stack, count in stacks.most_common()
+    )
+
+
+class RequestProfiles(object):
+    """ The cProfile stats of the last `size` profiled requests """
+
+    def __init__(self, size=32):
+        self.size = size
+        self._ids = itertools.count(1)
+        self._profiles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, method, path, duration_s, profile):
+        out = io.StringIO()
+        stats = pstats.Stats(profile, stream=out)
+        stats.sort_stats("cumulative").print_stats(50)
+        with self._lock:
+            profile_id = next(self._ids)
+            self._profiles[profile_id] = {
+                "id": profile_id,
+                "method": method,
+                "path": path,
+                "duration_ms": round(duration_s * 1000, 3),
+                "stats": out.getvalue(),
+            }
+            while len(self._profiles) > self.size:
+                self._profiles.popitem(last=False)
+        return profile_id
+
+    def list(self):
+        with self._lock:
+            return [dict((k, v) for k, v in p.items() if k != "stats")
+                    for p in self._profiles.values()]
+
+    def get(self, profile_id):
+        with self._lock:
+            return self._profiles.get(profile_id)
+
+
+class AllocationTracker(object):
+    """ tracemalloc snapshots, each diffed against the one before """
+
+    # Allocations made by the tracking itself
+    IGNORED = (
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<unknown>"),
+    )
+
+    def __init__(self):
+        self._last = None
+        self._lock = threading.Lock()
+
+    def start(self, frames=1):
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(frames)
+            self._last = None
+
+    def stop(self):
+        with self._lock:
+            tracemalloc.stop()
+            self._last = None
+
+    def snapshot(self, limit=30, diff=False):
+        """ Returns the top `limit` allocation sites, or with `diff` the top
+        changes since the last snapshot, as text
+        """
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                raise RuntimeError("tracemalloc is not started")
+            snapshot = tracemalloc.take_snapshot().filter_traces(self.IGNORED)
+            last, self._last = self._last, snapshot
+        current, peak = tracemalloc.get_traced_memory()
+        lines = ["traced=%d bytes, peak=%d bytes" % (current, peak)]
+        if diff:
+            if last is None:
+                lines.append("No earlier snapshot to diff against, took one now")
+            else:
+                lines.extend(str(s) for s in snapshot.compare_to(last, "lineno")[:limit])
+        else:
+            lines.extend(str(s) for s in snapshot.statistics("lineno")[:limit])
+        return "\n".join(lines) + "\n"
+
+
+def init_flask(app, token=None):
+    """ Adds the debug endpoints under /debug/ to a Flask app.
+
+    Only call this when profiling is enabled: nothing is added to the
+    request path otherwise. With a `token`, every debug request, and every
+    request to be profiled, must carry it in X-Debug-Token.
+
+        GET  /debug/profile?seconds=10&interval_ms=10   collapsed stacks
+        GET  /debug/profiles                           profiled requests
+        GET  /debug/profiles/<id>                      cProfile stats
+        POST /debug/tracemalloc/start?frames=1
+        GET  /debug/tracemalloc/snapshot?limit=30
+        GET  /debug/tracemalloc/diff?limit=30
+        POST /debug/tracemalloc/stop
+
+    A request is profiled when it carries X-Profile-Request, and the id of
+    its profile is returned in the same header. With several workers every
+    endpoint only sees the worker that handled it.
+    """
+    from flask import g, request, make_response, abort, jsonify
+
+    profiles = RequestProfiles()
+    allocations = AllocationTracker()
+    sampling_lock = threading.Lock()
+
+    def authorized():
+        return token is None or request.headers.get(TOKEN_HEADER) == token
+
+    def text(body, status=200):
+        response = make_response(body, status)
+        response.headers["Content-Type"] = "text/plain; charset=utf-8"
+        return response
+
+    @app.before_request
+    def _guard_and_profile():
+        if request.path.startswith(PATH_PREFIX):
+            if not authorized():
+                abort(404)
+            return None
+        if PROFILE_HEADER in request.headers and authorized():
+            g.profile_start = time.perf_counter()
+            g.profile = cProfile.Profile()
+            try:
+                g.profile.enable()
+            except ValueError:
+                # Another profiler is active on this thread
+                g.profile = None
+        return None
+
+    @app.after_request
+    def _save_profile(response):
+        profile = g.pop("profile", None)
+        if profile is not None:
+            profile.disable()
+            response.headers[PROFILE_HEADER] = str(profiles.add(
+                request.method, request.path,
+                time.perf_counter() - g.pop("profile_start"), profile
+            ))
+        return response
+
+    @app.route(PATH_PREFIX + "profile")
+    def debug_profile():
+        try:
+            seconds = min(float(request.args.get("seconds", 10)), MAX_PROFILE_S)
+            interval_s = float(request.args.get("interval_ms", 10)) / 1000.0
+        except ValueError:
+            return text("seconds and interval_ms must be numbers\n", 400)
+        if not sampling_lock.acquire(False):
+            return text("A profile is already being taken\n", 409)
+        try:
+            stacks = SamplingProfiler(max(interval_s, 0.001)).sample(seconds)
+        finally:
+            sampling_lock.release()
+        return text(collapse(stacks))
+
+    @app.route(PATH_PREFIX + "profiles")
+    def debug_profiles():
+        return jsonify(profiles.list())
+
+    @app.route(PATH_PREFIX + "profiles/<int:profile_id>")
+    def debug_request_profile(profile_id):
+        profile = profiles.get(profile_id)
+        if profile is None:
+            abort(404)
+        return text("%(method)s %(path)s %(duration_ms)sms\n\n%(stats)s" % profile)
+
+    @app.route(PATH_PREFIX + "tracemalloc/start", methods=["POST"])
+    def debug_tracemalloc_start():
+        try:
+            # tracemalloc rejects frames out of its range with a ValueError too
+            allocations.start(int(request.args.get("frames", 1)))
+        except ValueError:
+            return text("frames must be a number between 1 and 65535\n", 400)
+        return text("Started tracemalloc\n")
+
+    @app.route(PATH_PREFIX + "tracemalloc/stop", methods=["POST"])
+    def debug_tracemalloc_stop():
+        allocations.stop()
+        return text("Stopped tracemalloc\n")
+
+    @app.route(PATH_PREFIX + "tracemalloc/snapshot")
+    @app.route(PATH_PREFIX + "tracemalloc/diff", endpoint="debug_tracemalloc_diff")
+    def debug_tracemalloc_snapshot():
+        try:
+            limit = int(request.args.get("limit", 30))
+        except ValueError:
+            return text("limit must be a number\n", 400)
+        try:
+            return text(allocations.snapshot(limit=limit, diff=request.path.endswith("/diff")))
+        except RuntimeError as ex:
+            return text("%s\n" % ex, 409)
@@ -0,0 +1,116 @@
+import os
+import json
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+# A volume shared by the containers of a task, so the first container to
+# start fetches the metadata and its siblings read it from disk
+TASK_METADATA_CACHE_FILE = os.environ.get(
+    "TASK_METADATA_CACHE_FILE", "/var/run/task-metadata/task.json"
+)
+
+log = logging.getLogger(__name__)
+
+
+class TaskMetadataClient(object):
+    """ Reads the ECS task metadata once per task.
+
+    Requests have a connect and read timeout and are retried with backoff on
+    connection errors and 5xx responses. The response is kept in memory and
+    in `cache_file`, which is only ever written whole so a sibling container
+    never reads a partial file.
+    """
+
+    def __init__(self,
+                 uri=None,
+                 cache_file=TASK_METADATA_CACHE_FILE,
+                 connect_timeout_s=1.0,
+                 read_timeout_s=2.0,
+                 retries=4,
+                 backoff_s=0.1):
+        # Only the v4 endpoint reports the task's availability zone
+        self.uri = uri or os.environ.get("ECS_CONTAINER_METADATA_URI_V4") \
+            or os.environ["ECS_CONTAINER_METADATA_URI"]
+        self.cache_file = cache_file
+        self.timeout = (connect_timeout_s, read_timeout_s)
+        self._session = requests.Session()
+        self._session.mount("http://", HTTPAdapter(max_retries=Retry(
+            total=retries,
+            backoff_factor=backoff_s,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=("GET",)
+        )))
+        self._task = None
+        self._lock = threading.Lock()
+
+    def task(self):
+        """ The raw task metadata, see the ECS task metadata endpoint docs """
+        with self._lock:
+            if self._task is None:
+                self._task = self._read_cache()
+            if self._task is None:
+                self._task = self._fetch()
+                self._write_cache(self._task)
+            return self._task
+
+    def summary(self):
+        """ The parts of the task metadata the bootstrap scripts use """
+        task = self.task()
+        return {
+            "task_id": task["TaskARN"].split("/")[-1],
+            "family": task["Family"],
+            "ip": task["Containers"][0]["Networks"][0]["IPv4Addresses"][0],
+            "az": self.availability_zone(),
+        }
+
+    def availability_zone(self):
+        """ The AZ the task runs in, or None if it's unknown """
+        az = self.task().get("AvailabilityZone") or os.environ.get("AVAILABILITY_ZONE")
+        if not az:
+            log.warning("The task metadata has no AvailabilityZone, is %s the v4 endpoint?" % self.uri)
+        return az or None
+
+    def _fetch(self):
+        resp = self._session.get("{}/task".format(self.uri), timeout=self.timeout)
+        resp.raise_for_status()
+        log.info("Original Task Metadata \n%s" % resp.text)
+        return json.loads(resp.text)
+
+    def _read_cache(self):
+        if not self.cache_file:
+            return None
+        try:
+            with open(self.cache_file) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write_cache(self, task):
+        if not self.cache_file:
+            return
+        try:
+            cache_dir = os.path.dirname(self.cache_file)
+            if cache_dir and not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir, exist_ok=True)
+            tmp_file = "%s.%s.tmp" % (self.cache_file, os.getpid())
+            with open(tmp_file, "w") as f:
+                json.dump(task, f)
+            os.replace(tmp_file, self.cache_file)
+        except (IOError, OSError) as ex:
+            log.warning("Could not cache task metadata, filename=%s, %s" % (self.cache_file, ex))
+
+
+_client = None
+
+
+def get_task_metadata():
+    """ The task id, family, IP and AZ of the current task """
+    global _client
+    if _client is None:
+        _client = TaskMetadataClient()
+    return _client.summary()
@@ -0,0 +1,201 @@
+import os
+import time
+import queue
+import logging
+import threading
+from collections import OrderedDict
+
+from aws_xray_sdk.core.emitters.udp_emitter import (
+    UDPEmitter, PROTOCOL_HEADER, PROTOCOL_DELIMITER, DEFAULT_DAEMON_ADDRESS
+)
+from aws_xray_sdk.core.sampling.local.sampler import LocalSampler
+
+
+log = logging.getLogger(__name__)
+
+SAMPLING_MODE_DEFAULT = "default"
+SAMPLING_MODE_RATE = "rate"
+SAMPLING_MODE_TAIL = "tail"
+
+
+def build_sampling_rules(rate, route_rates=None, fixed_target=0):
+    """ Builds local X-Ray sampling rules that sample `rate` of all requests
+    and `route_rates[path]` of the requests to a path, e.g. {"/health": 0}.
+    """
+    return {
+        "version": 2,
+        "rules": [
+            {
+                "description": "Route %s" % path,
+                "host": "*",
+                "http_method": "*",
+                "url_path": path,
+                "fixed_target": 0,
+                "rate": route_rate
+            }
+            for path, route_rate in (route_rates or {}).items()
+        ],
+        "default": {
+            "fixed_target": fixed_target,
+            "rate": rate
+        }
+    }
+
+
+class BatchingEmitter(UDPEmitter):
+    """ Serializes and sends entities from a background thread in batches,
+    so the request thread only pays for a queue put.
+    """
+
+    def __init__(self, daemon_address=DEFAULT_DAEMON_ADDRESS,
+                 batch_size=32, flush_interval_s=0.1, max_queue=10000):
+        super(BatchingEmitter, self).__init__(daemon_address)
+        self.batch_size = batch_size
+        self.flush_interval_s = flush_interval_s
+        self.sent = 0
+        self.dropped = 0
+        self._queue = queue.Queue(max_queue)
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def send_entity(self, entity):
+        self._enqueue([entity])
+
+    def _enqueue(self, entities):
+        if self._pid != os.getpid():
+            self._start()
+        for entity in entities:
+            try:
+                self._queue.put_nowait(entity)
+            except queue.Full:
+                self.dropped += 1
+
+    def _start(self):
+        # Started lazily so that forked workers get their own thread
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(self._queue.maxsize)
+            thread = threading.Thread(target=self._run, name="xray-emitter")
+            thread.daemon = True
+            thread.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.time() + self.flush_interval_s
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            for entity in batch:
+                try:
+                    self._send_data("%s%s%s" % (
+                        PROTOCOL_HEADER, PROTOCOL_DELIMITER, entity.serialize()
+                    ))
+                    self.sent += 1
+                except Exception:
+                    log.exception("Failed to send entity to Daemon.")
+
+
+class TailSamplingEmitter(BatchingEmitter):
+    """ Buffers the entities of every trace in memory and only emits them
+    once the segment has ended with an error or fault, or took longer than
+    `latency_threshold_ms`. All other traces are dropped.
+
+    At most `max_traces` traces are buffered at a time. Beyond that, the
+    oldest trace is evicted. Every request must be sampled by the recorder
+    for this to see it, so it's used together with a sampling rate of 1.
+    """
+
+    def __init__(self, daemon_address=DEFAULT_DAEMON_ADDRESS,
+                 latency_threshold_ms=500, max_traces=1000, **kwargs):
+        super(TailSamplingEmitter, self).__init__(daemon_address, **kwargs)
+        self.latency_threshold_ms = latency_threshold_ms
+        self.max_traces = max_traces
+        self.kept = 0
+        self.discarded = 0
+        self.evicted = 0
+        self._buffer = OrderedDict()
+        self._lock = threading.Lock()
+
+    def send_entity(self, entity):
+        trace_id = entity.trace_id
+        if getattr(entity, "type", None) == "subsegment":
+            # Streamed subsegments wait for their parent segment
+            with self._lock:
+                self._buffer.setdefault(trace_id, []).append(entity)
+                if len(self._buffer) > self.max_traces:
+                    self._buffer.popitem(last=False)
+                    self.evicted += 1
+            return
+
+        with self._lock:
+            entities = self._buffer.pop(trace_id, [])
+        if not self.should_keep(entity):
+            self.discarded += 1
+            return
+        self.kept += 1
+        entities.append(entity)
+        self._enqueue(entities)
+
+    def should_keep(self, segment):
+        if any(getattr(segment, flag, False) for flag in ("error", "fault", "throttle")):
+            return True
+        status = segment.http.get("response", {}).get("status")
+        if status is not None and int(status) >= 500:
+            return True
+        if segment.end_time and segment.start_time:
+            return (segment.end_time - segment.start_time) * 1000 >= self.latency_threshold_ms
+        return False
+
+
+def _parse_route_rates(value):
+    """ Parses "/health=0,/fail=1" into {"/health": 0.0, "/fail": 1.0} """
+    rates = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            path, rate = item.rsplit("=", 1)
+            rates[path.strip()] = float(rate)
+    return rates
+
+
+def configure_tracing(recorder, service, **kwargs):
+    """ Configures the X-Ray recorder for `service` from the environment.
+
+    XRAY_SAMPLING_MODE=default - The SDK's default centralized sampling
+    XRAY_SAMPLING_MODE=rate    - Samples XRAY_SAMPLE_RATE of requests, with
+                                 per route rates in XRAY_SAMPLE_ROUTES, e.g.
+                                 "/health=0,/fail=1"
+    XRAY_SAMPLING_MODE=tail    - Records every request but only emits the
+                                 traces that errored or took longer than
+                                 XRAY_TAIL_LATENCY_MS
+
+    Sampling decisions that arrive with the request are always respected.
+    """
+    mode = os.environ.get("XRAY_SAMPLING_MODE", SAMPLING_MODE_DEFAULT)
+    daemon_address = os.environ.get("AWS_XRAY_DAEMON_ADDRESS", DEFAULT_DAEMON_ADDRESS)
+    route_rates = _parse_route_rates(os.environ.get("XRAY_SAMPLE_ROUTES"))
+
+    if mode == SAMPLING_MODE_RATE:
+        kwargs["sampler"] = LocalSampler(build_sampling_rules(
+            float(os.environ.get("XRAY_SAMPLE_RATE", 0.05)), route_rates
+        ))
+        kwargs["emitter"] = BatchingEmitter(daemon_address)
+    elif mode == SAMPLING_MODE_TAIL:
+        kwargs["sampler"] = LocalSampler(build_sampling_rules(1.0, route_rates))
+        kwargs["emitter"] = TailSamplingEmitter(
+            daemon_address,
+            latency_threshold_ms=float(os.environ.get("XRAY_TAIL_LATENCY_MS", 500)),
+            max_traces=int(os.environ.get("XRAY_TAIL_MAX_TRACES", 1000))
+        )
+    elif mode != SAMPLING_MODE_DEFAULT:
+        raise ValueError("Unknown XRAY_SAMPLING_MODE=%s" % mode)
+
+    recorder.configure(service=service, daemon_address=daemon_address, **kwargs)
+    return recorder
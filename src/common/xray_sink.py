@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# ------------------------------------------------------------------------------
+# A local stand-in for the X-Ray daemon that receives segments over UDP so the
+# tracing overhead can be measured offline.
+#
+# To run the sink and print the number of segments received every second:
+#
+#       python -m common.xray_sink -address 127.0.0.1:2000
+# ------------------------------------------------------------------------------
+
+import json
+import time
+import socket
+import argparse
+import threading
+from collections import deque
+
+
+class XRaySink(object):
+    """ Receives X-Ray daemon protocol datagrams and keeps the last
+    `keep` segments along with counters of what was received.
+    """
+
+    def __init__(self, address="127.0.0.1:2000", keep=1000):
+        host, port = address.rsplit(":", 1)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.bind((host, int(port)))
+        self.address = "%s:%s" % self._socket.getsockname()
+        self.packets = 0
+        self.bytes = 0
+        self.segments = deque(maxlen=keep)
+        self._thread = None
+        self._stopped = False
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="xray-sink")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped = True
+        self._socket.close()
+
+    def _run(self):
+        while not self._stopped:
+            try:
+                data = self._socket.recv(65535)
+            except OSError:
+                return
+            self.packets += 1
+            self.bytes += len(data)
+            _, _, body = data.partition(b"\n")
+            try:
+                self.segments.append(json.loads(body.decode("utf-8")))
+            except ValueError:
+                pass
+
+    def stats(self):
+        return {"packets": self.packets, "bytes": self.bytes}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='xray_sink',
+        description='Local stand-in for the X-Ray daemon.'
+    )
+    parser.add_argument('-address', type=str, default="127.0.0.1:2000")
+    args = parser.parse_args()
+
+    sink = XRaySink(args.address).start()
+    last = 0
+    while True:
+        time.sleep(1)
+        print(json.dumps({"address": sink.address, "segments_per_s": sink.packets - last,
+                          "total": sink.packets}))
+        last = sink.packets
+
+
+if __name__ == '__main__':
+    main()
@@ -101,7 +101,16 @@ Config {
                                                     },
                                                     "route": {
                                                         "cluster": "local_app"
-                                                    }
+                                                    },
+                                                    "request_headers_to_add": [
+                                                        {
+                                                            "header": {
+                                                                "key": "x-request-start",
+                                                                "value": "t=%START_TIME(%s.%3f)%"
+                                                            },
+                                                            "append": false
+                                                        }
+                                                    ]
                                                 }
                                             ],
                                             "domains": [
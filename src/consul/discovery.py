@@ -7,62 +7,45 @@
 # python /discovery.py -mode <client|server> \
 #                      -ecs-cluster <ECS_CLUSTER> \
 #                      -ecs-family <ECS_FAMILY> \
-#                      -saveto <FILENAME>
+#                      -saveto <FILENAME> \
+#                      [-watch]
 # ------------------------------------------------------------------------------
 
 import os
 import sys
 import time
 import json
-import logging
-from logging.config import dictConfig
+import subprocess
+from concurrent import futures
 
-import requests
 import boto3
 import argparse
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 
+from common.backoff import backoff_delays
+from common.logs import setup_logging, log_level_from_env
+from common.task_metadata import get_task_metadata
 
-log_levels = {
-    'DEBUG': logging.DEBUG,
-    'INFO': logging.INFO,
-    'WARNING': logging.WARNING,
-    'ERROR': logging.ERROR,
-    'CRITICAL': logging.CRITICAL
-}
 
 # Constants via environment variables
 AWS_REGION = os.environ["AWS_REGION"]
 BOOTSTRAP_EXPECT = int(os.environ.get("BOOTSTRAP_EXPECT", 1))
+DISCOVERY_DEADLINE_S = float(os.environ.get("DISCOVERY_DEADLINE_S", 600))
+DISCOVERY_CACHE_FILE = os.environ.get("DISCOVERY_CACHE_FILE", "/consul/data/discovery-cache.json")
+DISCOVERY_WATCH_INTERVAL_S = float(os.environ.get("DISCOVERY_WATCH_INTERVAL_S", 15))
+DISCOVERY_RELOAD_DEBOUNCE_S = float(os.environ.get("DISCOVERY_RELOAD_DEBOUNCE_S", 10))
+
+# The maximum number of tasks describe_tasks accepts per call
+DESCRIBE_TASKS_BATCH_SIZE = 100
 
 MODE_SERVER = "server"
 MODE_CLIENT = "client"
 
 
-def setup_logging(log_level):
-    logging_config = dict(
-        version = 1,
-        formatters = {
-            'simple': {
-                'format': '%(asctime)s %(levelname)-8s %(message)s'
-            }
-        },
-        handlers = {
-            'console': {
-                'class': 'logging.StreamHandler',
-                'formatter': 'simple',
-                'level': log_level,
-                'stream': 'ext://sys.stdout'
-            }
-        },
-        root = {
-            'handlers': ['console'],
-            'level': log_level,
-        },
-    )
-    dictConfig(logging_config)
-    return logging.getLogger(__name__)
+log = setup_logging(log_level_from_env(), __name__)
 
-log = setup_logging(log_levels.get(os.environ.get("LOG_LEVEL", "INFO")))
+_ecs = None
 
 
 def generate_node_name(mode, task_metadata):
@@ -74,56 +57,110 @@ def generate_node_name(mode, task_metadata):
     )
 
 
-def get_task_metadata():
-    metadata_uri = os.environ["ECS_CONTAINER_METADATA_URI"]
-    resp = requests.get("{}/task".format(metadata_uri))
-    log.info("Original Task Metadata \n%s" % resp.text)
-    resp = json.loads(resp.text)
-    ip = resp["Containers"][0]["Networks"][0]["IPv4Addresses"][0]
-    task_id =  resp['TaskARN'].split("/")[2]
-    return {"task_id": task_id, "family": resp['Family'], "ip": ip}
+def ecs_client():
+    """ The ECS client shared by every discovery attempt """
+    global _ecs
+    if _ecs is None:
+        _ecs = boto3.client("ecs", AWS_REGION, config=Config(
+            connect_timeout=5,
+            read_timeout=10,
+            retries={"max_attempts": 3, "mode": "standard"}
+        ))
+    return _ecs
+
+
+def list_server_ips(ecs, consul_cluster_name, consul_family_name):
+    """ Returns the private IPs of all running consul server tasks """
+    task_arns = []
+    paginator = ecs.get_paginator("list_tasks")
+    for page in paginator.paginate(cluster=consul_cluster_name,
+                                   family=consul_family_name,
+                                   desiredStatus='RUNNING'):
+        task_arns.extend(page["taskArns"])
+    log.info("Got task_arns=%s" % task_arns)
+
+    task_ips = []
+    for i in range(0, len(task_arns), DESCRIBE_TASKS_BATCH_SIZE):
+        resp = ecs.describe_tasks(
+            cluster=consul_cluster_name,
+            tasks=task_arns[i:i + DESCRIBE_TASKS_BATCH_SIZE]
+        )
+        for task in resp["tasks"]:
+            if task.get("lastStatus") not in (None, "RUNNING"):
+                continue
+            for container in task["containers"]:
+                interfaces = container.get("networkInterfaces") or []
+                if interfaces and interfaces[0].get("privateIpv4Address"):
+                    task_ips.append(interfaces[0]["privateIpv4Address"])
+                    break
+    return sorted(set(task_ips))
+
+
+def load_cached_ips(filename=DISCOVERY_CACHE_FILE):
+    try:
+        with open(filename) as f:
+            return json.load(f)["server_ips"]
+    except (IOError, OSError, ValueError, KeyError):
+        return []
+
+
+def save_cached_ips(ips, filename=DISCOVERY_CACHE_FILE):
+    try:
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, "w") as f:
+            json.dump({"server_ips": ips, "saved_at": time.time()}, f)
+        os.replace(tmp_filename, filename)
+    except (IOError, OSError) as ex:
+        log.warning("Could not cache server ips, filename=%s, %s" % (filename, ex))
 
 
 def discover_server_ips(consul_cluster_name,
                         consul_family_name,
-                        max_ips=BOOTSTRAP_EXPECT):
+                        min_ips=BOOTSTRAP_EXPECT,
+                        deadline_s=DISCOVERY_DEADLINE_S,
+                        ecs=None,
+                        cache_filename=DISCOVERY_CACHE_FILE):
     """ Gets the ECS tasks for all consul server services and extracts the
     private IP from it and return it.
 
     Since during bootstrap containers may take a bit of time to start, the logic
-    needs to wait for a minimum of `max_ips` to get in the RUNNING state.
+    waits, backing off, for at least `min_ips` to get in the RUNNING state.
+    When the server IPs of a previous run are cached on disk they are used
+    right away instead of waiting, merged with whatever is running now, so a
+    restarted agent rejoins immediately. When `deadline_s` passes, whatever
+    was found is returned.
     """
-    sleep_time_s = 30
+    ecs = ecs or ecs_client()
+    cached_ips = load_cached_ips(cache_filename)
+    start = time.time()
     task_ips = []
-    while True:
-        ecs = boto3.client("ecs", AWS_REGION)
-        resp = ecs.list_tasks(
-            maxResults=max_ips,
-            cluster=consul_cluster_name,
-            family=consul_family_name,
-            desiredStatus='RUNNING'
-        )
-        task_arns = resp["taskArns"]
-        log.info("Got task_arns=%s" % task_arns)
-        if (max_ips-len(task_arns)) != 0:
-            log.info("Waiting %s(s) for %s tasks more to bootstrap" % (sleep_time_s, (max_ips-len(task_arns))))
-            time.sleep(sleep_time_s)
-        else:
+    for delay_s in backoff_delays():
+        try:
+            task_ips = list_server_ips(ecs, consul_cluster_name, consul_family_name)
+        except (BotoCoreError, ClientError) as ex:
+            log.warning("Error listing consul server tasks, %s" % ex)
+        if len(task_ips) >= min_ips:
+            break
+        if cached_ips:
+            log.info("Found %s of %s tasks, joining with cached server_ips=%s" % (
+                len(task_ips), min_ips, cached_ips))
+            task_ips = sorted(set(task_ips) | set(cached_ips))
             break
+        elapsed_s = time.time() - start
+        if elapsed_s + delay_s > deadline_s:
+            log.warning("Gave up waiting for %s tasks after %.1f(s), found %s" % (
+                min_ips, elapsed_s, len(task_ips)))
+            break
+        log.info("Waiting %.1f(s) for %s tasks more to bootstrap" % (delay_s, (min_ips-len(task_ips))))
+        time.sleep(delay_s)
 
-    resp = ecs.describe_tasks(cluster=consul_cluster_name, tasks=task_arns)
-    task_containers = [t['containers'][0] for t in resp['tasks']]
-    task_ips = [
-        c['networkInterfaces'][0]['privateIpv4Address'] for c in task_containers
-    ]
-    log.info("Got task_ips=%s" % task_ips)
+    log.info("Got task_ips=%s in %.3f(s)" % (task_ips, time.time() - start))
+    if task_ips:
+        save_cached_ips(task_ips, cache_filename)
     return task_ips
 
 
-def generate_config(mode,
-                    task_metadata,
-                    consul_cluster_name,
-                    consul_family_name):
+def generate_config(mode, task_metadata, server_ips):
     """ Generates client or server specific Consul configs depending on the mode """
     if mode == MODE_SERVER:
         return json.dumps({
@@ -132,26 +169,144 @@ def generate_config(mode,
             "bootstrap_expect": BOOTSTRAP_EXPECT,
             "datacenter": AWS_REGION,
             "node_name": generate_node_name(mode, task_metadata),
-            "retry_join": discover_server_ips(
-                consul_cluster_name,
-                consul_family_name
-            )
+            "retry_join": server_ips
         })
     return json.dumps({
         "bind_addr": task_metadata["ip"],
         "datacenter": AWS_REGION,
         "node_name": generate_node_name(mode, task_metadata),
-        "retry_join": discover_server_ips(
-            consul_cluster_name,
-            consul_family_name
-        )
+        "retry_join": server_ips
     })
 
 
 def dump_config(config, filename):
+    """ Writes the config atomically, so consul never reads a partial file """
     log.info("Saving config to file, filename==%s" % filename)
-    with open(filename, "w") as f:
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "w") as f:
         f.write(config)
+    os.replace(tmp_filename, filename)
+
+
+class DiscoveryWatcher(object):
+    """ Keeps the retry_join list of a running agent current.
+
+    ECS is polled every `interval_s` for the running consul servers. When
+    the set of server IPs changes, the config file is rewritten and the agent
+    is reloaded and joined to the new servers. Reloads are debounced: one
+    happens `debounce_s` after the last change, or at the latest `max_wait_s`
+    after the first one, so servers being replaced one by one don't cause a
+    reload storm.
+    """
+
+    def __init__(self,
+                 mode,
+                 task_metadata,
+                 consul_cluster_name,
+                 consul_family_name,
+                 filename,
+                 interval_s=DISCOVERY_WATCH_INTERVAL_S,
+                 debounce_s=DISCOVERY_RELOAD_DEBOUNCE_S,
+                 max_wait_s=None,
+                 ecs=None):
+        self.mode = mode
+        self.task_metadata = task_metadata
+        self.consul_cluster_name = consul_cluster_name
+        self.consul_family_name = consul_family_name
+        self.filename = filename
+        self.interval_s = interval_s
+        self.debounce_s = debounce_s
+        self.max_wait_s = max_wait_s if max_wait_s is not None else debounce_s * 5
+        self.ecs = ecs or ecs_client()
+        self.server_ips = self._load_server_ips()
+        self._joined_ips = set(self.server_ips)
+        self._first_change_at = None
+        self._last_change_at = None
+        self.stats = {
+            "polls": 0,
+            "errors": 0,
+            "changes": 0,
+            "reloads": 0,
+            "reload_errors": 0,
+            "last_discovery_ms": None,
+            "max_discovery_ms": 0.0,
+        }
+
+    def _load_server_ips(self):
+        try:
+            with open(self.filename) as f:
+                return sorted(json.load(f)["retry_join"])
+        except (IOError, OSError, ValueError, KeyError):
+            return []
+
+    def poll(self, now=None):
+        """ Discovers the server IPs once, returns True when they changed """
+        now = now or time.time()
+        self.stats["polls"] += 1
+        start = time.time()
+        try:
+            server_ips = list_server_ips(self.ecs, self.consul_cluster_name, self.consul_family_name)
+        except (BotoCoreError, ClientError) as ex:
+            self.stats["errors"] += 1
+            log.warning("Error listing consul server tasks, %s" % ex)
+            return False
+        discovery_ms = (time.time() - start) * 1000
+        self.stats["last_discovery_ms"] = round(discovery_ms, 3)
+        self.stats["max_discovery_ms"] = round(max(self.stats["max_discovery_ms"], discovery_ms), 3)
+
+        # An empty result is more likely an ECS hiccup than no servers at all
+        if not server_ips or server_ips == self.server_ips:
+            return False
+
+        log.info("Consul servers changed, added=%s, removed=%s" % (
+            sorted(set(server_ips) - set(self.server_ips)),
+            sorted(set(self.server_ips) - set(server_ips))))
+        self.server_ips = server_ips
+        self.stats["changes"] += 1
+        dump_config(generate_config(self.mode, self.task_metadata, server_ips), self.filename)
+        save_cached_ips(server_ips)
+        self._last_change_at = now
+        if self._first_change_at is None:
+            self._first_change_at = now
+        return True
+
+    def reload_due_at(self):
+        if self._first_change_at is None:
+            return None
+        return min(self._last_change_at + self.debounce_s, self._first_change_at + self.max_wait_s)
+
+    def reload_if_due(self, now=None):
+        due_at = self.reload_due_at()
+        if due_at is None or (now or time.time()) < due_at:
+            return False
+        self._first_change_at = self._last_change_at = None
+        self.stats["reloads"] += 1
+        try:
+            subprocess.check_call(["consul", "reload"])
+            # retry_join is only used when the agent starts, so the new
+            # servers are joined explicitly as well
+            new_ips = sorted(set(self.server_ips) - self._joined_ips)
+            if new_ips:
+                subprocess.check_call(["consul", "join"] + new_ips)
+            self._joined_ips = set(self.server_ips)
+        except (OSError, subprocess.CalledProcessError) as ex:
+            self.stats["reload_errors"] += 1
+            log.warning("Error reloading consul, %s" % ex)
+        log.info("Reloaded consul, server_ips=%s, stats=%s" % (self.server_ips, json.dumps(self.stats)))
+        return True
+
+    def run(self):
+        log.info("Watching consul servers every %s(s), server_ips=%s" % (self.interval_s, self.server_ips))
+        next_poll_at = time.time()
+        while True:
+            now = time.time()
+            if now >= next_poll_at:
+                self.poll(now)
+                next_poll_at = now + self.interval_s
+            self.reload_if_due()
+            due_at = self.reload_due_at()
+            wake_at = next_poll_at if due_at is None else min(next_poll_at, due_at)
+            time.sleep(max(wake_at - time.time(), 0))
 
 
 def _parse_args():
@@ -194,6 +349,11 @@ def _parse_args():
         default="/consul/config/server-discovery.json",
         help='Absolute path of (JSON) filename to store the consul configuration.'
     )
+    parser.add_argument(
+        '-watch',
+        action='store_true',
+        help='Keep running and update the configuration when the consul servers change.'
+    )
     return parser
 
 
@@ -204,7 +364,8 @@ def main():
         python /discovery.py -mode <client|server> \
                              -ecs-cluster <ECS_CLUSTER> \
                              -ecs-family <ECS_FAMILY> \
-                             -saveto <FILENAME>
+                             -saveto <FILENAME> \
+                             [-watch]
     """
     try:
         parser = _parse_args()
@@ -213,20 +374,29 @@ def main():
         consul_cluster_name = args['ecs_cluster'][0]
         consul_family_name = args['ecs_family'][0]
         filename = args['saveto'][0]
+        watch = args['watch']
     except SystemExit:
         parser.print_help()
         exit(1)
 
     log.info("Running script.")
-    metadata = get_task_metadata()
-    log.info("Got Task Metadata \n%s " % json.dumps(metadata))
-    config = generate_config(mode,
-                             metadata,
-                             consul_cluster_name,
-                             consul_family_name)
+    if watch:
+        metadata = get_task_metadata()
+        DiscoveryWatcher(mode, metadata, consul_cluster_name, consul_family_name, filename).run()
+        return
+
+    # The task metadata and the servers don't depend on each other
+    start = time.time()
+    with futures.ThreadPoolExecutor(max_workers=2) as executor:
+        metadata_future = executor.submit(get_task_metadata)
+        server_ips_future = executor.submit(discover_server_ips, consul_cluster_name, consul_family_name)
+        metadata = metadata_future.result()
+        log.info("Got Task Metadata in %.3f(s) \n%s " % (time.time() - start, json.dumps(metadata)))
+        server_ips = server_ips_future.result()
+    config = generate_config(mode, metadata, server_ips)
     log.info("Generated config \n%s " % config)
     dump_config(config, filename)
-    log.info("Saved to file, filename==%s" % filename)
+    log.info("Saved to file in %.3f(s), filename==%s" % (time.time() - start, filename))
 
 
 if __name__=='__main__':
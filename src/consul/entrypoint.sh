@@ -30,6 +30,15 @@ else
                           -ecs-cluster $CONSUL_ECS_CLUSTER \
                           -ecs-family $CONSUL_ECS_SERVICE
 
+    # Keep the discovery configuration current while the agent runs
+    if [ "$DISCOVERY_WATCH" == "true" ]; then
+        /scripts/discovery.py -mode $MODE \
+                              -saveto $CONFIG_DIR/discovery.json \
+                              -ecs-cluster $CONSUL_ECS_CLUSTER \
+                              -ecs-family $CONSUL_ECS_SERVICE \
+                              -watch &
+    fi
+
     set -- consul agent \
                 -config-dir $CONFIG_DIR \
                 -data-dir="$DATA_DIR" \
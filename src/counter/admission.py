@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import threading
+
+from common import metrics
+from common.context import current_context
+
+
+SHED_OVER_LIMIT = "over_limit"
+SHED_DEADLINE = "deadline"
+
+# Enough for a stable median without sorting every request of a busy window
+MAX_WINDOW_SAMPLES = 1000
+
+
+class AdmissionController(object):
+    """ An adaptive limit on the requests a worker handles at once.
+
+    The limit moves AIMD style with the measured latency. The median latency
+    of each window of `window_s` is compared with the lowest window median of
+    the last `min_rtt_reset_s`, which stands in for the latency without load.
+    The median moves when every request slows down under load, but not for a
+    few stalled requests, which a lower limit wouldn't help.
+
+    When a window is more than `tolerance` times slower, and at least
+    `slack_s` slower, the limit is cut by `backoff`. Otherwise it grows by
+    one, as long as the window used at least half of it.
+
+    Requests over the limit are shed right away, instead of queueing behind
+    requests that are already too slow.
+    """
+
+    def __init__(self,
+                 initial_limit=20,
+                 min_limit=2,
+                 max_limit=200,
+                 tolerance=2.0,
+                 slack_s=0.005,
+                 backoff=0.9,
+                 window_s=0.25,
+                 min_rtt_reset_s=30.0,
+                 registry=metrics.REGISTRY):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.slack_s = slack_s
+        self.backoff = backoff
+        self.window_s = window_s
+        self.min_rtt_reset_s = min_rtt_reset_s
+        self.limit = float(initial_limit)
+        self.in_flight = 0
+        self.min_rtt = None
+        self._min_rtt_at = 0.0
+        self._window_end = time.time() + window_s
+        self._window_samples = []
+        self._window_max_in_flight = 0
+        self._lock = threading.Lock()
+
+        self._shed = registry.counter(
+            "admission_shed_total", "Requests shed by the admission controller", ("reason",)
+        )
+        # Moved by the change in the limit, so the sum over workers is the
+        # limit of the whole instance
+        self._limit_gauge = registry.gauge(
+            "admission_concurrency_limit", "Requests admitted at once"
+        )
+        self._reported_limit = 0
+        self._reported_pid = None
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            initial_limit=int(os.environ.get("ADMISSION_INITIAL_LIMIT", 20)),
+            min_limit=int(os.environ.get("ADMISSION_MIN_LIMIT", 2)),
+            max_limit=int(os.environ.get("ADMISSION_MAX_LIMIT", 200)),
+            tolerance=float(os.environ.get("ADMISSION_TOLERANCE", 2.0)),
+            window_s=float(os.environ.get("ADMISSION_WINDOW_S", 0.25))
+        )
+
+    def try_acquire(self):
+        """ Admits a request unless the limit is reached, in which case it
+        should be shed. Admitted requests must be released.
+        """
+        with self._lock:
+            self._report_limit()
+            if self.in_flight >= int(self.limit):
+                admitted = False
+            else:
+                admitted = True
+                self.in_flight += 1
+                self._window_max_in_flight = max(self._window_max_in_flight, self.in_flight)
+        if not admitted:
+            self._shed.inc(1, (SHED_OVER_LIMIT,))
+        return admitted
+
+    def shed_expired(self):
+        """ Counts a request shed because its caller already gave up """
+        self._shed.inc(1, (SHED_DEADLINE,))
+
+    def release(self, duration_s):
+        with self._lock:
+            self.in_flight -= 1
+            if len(self._window_samples) < MAX_WINDOW_SAMPLES:
+                self._window_samples.append(duration_s)
+            now = time.time()
+            if now >= self._window_end:
+                self._update(now)
+
+    def _update(self, now):
+        samples = sorted(self._window_samples)
+        rtt = samples[len(samples) // 2]
+        if self.min_rtt is None or rtt < self.min_rtt or now - self._min_rtt_at > self.min_rtt_reset_s:
+            self.min_rtt = rtt
+            self._min_rtt_at = now
+        if rtt > max(self.min_rtt * self.tolerance, self.min_rtt + self.slack_s):
+            self.limit = max(self.limit * self.backoff, self.min_limit)
+        elif self._window_max_in_flight * 2 >= self.limit:
+            self.limit = min(self.limit + 1, self.max_limit)
+        self._window_end = now + self.window_s
+        self._window_samples = []
+        self._window_max_in_flight = self.in_flight
+        self._report_limit()
+
+    def _report_limit(self):
+        # The gauge is reset in forked workers
+        pid = os.getpid()
+        if self._reported_pid != pid:
+            self._reported_pid = pid
+            self._reported_limit = 0
+        limit = int(self.limit)
+        if limit != self._reported_limit:
+            self._limit_gauge.inc(limit - self._reported_limit)
+            self._reported_limit = limit
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "min_rtt_ms": None if self.min_rtt is None else round(self.min_rtt * 1000, 3),
+            }
+
+
+def init_flask(app, controller, priority_paths=()):
+    """ Sheds the requests of a Flask app that are over the limit of
+    `controller`, or whose deadline has passed, with a fast 503.
+
+    Requests to `priority_paths`, e.g. health checks, are always admitted
+    and left out of the limit, so they keep passing under load.
+    """
+    from flask import g, request, make_response
+
+    def shed(message):
+        response = make_response(json.dumps({
+            "message": message,
+            "trace_id": current_context().trace_id,
+            "request_id": current_context().request_id
+        }), 503)
+        # Tells Envoy not to retry the request on another overloaded host
+        response.headers["X-Envoy-Overloaded"] = "true"
+        return response
+
+    @app.before_request
+    def _admit_request():
+        if request.path in priority_paths:
+            return None
+        remaining_s = current_context().remaining_s()
+        if remaining_s is not None and remaining_s <= 0:
+            controller.shed_expired()
+            return shed("Deadline exceeded before the request was handled")
+        if not controller.try_acquire():
+            return shed("Over the concurrency limit of %s" % int(controller.limit))
+        g.admission_start = time.perf_counter()
+        return None
+
+    @app.teardown_request
+    def _release_request(exc):
+        start = g.pop("admission_start", None)
+        if start is not None:
+            controller.release(time.perf_counter() - start)
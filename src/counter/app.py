@@ -1,70 +1,135 @@
 import os
-import sys
-import time
+import atexit
 import json
 import socket
-import logging
-from logging.config import dictConfig
 
 from flask import Flask, make_response, request
+from flask.logging import default_handler
 from aws_xray_sdk.core import xray_recorder, patch_all
 from aws_xray_sdk.ext.flask.middleware import XRayMiddleware
 from werkzeug.exceptions import HTTPException
 
+from common import health, metrics, profiling
+from common.context import current_context, init_flask
+from common.logs import setup_logging, log_level_from_env
+from common.tracing import configure_tracing
+from server import serve
+from persistence import WriteBehindPersister
+from shared_counter import SharedCounter
+from consul_counter import ConsulCounter
+from counter_store import CounterStore, StoreFullError
+from faults import FaultInjector, InvalidFaultConfig, delay, reset_connection
+import admission
 
-log_levels = {
-    'DEBUG': logging.DEBUG,
-    'INFO': logging.INFO,
-    'WARNING': logging.WARNING,
-    'ERROR': logging.ERROR,
-    'CRITICAL': logging.CRITICAL
-}
-
-# Maintain count in memory
-count = 0
-
-
-def setup_logging(log_level):
-    logging_config = dict(
-        version = 1,
-        formatters = {
-            'simple': {
-                    'format': '%(asctime)s %(levelname)-8s %(message)s'
-                }
-            },
-        handlers = {
-            'console': {
-                    'class': 'logging.StreamHandler',
-                    'formatter': 'simple',
-                    'level': log_level,
-                    'stream': 'ext://sys.stdout'
-                }
-            },
-        root = {
-            'handlers': ['console'],
-            'level': log_level,
-            },
-    )
-    dictConfig(logging_config)
-
-
-def get_trace_id(x_amzn_trace_id):
-    if x_amzn_trace_id and "Root=" in x_amzn_trace_id:
-        trace_id = x_amzn_trace_id.split("Root=")[1].split(";")[0]
-        return trace_id
+
+FAIL_TIMEOUT_S = float(os.environ.get("FAIL_TIMEOUT_S", 100))
+
+# Served ahead of the fault injection, see common/health.py
+LIVENESS_BODY = json.dumps({"status": "COUNTER_HEALTHY"}).encode("utf-8")
+
+# Paths that faults are never injected into, along with the debug endpoints.
+# Health probes never reach the app, see common/health.py
+FAULT_EXEMPT_PATHS = ("/faults", "/persistence", "/distributed", "/metrics")
+
+# Paths that are never shed. Health probes are answered ahead of the app, so
+# they don't flap under load either
+ADMISSION_PRIORITY_PATHS = ("/metrics",)
 
 
 def create_app():
     app = Flask(__name__)
+    init_flask(app)
+    metrics.init_flask(app)
 
     # Configure xray tracing
-    xray_recorder.configure(service='counter')
+    configure_tracing(xray_recorder, 'counter')
     XRayMiddleware(app, xray_recorder)
     patch_all()
 
     # Setup logging
-    setup_logging(log_levels.get(os.environ.get("LOG_LEVEL", "INFO")))
-    log = logging.getLogger(__name__)
+    log = setup_logging(log_level_from_env(), __name__)
+    app.logger.removeHandler(default_handler)
+
+    # Profiling and allocation tracking on demand, see common/profiling.py
+    if os.environ.get("DEBUG_ENDPOINTS") == "true":
+        profiling.init_flask(app, token=os.environ.get("DEBUG_TOKEN"))
+
+    # Shed requests early when over an adaptive concurrency limit, before
+    # they queue up behind requests that are already too slow
+    if os.environ.get("ADMISSION_CONTROL", "true") == "true":
+        admission.init_flask(app, admission.AdmissionController.from_env(),
+                             priority_paths=ADMISSION_PRIORITY_PATHS)
+
+    # Maintain count in shared memory so that all workers see the same value,
+    # optionally persisted in the background so it survives restarts. With a
+    # COUNTER_KV_KEY, every replica adds to one count kept in Consul KV
+    # instead, which is then where it's persisted
+    kv_key = os.environ.get("COUNTER_KV_KEY")
+    state_dir = None if kv_key else os.environ.get("COUNTER_STATE_DIR")
+    persister = None
+    if kv_key:
+        counter = ConsulCounter.from_env(kv_key)
+        counter.start()
+        atexit.register(counter.stop)
+    elif state_dir:
+        persister = WriteBehindPersister(
+            state_dir,
+            flush_interval_s=float(os.environ.get("COUNTER_FLUSH_INTERVAL_S", 1.0))
+        )
+        counter = SharedCounter(persister.recover())
+        persister.start(counter)
+        atexit.register(persister.stop)
+    else:
+        counter = SharedCounter()
+
+    # Dependencies checked in the background for readiness probes
+    deep_checks = {}
+    if state_dir:
+        def check_state_dir():
+            if not os.access(state_dir, os.W_OK):
+                raise IOError("%s is not writable" % state_dir)
+        deep_checks["persistence"] = check_state_dir
+    if kv_key:
+        deep_checks["consul_kv"] = counter.check
+    health.init_flask(app, LIVENESS_BODY, health.DeepHealthCheck.from_env(deep_checks))
+
+    # Named counters, shared across workers the same way
+    store = CounterStore(int(os.environ.get("COUNTER_MAX_KEYS", 262144)))
+
+    # Read from shared memory when scraped, so they're the same on every worker
+    metrics.REGISTRY.gauge("counter_count", "The current count", function=lambda: counter.value)
+    if persister is not None:
+        metrics.REGISTRY.gauge("counter_unflushed", "Increments not yet persisted",
+                               function=persister.unflushed)
+    if kv_key:
+        metrics.REGISTRY.gauge("counter_unflushed", "Increments not yet added to Consul KV",
+                               function=counter.pending)
+
+    def bad_request(message):
+        return make_response(json.dumps({"message": message}), 400)
+
+    # Runtime configurable faults, shared across workers
+    faults = FaultInjector()
+
+    @app.before_request
+    def inject_faults():
+        if request.path in FAULT_EXEMPT_PATHS or request.path.startswith(profiling.PATH_PREFIX):
+            return None
+        fault = faults.decide()
+        if not fault:
+            return None
+        if fault.delay_s:
+            delay(fault.delay_s)
+        if fault.reset and reset_connection(request.environ):
+            return make_response("", 502)
+        if fault.status_code or fault.reset:
+            status_code = fault.status_code or 502
+            return make_response(json.dumps({
+                "message": "Injected fault, code=%s" % status_code,
+                "trace_id": current_context().trace_id,
+                "request_id": current_context().request_id
+            }), status_code)
+        return None
 
     @app.errorhandler(HTTPException)
     def handle_error(error):
@@ -79,8 +144,8 @@ def create_app():
             json.dumps({
                 "message": "Error occured",
                 "code": error.code,
-                "trace_id": get_trace_id(request.headers.get("X-Amzn-Trace-Id")),
-                "request_id": request.headers.get("X-Request-Id")
+                "trace_id": current_context().trace_id,
+                "request_id": current_context().request_id
             }), 500
         )
 
@@ -98,56 +163,138 @@ def create_app():
                 'X-Envoy-Downstream-Service-Node'
             ]
         '''
-        global count
-        count = count + 1
-        log.info(
-            "Received request, trace_id={}, req_id={}".format(
-                get_trace_id(request.headers.get("X-Amzn-Trace-Id")),
-                request.headers.get("X-Request-Id")
-            )
-        )
+        count = counter.increment()
+        log.info("Received request", extra={
+            "route": "/",
+            "status_code": 200
+        })
         return json.dumps({
             "count": count,
             "counter_service_id": socket.gethostname(),
-            "trace_id": get_trace_id(request.headers.get("X-Amzn-Trace-Id")),
-            "request_id": request.headers.get("X-Request-Id")
+            "trace_id": current_context().trace_id,
+            "request_id": current_context().request_id
         })
 
     @app.route("/fail")
     def fail():
         code = int(request.args.get('code'))
         if code == 504:
-            # Simulate 504 by timeout
-            time.sleep(100)
+            # Simulate 504 by timeout, see faults.delay()
+            delay(FAIL_TIMEOUT_S)
             return make_response(json.dumps({}))
         elif code == 502:
-            # Simulate 502 by abrupt exit
-            sys.exit(1)
+            # Simulate 502 by resetting the connection
+            if reset_connection(request.environ):
+                return make_response("", 502)
+            return make_response(json.dumps({}), 502)
         else:
             # For 503 and 500 return the code
             msg = "/fail?code={} called! Responding with {}, trace_id={}, req_id={}".format(
                 code, code,
-                get_trace_id(request.headers.get("X-Amzn-Trace-Id")),
-                request.headers.get("X-Request-Id")
+                current_context().trace_id,
+                current_context().request_id
             )
-            log.info(msg)
+            log.info("/fail?code=%s called! Responding with %s", code, code, extra={
+                "route": "/fail",
+                "status_code": code
+            })
             resp = make_response(
                 json.dumps({
                     "message": msg,
-                    "trace_id": get_trace_id(request.headers.get("X-Amzn-Trace-Id")),
-                    "request_id": request.headers.get("X-Request-Id")
+                    "trace_id": current_context().trace_id,
+                    "request_id": current_context().request_id
                 }), int(code)
             )
             return resp
 
-    @app.route("/health")
-    def health():
-        return json.dumps({"status": "COUNTER_HEALTHY"})
+    @app.route("/faults", methods=["GET"])
+    def get_faults():
+        return json.dumps(faults.config)
+
+    @app.route("/faults", methods=["PUT"])
+    def configure_faults():
+        '''Replaces the fault config, see faults.validate_config()'''
+        try:
+            config = faults.configure(request.get_json(force=True, silent=True))
+        except InvalidFaultConfig as ex:
+            return bad_request(str(ex))
+        log.info("Configured faults, config=%s", config)
+        return json.dumps(config)
+
+    @app.route("/count")
+    def read_count():
+        '''Returns the current count without incrementing it'''
+        return json.dumps({
+            "count": counter.value,
+            "counter_service_id": socket.gethostname()
+        })
+
+    @app.route("/counters/<name>", methods=["GET"])
+    def get_counter(name):
+        return json.dumps({"name": name, "count": store.get(name)})
+
+    @app.route("/counters/<name>", methods=["POST"])
+    def increment_counter(name):
+        try:
+            delta = int(request.args.get("delta", 1))
+        except ValueError:
+            return bad_request("delta must be an integer")
+        try:
+            count = store.increment(name, delta)
+        except StoreFullError as ex:
+            return make_response(json.dumps({"message": str(ex)}), 507)
+        return json.dumps({"name": name, "count": count})
+
+    @app.route("/counters", methods=["GET"])
+    def get_counters():
+        '''Reads many counters at once, e.g. /counters?names=a,b&names=c'''
+        names = []
+        for value in request.args.getlist("names"):
+            names.extend(n for n in value.split(",") if n)
+        return json.dumps({"counters": store.get_many(names)})
+
+    @app.route("/counters", methods=["POST"])
+    def increment_counters():
+        '''Applies many increments at once, the body is either
+            {"increments": [["a", 1], ["b", 5]]} or {"increments": {"a": 1, "b": 5}}
+        '''
+        body = request.get_json(force=True, silent=True)
+        if not isinstance(body, dict):
+            return bad_request("The body must be a JSON object with increments")
+        increments = body.get("increments")
+        if isinstance(increments, dict):
+            increments = list(increments.items())
+        if not isinstance(increments, list):
+            return bad_request("increments must be a list of [name, delta] pairs")
+        try:
+            increments = [(str(name), int(delta)) for name, delta in increments]
+        except (TypeError, ValueError):
+            return bad_request("increments must be a list of [name, delta] pairs")
+        try:
+            counters = store.increment_many(increments)
+        except StoreFullError as ex:
+            return make_response(json.dumps({"message": str(ex)}), 507)
+        return json.dumps({"counters": counters})
+
+    @app.route("/persistence")
+    def persistence():
+        if persister is None:
+            return json.dumps({"enabled": False})
+        stats = persister.stats()
+        stats["enabled"] = True
+        return json.dumps(stats)
 
+    @app.route("/distributed")
+    def distributed():
+        if not kv_key:
+            return json.dumps({"enabled": False})
+        stats = counter.stats()
+        stats["enabled"] = True
+        return json.dumps(stats)
 
     return app
 
 
 if __name__ == "__main__":
     app = create_app()
-    app.run(host="0.0.0.0", port=os.environ.get('PORT', 80))
+    serve(app, os.environ.get('PORT', 80))
@@ -0,0 +1,320 @@
+import os
+import json
+import mmap
+import time
+import uuid
+import base64
+import socket
+import struct
+import logging
+import threading
+import multiprocessing
+
+import requests
+
+from common.backoff import backoff_delays
+
+
+log = logging.getLogger(__name__)
+
+CONSUL_HTTP_ADDR = os.environ.get("CONSUL_HTTP_ADDR", "127.0.0.1:8500")
+
+# Slots of the shared memory mapping, all signed 64-bit
+SLOTS_FORMAT = "<7q"
+PENDING, GLOBAL, KV_VALUE, KV_INDEX, FLUSHES, CONFLICTS, ERRORS = range(7)
+SLOT_SIZE = struct.calcsize("<q")
+
+
+def _b64(text):
+    return base64.b64encode(text.encode("utf-8")).decode("ascii")
+
+
+def _consul_url(consul_addr):
+    if not consul_addr.startswith("http"):
+        consul_addr = "http://%s" % consul_addr
+    return consul_addr.rstrip("/")
+
+
+class ConsulCounter(object):
+    """ A count shared by every counter replica, kept in a Consul KV key.
+
+    Increments only add to a pending delta in shared memory. Every
+    `flush_interval_s` the pending delta is added to the key with a
+    check-and-set, which is retried with backoff when another replica wrote
+    the key in between. However many increments there were, a replica writes
+    the key about once per interval.
+
+    The count of the key is cached from a blocking query, which Consul
+    answers as soon as the key changes. Reads return it plus the increments
+    pending here, so a replica counts its own increments right away and
+    those of the others within about a flush interval.
+
+    Like the persister, the flushes and the blocking query run in the process
+    that started the counter, and forked workers only touch the shared memory.
+    Increments made since the last flush are lost if that process crashes.
+
+    A flush whose response is lost, e.g. to a read timeout, may or may not
+    have been written. So every flush also writes its id to a key of its own
+    replica, under `<key>/flushes/`, in the same transaction. Nothing else is
+    flushed until that flush is settled, see `_resolve_in_doubt`, so its
+    increments are never added twice.
+    """
+
+    def __init__(self, key,
+                 consul_addr=CONSUL_HTTP_ADDR,
+                 flush_interval_s=0.5,
+                 wait_s=30,
+                 max_attempts=5,
+                 timeout_s=1.0,
+                 token=None):
+        self.key = key.strip("/")
+        self.kv_url = "%s/v1/kv" % _consul_url(consul_addr)
+        self.url = "%s/%s" % (self.kv_url, self.key)
+        self.txn_url = "%s/v1/txn" % _consul_url(consul_addr)
+        self.flush_key = None
+        self.flush_interval_s = flush_interval_s
+        self.wait_s = wait_s
+        self.max_attempts = max_attempts
+        self.timeout_s = timeout_s
+        self._headers = {"X-Consul-Token": token} if token else {}
+        self._mm = mmap.mmap(-1, struct.calcsize(SLOTS_FORMAT))
+        self._lock = multiprocessing.Lock()
+        self._owner_pid = None
+        self._flush_session = None
+        # (flush id, delta, count, index) of a flush that may not have been written
+        self._in_doubt = None
+        self._stop = threading.Event()
+        self._threads = []
+
+    @classmethod
+    def from_env(cls, key):
+        return cls(
+            key,
+            flush_interval_s=float(os.environ.get("COUNTER_KV_FLUSH_INTERVAL_S", 0.5)),
+            wait_s=int(os.environ.get("COUNTER_KV_WAIT_S", 30)),
+            token=os.environ.get("CONSUL_HTTP_TOKEN")
+        )
+
+    def _get(self, slot):
+        return struct.unpack_from("<q", self._mm, slot * SLOT_SIZE)[0]
+
+    def _set(self, slot, value):
+        struct.pack_into("<q", self._mm, slot * SLOT_SIZE, value)
+
+    def _add(self, slot, delta):
+        with self._lock:
+            self._set(slot, self._get(slot) + delta)
+
+    def increment(self, delta=1):
+        with self._lock:
+            pending = self._get(PENDING) + delta
+            self._set(PENDING, pending)
+            return self._get(GLOBAL) + pending
+
+    @property
+    def value(self):
+        with self._lock:
+            return self._get(GLOBAL) + self._get(PENDING)
+
+    def pending(self):
+        """ Increments not yet added to the key """
+        return self._get(PENDING)
+
+    def start(self):
+        """ Reads the key and starts flushing to and watching it in
+        background threads
+        """
+        self._owner_pid = os.getpid()
+        self.flush_key = "%s/flushes/%s-%s" % (self.key, socket.gethostname(), self._owner_pid)
+        self._flush_session = requests.Session()
+        try:
+            self._observe(*self._read(self._flush_session)[:2])
+        except (requests.exceptions.RequestException, ValueError) as ex:
+            log.warning("Error reading %s from consul, starting from 0, %s" % (self.key, ex))
+        for target, name in ((self._run_flusher, "consul-counter-flusher"),
+                             (self._run_watcher, "consul-counter-watcher")):
+            thread = threading.Thread(target=target, name=name)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """ Stops the background threads and does a final flush """
+        self._stop.set()
+        if self._threads:
+            self._threads[0].join(self.flush_interval_s * 2)
+        self.flush()
+        if self._in_doubt is None and self.flush_key and os.getpid() == self._owner_pid:
+            try:
+                self._flush_session.delete("%s/%s" % (self.kv_url, self.flush_key),
+                                           headers=self._headers, timeout=self.timeout_s)
+            except requests.exceptions.RequestException:
+                pass
+
+    def _read(self, session, index=None):
+        """ Returns (count, modify_index, consul_index) of the key, blocking
+        until it changes past `index` if given
+        """
+        params = {}
+        timeout_s = self.timeout_s
+        if index:
+            params = {"index": index, "wait": "%ss" % self.wait_s}
+            # Consul adds up to wait / 16 of jitter
+            timeout_s += self.wait_s * 17 / 16.0
+        resp = session.get(self.url, params=params, headers=self._headers, timeout=timeout_s)
+        consul_index = int(resp.headers.get("X-Consul-Index", 0))
+        if resp.status_code == 404:
+            return 0, 0, consul_index
+        resp.raise_for_status()
+        entry = resp.json()[0]
+        count = int(base64.b64decode(entry["Value"])) if entry["Value"] else 0
+        return count, entry["ModifyIndex"], consul_index
+
+    def _observe(self, count, modify_index):
+        """ Caches the key as of `modify_index`, unless a later one is cached """
+        with self._lock:
+            if modify_index < self._get(KV_INDEX):
+                return
+            self._set(KV_VALUE, count)
+            self._set(KV_INDEX, modify_index)
+            # The count only grows, and a flush may already have been
+            # counted before its write is seen here
+            self._set(GLOBAL, max(self._get(GLOBAL), count))
+
+    def _write(self, count, index, flush_id):
+        """ Returns whether `count` was written, which is only if the key is
+        still at `index`. An index of 0 only creates the key if it doesn't exist yet.
+        """
+        ops = [
+            {"KV": {"Verb": "cas", "Key": self.key, "Index": index, "Value": _b64(str(count))}},
+            {"KV": {"Verb": "set", "Key": self.flush_key, "Value": _b64(flush_id)}},
+        ]
+        resp = self._flush_session.put(self.txn_url, data=json.dumps(ops),
+                                       headers=self._headers, timeout=self.timeout_s)
+        # Consul rolls the transaction back with a 409 when the cas fails
+        if resp.status_code == 409:
+            return False
+        resp.raise_for_status()
+        return True
+
+    def _flushed(self, delta, count):
+        with self._lock:
+            self._set(PENDING, self._get(PENDING) - delta)
+            self._set(GLOBAL, max(self._get(GLOBAL), count))
+            self._set(FLUSHES, self._get(FLUSHES) + 1)
+
+    def _flush_id(self):
+        """ The id of the last flush of this replica that was written """
+        resp = self._flush_session.get("%s/%s" % (self.kv_url, self.flush_key),
+                                       headers=self._headers, timeout=self.timeout_s)
+        if resp.status_code == 404:
+            return None
+        resp.raise_for_status()
+        return base64.b64decode(resp.json()[0]["Value"] or b"").decode("utf-8")
+
+    def _resolve_in_doubt(self):
+        """ Returns whether the flush in doubt, if any, is settled.
+
+        It's settled by making the same write again. The write only succeeds
+        if the first one wasn't made, and once the key has moved on the first
+        one can't be made anymore, so the flush id tells whether it was.
+        """
+        if self._in_doubt is None:
+            return True
+        flush_id, delta, count, index = self._in_doubt
+        try:
+            written = self._write(count, index, flush_id) or self._flush_id() == flush_id
+        except (requests.exceptions.RequestException, ValueError) as ex:
+            self._add(ERRORS, 1)
+            log.warning("Error settling the last flush of %s, pending=%s, %s" % (self.key, delta, ex))
+            return False
+        self._in_doubt = None
+        if written:
+            self._flushed(delta, count)
+        log.info("The last flush of %s, pending=%s, was%s written" % (self.key, delta, "" if written else " not"))
+        return True
+
+    def flush(self):
+        """ Adds the pending increments to the key, retrying on conflicts """
+        if os.getpid() != self._owner_pid:
+            return
+        if not self._resolve_in_doubt():
+            return
+        delta = self._get(PENDING)
+        if not delta:
+            return
+        with self._lock:
+            count, index = self._get(KV_VALUE), self._get(KV_INDEX)
+        delays = backoff_delays(initial_s=0.01, max_s=self.flush_interval_s)
+        for _ in range(self.max_attempts):
+            flush_id = uuid.uuid4().hex
+            try:
+                written = self._write(count + delta, index, flush_id)
+            except requests.exceptions.RequestException as ex:
+                # The write may have been made even though it failed here
+                self._in_doubt = (flush_id, delta, count + delta, index)
+                self._add(ERRORS, 1)
+                log.warning("Error flushing %s to consul, pending=%s, %s" % (self.key, delta, ex))
+                self._resolve_in_doubt()
+                return
+            if written:
+                self._flushed(delta, count + delta)
+                return
+            self._add(CONFLICTS, 1)
+            time.sleep(next(delays))
+            try:
+                count, index = self._read(self._flush_session)[:2]
+            except (requests.exceptions.RequestException, ValueError) as ex:
+                self._add(ERRORS, 1)
+                log.warning("Error reading %s from consul, pending=%s, %s" % (self.key, delta, ex))
+                return
+            self._observe(count, index)
+        log.warning("Gave up flushing %s to consul after %s conflicts, pending=%s"
+                    % (self.key, self.max_attempts, delta))
+
+    def _run_flusher(self):
+        while not self._stop.wait(self.flush_interval_s):
+            try:
+                self.flush()
+            except Exception:
+                log.exception("Error flushing %s to consul", self.key)
+
+    def _run_watcher(self):
+        session = requests.Session()
+        delays = None
+        index = self._get(KV_INDEX)
+        while not self._stop.is_set():
+            try:
+                count, modify_index, consul_index = self._read(session, index=max(index, 1))
+            except (requests.exceptions.RequestException, ValueError) as ex:
+                delays = delays or backoff_delays(initial_s=0.1, max_s=self.wait_s)
+                log.warning("Error watching %s in consul, %s" % (self.key, ex))
+                self._add(ERRORS, 1)
+                self._stop.wait(next(delays))
+                continue
+            delays = None
+            self._observe(count, modify_index)
+            # Consul's index can go backwards, e.g. after a snapshot restore,
+            # in which case the query has to start over
+            index = consul_index if consul_index > index else 0
+
+    def check(self):
+        """ Raises unless the key can be read, for readiness checks. A key
+        that doesn't exist yet is created by the first flush.
+        """
+        resp = requests.get(self.url, headers=self._headers, timeout=self.timeout_s)
+        if resp.status_code != 404:
+            resp.raise_for_status()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "key": self.key,
+                "global_count": self._get(GLOBAL),
+                "pending": self._get(PENDING),
+                "modify_index": self._get(KV_INDEX),
+                "flushes": self._get(FLUSHES),
+                "conflicts": self._get(CONFLICTS),
+                "errors": self._get(ERRORS),
+                "flush_interval_s": self.flush_interval_s,
+            }
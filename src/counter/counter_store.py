@@ -0,0 +1,109 @@
+import mmap
+import struct
+import hashlib
+import multiprocessing
+
+
+# Each slot holds the 64-bit hash of a counter name and its value
+SLOT_FORMAT = "<Qq"
+SLOT_SIZE = struct.calcsize(SLOT_FORMAT)
+EMPTY = 0
+
+
+class StoreFullError(Exception):
+    pass
+
+
+def _key_hash(name):
+    h = struct.unpack(
+        "<Q", hashlib.blake2b(name.encode("utf-8"), digest_size=8).digest()
+    )[0]
+    # Zero marks an empty slot
+    return h or 1
+
+
+class CounterStore(object):
+    """ Named counters in an open addressing hash table kept in an anonymous
+    shared memory mapping.
+
+    Only a 64-bit hash of each name is stored, so a slot costs 16 bytes no
+    matter how long the name is. Like `SharedCounter`, the store must be
+    created before workers are forked so they all share it. A single lock is
+    taken once per call, so bulk calls pay for it once for all of their keys.
+    """
+
+    def __init__(self, max_keys=262144):
+        # Keep the load factor at or under 0.5 so probe chains stay short
+        capacity = 1
+        while capacity < max_keys * 2:
+            capacity <<= 1
+        self.max_keys = max_keys
+        self.capacity = capacity
+        self._mask = capacity - 1
+        self._mm = mmap.mmap(-1, capacity * SLOT_SIZE + 8)
+        self._size_offset = capacity * SLOT_SIZE
+        self._lock = multiprocessing.Lock()
+
+    def __len__(self):
+        return struct.unpack_from("<q", self._mm, self._size_offset)[0]
+
+    def _find(self, key, insert):
+        """ Returns the offset of the slot for `key`, or None if it's absent
+        and `insert` is False.
+        """
+        mm = self._mm
+        index = key & self._mask
+        while True:
+            offset = index * SLOT_SIZE
+            slot_key = struct.unpack_from("<Q", mm, offset)[0]
+            if slot_key == key:
+                return offset
+            if slot_key == EMPTY:
+                if not insert:
+                    return None
+                size = len(self)
+                if size >= self.max_keys:
+                    raise StoreFullError(
+                        "Counter store is full, max_keys=%s" % self.max_keys
+                    )
+                struct.pack_into(SLOT_FORMAT, mm, offset, key, 0)
+                struct.pack_into("<q", mm, self._size_offset, size + 1)
+                return offset
+            index = (index + 1) & self._mask
+
+    def get(self, name):
+        offset = self._find(_key_hash(name), insert=False)
+        if offset is None:
+            return 0
+        return struct.unpack_from("<q", self._mm, offset + 8)[0]
+
+    def get_many(self, names):
+        return dict((name, self.get(name)) for name in names)
+
+    def increment(self, name, delta=1):
+        return self.increment_many([(name, delta)])[name]
+
+    def increment_many(self, increments):
+        """ Applies a list of (name, delta) increments and returns the new
+        value of every counter that was touched.
+
+        Either all of the increments are applied or, when their new keys
+        don't fit, none of them and StoreFullError is raised.
+        """
+        result = {}
+        mm = self._mm
+        keyed = [(name, _key_hash(name), delta) for name, delta in increments]
+        with self._lock:
+            new_keys = set(
+                key for _, key, _ in keyed if self._find(key, insert=False) is None
+            )
+            if len(self) + len(new_keys) > self.max_keys:
+                raise StoreFullError(
+                    "Counter store is full, max_keys=%s" % self.max_keys
+                )
+            for name, key, delta in keyed:
+                offset = self._find(key, insert=True) + 8
+                value = struct.unpack_from("<q", mm, offset)[0] + delta
+                struct.pack_into("<q", mm, offset, value)
+                result[name] = value
+        return result
@@ -0,0 +1,193 @@
+import json
+import math
+import mmap
+import time
+import random
+import socket
+import struct
+import multiprocessing
+
+
+HEADER_FORMAT = "<qq"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+LATENCY_FIXED = "fixed"
+LATENCY_UNIFORM = "uniform"
+LATENCY_LOGNORMAL = "lognormal"
+
+# No faults are injected until they are configured
+DEFAULT_CONFIG = {
+    "latency": None,
+    "errors": {},
+    "reset_percent": 0.0,
+}
+
+
+class InvalidFaultConfig(ValueError):
+    pass
+
+
+def _number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _percent(value, name):
+    if not _number(value) or not 0 <= value <= 100:
+        raise InvalidFaultConfig("%s must be a percentage between 0 and 100" % name)
+    return float(value)
+
+
+def validate_config(config):
+    """ Validates a fault config and fills in defaults, e.g.
+
+        {
+            "latency": {"type": "lognormal", "median_ms": 50, "sigma": 0.8, "percent": 100},
+            "errors": {"503": 5, "500": 1},
+            "reset_percent": 0.5
+        }
+
+    Latency types are "fixed" (ms), "uniform" (min_ms, max_ms) and
+    "lognormal" (median_ms, sigma). Percentages are of all requests, and a
+    request gets at most one error or reset, so those add up to 100 at most.
+    """
+    if not isinstance(config, dict):
+        raise InvalidFaultConfig("Fault config must be an object")
+    result = dict(DEFAULT_CONFIG)
+    result.update(config)
+
+    latency = result["latency"]
+    if latency is not None:
+        if not isinstance(latency, dict):
+            raise InvalidFaultConfig("latency must be an object or null")
+        latency = result["latency"] = dict(latency)
+        kind = latency.get("type")
+        required = {
+            LATENCY_FIXED: ("ms",),
+            LATENCY_UNIFORM: ("min_ms", "max_ms"),
+            LATENCY_LOGNORMAL: ("median_ms", "sigma"),
+        }.get(kind)
+        if required is None:
+            raise InvalidFaultConfig("Unknown latency type=%s" % kind)
+        for key in required:
+            if not _number(latency.get(key)) or latency[key] < 0:
+                raise InvalidFaultConfig("latency.%s must be a positive number" % key)
+        if kind == LATENCY_UNIFORM and latency["min_ms"] > latency["max_ms"]:
+            raise InvalidFaultConfig("latency.min_ms must not be above latency.max_ms")
+        latency["percent"] = _percent(latency.get("percent", 100.0), "latency.percent")
+
+    errors = result["errors"]
+    if not isinstance(errors, dict):
+        raise InvalidFaultConfig("errors must map status codes to percentages")
+    try:
+        codes = [int(code) for code in errors]
+    except (TypeError, ValueError):
+        raise InvalidFaultConfig("errors must map status codes to percentages")
+    if any(not 400 <= code < 600 for code in codes):
+        raise InvalidFaultConfig("errors must only contain 4xx and 5xx codes")
+    result["errors"] = dict(
+        (code, _percent(pct, "errors.%s" % code)) for code, pct in zip(codes, errors.values())
+    )
+
+    result["reset_percent"] = _percent(result["reset_percent"], "reset_percent")
+    if sum(result["errors"].values()) + result["reset_percent"] > 100:
+        raise InvalidFaultConfig("errors and reset_percent must add up to 100 at most")
+    return result
+
+
+class Fault(object):
+
+    def __init__(self, delay_s=0.0, status_code=None, reset=False):
+        self.delay_s = delay_s
+        self.status_code = status_code
+        self.reset = reset
+
+    def __bool__(self):
+        return bool(self.delay_s or self.status_code or self.reset)
+
+
+class FaultInjector(object):
+    """ Decides which faults to inject into a request.
+
+    The config lives in an anonymous shared memory mapping so that updating
+    it at runtime on one worker applies to all of them. Workers only re-parse
+    it when its version changes.
+
+    Injected delays are plain `time.sleep` calls, so they only free the
+    serving thread when running under the gevent worker class, where the
+    sleep yields to other requests instead of holding an OS thread.
+    """
+
+    def __init__(self, max_config_size=65536):
+        self._mm = mmap.mmap(-1, HEADER_SIZE + max_config_size)
+        self._max_config_size = max_config_size
+        self._lock = multiprocessing.Lock()
+        self._version = -1
+        self._config = DEFAULT_CONFIG
+        self.configure(DEFAULT_CONFIG)
+
+    def configure(self, config):
+        config = validate_config(config)
+        data = json.dumps(config).encode("utf-8")
+        if len(data) > self._max_config_size:
+            raise InvalidFaultConfig("Fault config is too large")
+        with self._lock:
+            version = struct.unpack_from(HEADER_FORMAT, self._mm, 0)[0]
+            self._mm[HEADER_SIZE:HEADER_SIZE + len(data)] = data
+            struct.pack_into(HEADER_FORMAT, self._mm, 0, version + 1, len(data))
+        return config
+
+    @property
+    def config(self):
+        version = struct.unpack_from(HEADER_FORMAT, self._mm, 0)[0]
+        if version != self._version:
+            with self._lock:
+                version, length = struct.unpack_from(HEADER_FORMAT, self._mm, 0)
+                data = self._mm[HEADER_SIZE:HEADER_SIZE + length]
+            self._config = validate_config(json.loads(data.decode("utf-8")))
+            self._version = version
+        return self._config
+
+    def decide(self):
+        config = self.config
+        fault = Fault()
+
+        roll = random.random() * 100
+        if roll < config["reset_percent"]:
+            fault.reset = True
+            return fault
+        roll -= config["reset_percent"]
+        for code, percent in config["errors"].items():
+            if roll < percent:
+                fault.status_code = code
+                break
+            roll -= percent
+
+        latency = config["latency"]
+        if latency and random.random() * 100 < latency["percent"]:
+            fault.delay_s = sample_latency_ms(latency) / 1000.0
+        return fault
+
+
+def sample_latency_ms(latency):
+    kind = latency["type"]
+    if kind == LATENCY_FIXED:
+        return latency["ms"]
+    if kind == LATENCY_UNIFORM:
+        return random.uniform(latency["min_ms"], latency["max_ms"])
+    return random.lognormvariate(math.log(max(latency["median_ms"], 1e-3)), latency["sigma"])
+
+
+def delay(seconds):
+    time.sleep(seconds)
+
+
+def reset_connection(environ):
+    """ Aborts the client connection with a TCP RST. Returns False when the
+    server doesn't expose the client socket.
+    """
+    sock = environ.get("gunicorn.socket") or environ.get("werkzeug.socket")
+    if sock is None:
+        return False
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+    sock.close()
+    return True
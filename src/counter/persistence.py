@@ -0,0 +1,180 @@
+import os
+import mmap
+import time
+import zlib
+import struct
+import logging
+import threading
+
+
+log = logging.getLogger(__name__)
+
+SNAPSHOT_FILENAME = "counter.snapshot"
+LOG_FILENAME = "counter.log"
+
+# Each record holds an absolute count and a checksum so that a torn write at
+# the end of the log can be detected and ignored on recovery.
+RECORD_FORMAT = "<qI4x"
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+
+
+def _pack(value):
+    raw = struct.pack("<q", value)
+    return struct.pack(RECORD_FORMAT, value, zlib.crc32(raw))
+
+
+def _unpack(record):
+    value, checksum = struct.unpack(RECORD_FORMAT, record)
+    if zlib.crc32(struct.pack("<q", value)) != checksum:
+        return None
+    return value
+
+
+def _read_snapshot(path):
+    try:
+        with open(path, "rb") as f:
+            return _unpack(f.read(RECORD_SIZE))
+    except (IOError, OSError, struct.error):
+        return None
+
+
+def _read_log_tail(path):
+    """ Returns the last valid record of the log, scanning backwards past any
+    torn or corrupt records.
+    """
+    try:
+        with open(path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            offset = (f.tell() // RECORD_SIZE) * RECORD_SIZE
+            while offset > 0:
+                offset -= RECORD_SIZE
+                f.seek(offset)
+                value = _unpack(f.read(RECORD_SIZE))
+                if value is not None:
+                    return value
+    except (IOError, OSError):
+        pass
+    return None
+
+
+class WriteBehindPersister(object):
+    """ Persists a counter in the background.
+
+    Increments never touch the disk. Every `flush_interval_s` the current
+    count is appended to a log if it changed, without an fsync. Once the log
+    holds `compact_after` records it is compacted into a snapshot. Since the
+    counter only grows, recovery is the max of the snapshot and the log tail.
+
+    In a crash, at most the increments made since the last flush are lost,
+    which is what `unflushed()` reports.
+    """
+
+    def __init__(self, state_dir, flush_interval_s=1.0, compact_after=4096):
+        self.state_dir = state_dir
+        self.flush_interval_s = flush_interval_s
+        self.compact_after = compact_after
+        self.snapshot_path = os.path.join(state_dir, SNAPSHOT_FILENAME)
+        self.log_path = os.path.join(state_dir, LOG_FILENAME)
+        # Kept in shared memory so forked workers can report it too
+        self._flushed = mmap.mmap(-1, 8)
+        self.recovery_ms = None
+        self._counter = None
+        self._owner_pid = None
+        self._log_file = None
+        self._log_records = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def flushed_value(self):
+        return struct.unpack_from("<q", self._flushed, 0)[0]
+
+    @flushed_value.setter
+    def flushed_value(self, value):
+        struct.pack_into("<q", self._flushed, 0, value)
+
+    def recover(self):
+        """ Rebuilds the last persisted count from the snapshot and log tail """
+        start = time.time()
+        if not os.path.isdir(self.state_dir):
+            os.makedirs(self.state_dir)
+        values = [
+            v for v in (_read_snapshot(self.snapshot_path),
+                        _read_log_tail(self.log_path))
+            if v is not None
+        ]
+        self.flushed_value = max(values) if values else 0
+        self.recovery_ms = (time.time() - start) * 1000
+        log.info("Recovered count=%s in %.2fms from %s",
+                 self.flushed_value, self.recovery_ms, self.state_dir)
+        return self.flushed_value
+
+    def start(self, counter):
+        """ Starts flushing `counter` in a background thread """
+        self._counter = counter
+        self._owner_pid = os.getpid()
+        self._log_file = open(self.log_path, "ab")
+        self._log_records = self._log_file.tell() // RECORD_SIZE
+        self._thread = threading.Thread(
+            target=self._run, name="counter-persister"
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stops the background thread and does a final flush """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(self.flush_interval_s * 2)
+        self.flush()
+        if self._log_file is not None:
+            self._log_file.close()
+            self._log_file = None
+
+    def flush(self):
+        # Only the process that started the persister writes, never the
+        # forked workers that inherited its file
+        if self._log_file is None or os.getpid() != self._owner_pid:
+            return
+        with self._lock:
+            value = self._counter.value
+            if value != self.flushed_value:
+                self._log_file.write(_pack(value))
+                self._log_file.flush()
+                self._log_records += 1
+                self.flushed_value = value
+            if self._log_records >= self.compact_after:
+                self._compact()
+
+    def unflushed(self):
+        """ Number of increments that would be lost if the process crashed now """
+        if self._counter is None:
+            return 0
+        return self._counter.value - self.flushed_value
+
+    def stats(self):
+        return {
+            "flushed_count": self.flushed_value,
+            "unflushed": self.unflushed(),
+            "flush_interval_s": self.flush_interval_s,
+            "recovery_ms": self.recovery_ms,
+        }
+
+    def _compact(self):
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(_pack(self.flushed_value))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        self._log_file.truncate(0)
+        self._log_file.seek(0)
+        self._log_records = 0
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval_s):
+            try:
+                self.flush()
+            except Exception:
+                log.exception("Error flushing counter to %s", self.state_dir)
@@ -0,0 +1,59 @@
+import os
+import multiprocessing
+
+from gunicorn.app.base import BaseApplication
+
+
+# Serving modes
+SERVER_MODE_DEV = "dev"
+SERVER_MODE_GUNICORN = "gunicorn"
+
+
+class GunicornApplication(BaseApplication):
+    """ Runs an already created WSGI app under gunicorn.
+
+    The app is created in the master before the workers are forked, which is
+    what lets state such as the shared counter live across all workers.
+    """
+
+    def __init__(self, app, options=None):
+        self.application = app
+        self.options = options or {}
+        super(GunicornApplication, self).__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            if key in self.cfg.settings and value is not None:
+                self.cfg.set(key.lower(), value)
+
+    def load(self):
+        return self.application
+
+
+def serve(app, port):
+    """ Serves the app according to the SERVER_MODE environment variable
+
+    SERVER_MODE=dev      - The single process Flask development server
+    SERVER_MODE=gunicorn - WORKERS processes with THREADS threads each, or
+                           WORKER_CONNECTIONS greenlets each when
+                           WORKER_CLASS=gevent
+    """
+    mode = os.environ.get("SERVER_MODE", SERVER_MODE_DEV)
+    if mode == SERVER_MODE_DEV:
+        app.run(host="0.0.0.0", port=port)
+        return
+
+    if mode != SERVER_MODE_GUNICORN:
+        raise ValueError("Unknown SERVER_MODE=%s" % mode)
+
+    options = {
+        "bind": "0.0.0.0:%s" % port,
+        "workers": int(os.environ.get("WORKERS", multiprocessing.cpu_count())),
+        "threads": int(os.environ.get("THREADS", 1)),
+        "worker_class": os.environ.get("WORKER_CLASS", "gthread"),
+        "worker_connections": int(os.environ.get("WORKER_CONNECTIONS", 1000)),
+        "backlog": int(os.environ.get("BACKLOG", 2048)),
+        "keepalive": int(os.environ.get("KEEPALIVE_S", 5)),
+        "accesslog": None,
+    }
+    GunicornApplication(app, options).run()
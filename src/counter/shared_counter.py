@@ -0,0 +1,32 @@
+import mmap
+import struct
+import multiprocessing
+
+
+# A single signed 64-bit slot
+SLOT_FORMAT = "q"
+SLOT_SIZE = struct.calcsize(SLOT_FORMAT)
+
+
+class SharedCounter(object):
+    """ A counter kept in an anonymous shared memory mapping.
+
+    The mapping and its lock must be created in the parent process before any
+    workers are forked, so that every worker inherits the same slot and they
+    all increment and return one consistent, monotonically increasing count.
+    """
+
+    def __init__(self, initial=0):
+        self._mm = mmap.mmap(-1, SLOT_SIZE)
+        self._lock = multiprocessing.Lock()
+        struct.pack_into(SLOT_FORMAT, self._mm, 0, initial)
+
+    def increment(self, delta=1):
+        with self._lock:
+            value = struct.unpack_from(SLOT_FORMAT, self._mm, 0)[0] + delta
+            struct.pack_into(SLOT_FORMAT, self._mm, 0, value)
+        return value
+
+    @property
+    def value(self):
+        return struct.unpack_from(SLOT_FORMAT, self._mm, 0)[0]
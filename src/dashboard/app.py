@@ -2,72 +2,74 @@ import os
 import sys
 import json
 import socket
-import logging
-from logging.config import dictConfig
 
 import requests
 from flask import Flask, make_response, request
+from flask.logging import default_handler
 from aws_xray_sdk.core import xray_recorder, patch_all
 from aws_xray_sdk.ext.flask.middleware import XRayMiddleware
 from werkzeug.exceptions import HTTPException
 
+from common import health, metrics, profiling
+from common.context import current_context, init_flask
+from common.logs import setup_logging, log_level_from_env
+from common.tracing import configure_tracing
+from cache import CoalescingCache
+from circuit import CircuitOpenError
+from fanout import FanOut, ServiceCatalog
+from upstream import UpstreamClient
 
-log_levels = {
-    'DEBUG': logging.DEBUG,
-    'INFO': logging.INFO,
-    'WARNING': logging.WARNING,
-    'ERROR': logging.ERROR,
-    'CRITICAL': logging.CRITICAL
-}
 
 COUNTER_ENDPOINT = os.environ["COUNTER_ENDPOINT"]
+COUNT_CACHE_TTL_S = float(os.environ.get("COUNT_CACHE_TTL_S", 1.0))
+COUNTER_SERVICE_NAME = os.environ.get("COUNTER_SERVICE_NAME", "counter")
+FANOUT_DEADLINE_S = float(os.environ.get("FANOUT_DEADLINE_S", 1.0))
 
+# Served by both serving modes, see async_app.py
+LIVENESS_BODY = json.dumps({"status": "DASHBOARD_HEALTHY"}).encode("utf-8")
 
-def setup_logging(log_level):
-    logging_config = dict(
-        version = 1,
-        formatters = {
-            'simple': {
-                    'format': '%(asctime)s %(levelname)-8s %(message)s'
-                }
-            },
-        handlers = {
-            'console': {
-                    'class': 'logging.StreamHandler',
-                    'formatter': 'simple',
-                    'level': log_level,
-                    'stream': 'ext://sys.stdout'
-                }
-            },
-        root = {
-            'handlers': ['console'],
-            'level': log_level,
-            },
-    )
-    dictConfig(logging_config)
 
+def create_app():
+    app = Flask(__name__)
+    init_flask(app)
+    metrics.init_flask(app)
 
-def get_trace_id(x_amzn_trace_id):
-    if x_amzn_trace_id and "Root=" in x_amzn_trace_id:
-        trace_id = x_amzn_trace_id.split("Root=")[1].split(";")[0]
-        return trace_id
+    # Shared keep-alive connection pool to the counter upstream
+    counter = UpstreamClient.from_env(COUNTER_ENDPOINT)
 
+    def load_count():
+        resp = counter.get_hedged("/count")
+        resp.raise_for_status()
+        return json.loads(resp.text)
 
-def get_request_id():
-    return request.headers.get("X-Request-Id")
+    # Readiness probes read whether counter was reachable on the last check
+    def check_counter():
+        counter.get("/health", timeout=(0.5, 1.0)).raise_for_status()
 
+    health.init_flask(app, LIVENESS_BODY, health.DeepHealthCheck.from_env({"counter": check_counter}))
 
-def create_app():
-    app = Flask(__name__)
+    # Read-only count, shared by all concurrent requests in a refresh window
+    count_cache = CoalescingCache(load_count, ttl_s=COUNT_CACHE_TTL_S)
+
+    # All healthy counter instances, queried concurrently for /counts
+    counter_catalog = ServiceCatalog(
+        COUNTER_SERVICE_NAME,
+        ttl_s=float(os.environ.get("CATALOG_CACHE_TTL_S", 5.0))
+    )
+    fanout = FanOut(max_workers=int(os.environ.get("FANOUT_MAX_WORKERS", 32)))
 
     # Configure xray tracing
-    xray_recorder.configure(service='dashboard')
+    configure_tracing(xray_recorder, 'dashboard')
     XRayMiddleware(app, xray_recorder)
     patch_all()
 
     # Setup logging
-    setup_logging(log_levels.get(os.environ.get("LOG_LEVEL", "INFO")))
-    log = logging.getLogger(__name__)
+    log = setup_logging(log_level_from_env(), __name__)
+    app.logger.removeHandler(default_handler)
+
+    # Profiling and allocation tracking on demand, see common/profiling.py
+    if os.environ.get("DEBUG_ENDPOINTS") == "true":
+        profiling.init_flask(app, token=os.environ.get("DEBUG_TOKEN"))
 
     @app.errorhandler(HTTPException)
     def handle_error(error):
@@ -82,50 +84,61 @@ def create_app():
             json.dumps({
                 "message": "Error occured",
                 "code": error.code,
-                "trace_id": get_trace_id(request.headers.get("X-Amzn-Trace-Id")),
-                "request_id": get_request_id()
+                "trace_id": current_context().trace_id,
+                "request_id": current_context().request_id
             }), 500
         )
 
     @app.route("/")
     def hello():
         try:
-            resp = requests.get(
-                "{}/".format(COUNTER_ENDPOINT),
-                headers={"X-Request-Id": get_request_id()}
-            )
-            log.info(
-                "Received request, trace_id={}, req_id={}".format(
-                    get_trace_id(request.headers.get("X-Amzn-Trace-Id")),
-                    get_request_id()
-                )
-            )
+            resp = counter.get("/")
             if resp.status_code == 200:
+                log.info("Received request", extra={
+                    "route": "/",
+                    "status_code": 200
+                })
                 resp = json.loads(resp.text)
                 resp = json.dumps({
                     "message": "Counter is reachable",
                     "count": resp["count"],
                     "counter_service_id": resp["counter_service_id"],
                     "dashboard_service_id": socket.gethostname(),
-                    "trace_id": get_trace_id(request.headers.get("X-Amzn-Trace-Id")),
-                    "request_id": get_request_id()
+                    "trace_id": current_context().trace_id,
+                    "request_id": current_context().request_id
                 })
             else:
-                log.info("Error calling {} service! code={}, service={}".format(resp.text, resp.status_code, COUNTER_ENDPOINT))
+                log.info("Error calling %s service! code=%s, service=%s", resp.text, resp.status_code, COUNTER_ENDPOINT, extra={
+                    "route": "/",
+                    "status_code": 500
+                })
                 resp = make_response(json.dumps({
                     "message": "Error calling %s service" % COUNTER_ENDPOINT,
                     "code": resp.status_code,
                     "error": resp.text,
-                    "trace_id": get_trace_id(request.headers.get("X-Amzn-Trace-Id")),
-                    "request_id": get_request_id()
+                    "trace_id": current_context().trace_id,
+                    "request_id": current_context().request_id
 
                 }), 500)
+        except CircuitOpenError as ex:
+            log.info("Not calling counter at %s, %s", COUNTER_ENDPOINT, ex, extra={
+                "route": "/",
+                "status_code": 503
+            })
+            resp = make_response(json.dumps({
+                "message": str(ex),
+                "trace_id": current_context().trace_id,
+                "request_id": current_context().request_id
+            }), 503)
         except requests.exceptions.RequestException as ex:
-            log.info("Error connecting to counter at %s, %s" % (COUNTER_ENDPOINT, str(ex)))
+            log.info("Error connecting to counter at %s, %s", COUNTER_ENDPOINT, ex, extra={
+                "route": "/",
+                "status_code": 500
+            })
             resp = make_response(json.dumps({
                 "message": str(ex),
-                "trace_id": get_trace_id(request.headers.get("X-Amzn-Trace-Id")),
-                "request_id": get_request_id()
+                "trace_id": current_context().trace_id,
+                "request_id": current_context().request_id
             }), 500)
         return resp
 
@@ -133,32 +146,97 @@ def create_app():
     @app.route("/fail")
     def fail():
         code = request.args.get('code')
-        log.info(
-            "/fail?code={} called! Relaying to counter service, trace_id={}, req_id={}".format(
-                code,
-                get_trace_id(request.headers.get("X-Amzn-Trace-Id")),
-                get_request_id()
-        ))
-        resp = requests.get(
-            "{}/fail?code={}".format(COUNTER_ENDPOINT, code),
-            headers={"X-Request-Id": get_request_id()}
-        )
+        log.info("/fail?code=%s called! Relaying to counter service", code, extra={
+            "route": "/fail"
+        })
+        try:
+            # The failures are asked for, so they mustn't open the circuit
+            resp = counter.get(
+                "/fail",
+                params={"code": code},
+                record=False
+            )
+            status_code = resp.status_code
+        except CircuitOpenError:
+            status_code = 503
+        except requests.exceptions.Timeout:
+            status_code = 504
+        except requests.exceptions.RequestException:
+            status_code = 502
         resp = make_response(json.dumps({
             "message": "Received code={} on {}/fail?code={}".format(
-                resp.status_code, COUNTER_ENDPOINT, code
+                status_code, COUNTER_ENDPOINT, code
                 )
-            }), int(resp.status_code))
+            }), int(status_code))
         return resp
 
 
-    @app.route("/health")
-    def health():
-        return json.dumps({"status": "DASHBOARD_HEALTHY"})
-
+    @app.route("/count")
+    def count():
+        try:
+            resp = count_cache.get()
+        except CircuitOpenError as ex:
+            return make_response(json.dumps({
+                "message": str(ex),
+                "trace_id": current_context().trace_id,
+                "request_id": current_context().request_id
+            }), 503)
+        except requests.exceptions.RequestException as ex:
+            log.info("Error reading count from counter at %s, %s", COUNTER_ENDPOINT, ex)
+            return make_response(json.dumps({
+                "message": str(ex),
+                "trace_id": current_context().trace_id,
+                "request_id": current_context().request_id
+            }), 500)
+        return json.dumps({
+            "count": resp["count"],
+            "counter_service_id": resp["counter_service_id"],
+            "dashboard_service_id": socket.gethostname()
+        })
+
+    @app.route("/counts")
+    def counts():
+        '''Returns the count of every healthy counter instance and their sum.
+        Instances that don't answer within the deadline are listed in errors.
+        '''
+        try:
+            instances = counter_catalog.instances()
+        except requests.exceptions.RequestException as ex:
+            log.info("Error looking up %s instances in consul, %s", COUNTER_SERVICE_NAME, ex)
+            return make_response(json.dumps({
+                "message": str(ex),
+                "trace_id": current_context().trace_id,
+                "request_id": current_context().request_id
+            }), 500)
+        results, errors = fanout.get(
+            instances, "/count",
+            deadline_s=current_context().timeout_s(FANOUT_DEADLINE_S)
+        )
+        return json.dumps({
+            "total": sum(r["count"] for r in results.values()),
+            "instances": dict((i, r["count"]) for i, r in results.items()),
+            "errors": errors,
+            "partial": bool(errors),
+            "dashboard_service_id": socket.gethostname()
+        })
+
+    @app.route("/cache/stats")
+    def cache_stats():
+        stats = count_cache.stats.as_dict()
+        stats["ttl_s"] = count_cache.ttl_s
+        return json.dumps(stats)
+
+    @app.route("/upstream/stats")
+    def upstream_stats():
+        return json.dumps(counter.stats())
 
     return app
 
 
 if __name__ == "__main__":
-    app = create_app()
-    app.run(host="0.0.0.0", port=os.environ.get('PORT', 80))
+    if os.environ.get("SERVER_MODE") == "async":
+        import async_app
+        async_app.main(os.environ.get('PORT', 80))
+    else:
+        app = create_app()
+        app.run(host="0.0.0.0", port=os.environ.get('PORT', 80))
@@ -0,0 +1,293 @@
+import os
+import json
+import socket
+import asyncio
+import logging
+import contextlib
+
+import aiohttp
+import requests
+from aiohttp import web
+from aws_xray_sdk.core import xray_recorder, patch_all
+from aws_xray_sdk.core.async_context import AsyncContext
+from aws_xray_sdk.ext.aiohttp.middleware import middleware as xray_middleware
+from aws_xray_sdk.ext.aiohttp.client import aws_xray_trace_config
+
+from app import COUNTER_ENDPOINT, COUNT_CACHE_TTL_S, COUNTER_SERVICE_NAME, FANOUT_DEADLINE_S, LIVENESS_BODY
+from common import health, metrics
+from common.context import current_context, aiohttp_middleware
+from common.logs import setup_logging, log_level_from_env
+from common.tracing import configure_tracing
+from cache import AsyncCoalescingCache
+from circuit import CircuitBreaker, CircuitOpenError
+from fanout import AsyncFanOut, ServiceCatalog
+from hedging import HedgePolicy, hedged_call_async
+
+
+log = logging.getLogger(__name__)
+
+
+async def _on_startup(app):
+    connector = aiohttp.TCPConnector(
+        limit=int(os.environ.get("UPSTREAM_POOL_SIZE", 10)),
+        keepalive_timeout=float(os.environ.get("UPSTREAM_IDLE_TIMEOUT_S", 60.0))
+    )
+    app["counter_timeout"] = aiohttp.ClientTimeout(
+        sock_connect=float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT_S", 0.5)),
+        sock_read=float(os.environ.get("UPSTREAM_READ_TIMEOUT_S", 5.0))
+    )
+    app["counter_breaker"] = CircuitBreaker.from_env(COUNTER_ENDPOINT)
+    app["counter"] = aiohttp.ClientSession(
+        connector=connector,
+        timeout=app["counter_timeout"],
+        trace_configs=[
+            aws_xray_trace_config(),
+            metrics.aiohttp_trace_config(COUNTER_ENDPOINT)
+        ]
+    )
+
+    # Count reads are idempotent, so slow ones can be hedged
+    app["counter_hedge_policy"] = None
+    if os.environ.get("HEDGING") == "true":
+        app["counter_hedge_policy"] = HedgePolicy.from_env()
+
+    async def read_count():
+        async with counter_get(app, "/count") as resp:
+            resp.raise_for_status()
+            return json.loads(await resp.text())
+
+    async def load_count():
+        if app["counter_hedge_policy"] is None:
+            return await read_count()
+        return await hedged_call_async(app["counter_hedge_policy"], read_count)
+
+    app["count_cache"] = AsyncCoalescingCache(load_count, ttl_s=COUNT_CACHE_TTL_S)
+
+    # All healthy counter instances, queried concurrently for /counts. The
+    # catalog is cached, so looking it up in the executor is rare
+    app["counter_catalog"] = ServiceCatalog(
+        COUNTER_SERVICE_NAME,
+        ttl_s=float(os.environ.get("CATALOG_CACHE_TTL_S", 5.0))
+    )
+    app["fanout"] = AsyncFanOut(aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=int(os.environ.get("FANOUT_MAX_WORKERS", 32))),
+        trace_configs=[aws_xray_trace_config()]
+    ))
+
+
+async def _on_cleanup(app):
+    await app["counter"].close()
+    await app["fanout"].session.close()
+
+
+@contextlib.asynccontextmanager
+async def counter_get(app, path, params=None, record=True):
+    """ Calls the counter, continuing the trace of the current request.
+
+    The call is given what's left until the deadline of the request, as a
+    total timeout, and fails fast while the circuit to the counter is open.
+    Calls made with `record=False` are kept out of the circuit breaker.
+    """
+    ctx = current_context()
+    remaining_s = ctx.remaining_s()
+    if remaining_s is not None and remaining_s <= 0:
+        raise asyncio.TimeoutError("Deadline exceeded before calling %s%s" % (COUNTER_ENDPOINT, path))
+    breaker = app["counter_breaker"] if record else None
+    probe = breaker is not None and breaker.allow()
+    timeout = app["counter_timeout"]
+    if remaining_s is not None:
+        timeout = aiohttp.ClientTimeout(
+            total=ctx.timeout_s(remaining_s),
+            sock_connect=ctx.timeout_s(timeout.sock_connect),
+            sock_read=ctx.timeout_s(timeout.sock_read)
+        )
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    try:
+        async with app["counter"].get(
+                "{}{}".format(COUNTER_ENDPOINT, path),
+                params=params,
+                headers=ctx.outbound_headers(),
+                timeout=timeout) as resp:
+            yield resp
+    except asyncio.CancelledError:
+        # E.g. the hedge that lost the race, which says nothing about the
+        # counter. A cancelled probe still has to let the next call probe
+        if probe:
+            breaker.release()
+        raise
+    except BaseException:
+        if breaker is not None:
+            breaker.record(False, loop.time() - start)
+        raise
+    if breaker is not None:
+        breaker.record(resp.status < 500, loop.time() - start)
+
+
+async def hello(request):
+    try:
+        async with counter_get(request.app, "/") as resp:
+            text = await resp.text()
+            status_code = resp.status
+        if status_code == 200:
+            log.info("Received request", extra={
+                "route": "/",
+                "status_code": 200
+            })
+            body = json.loads(text)
+            return web.Response(text=json.dumps({
+                "message": "Counter is reachable",
+                "count": body["count"],
+                "counter_service_id": body["counter_service_id"],
+                "dashboard_service_id": socket.gethostname(),
+                "trace_id": current_context().trace_id,
+                "request_id": current_context().request_id
+            }))
+        log.info("Error calling %s service! code=%s, service=%s", text, status_code, COUNTER_ENDPOINT, extra={
+            "route": "/",
+            "status_code": 500
+        })
+        return web.Response(status=500, text=json.dumps({
+            "message": "Error calling %s service" % COUNTER_ENDPOINT,
+            "code": status_code,
+            "error": text,
+            "trace_id": current_context().trace_id,
+            "request_id": current_context().request_id
+        }))
+    except CircuitOpenError as ex:
+        log.info("Not calling counter at %s, %s", COUNTER_ENDPOINT, ex)
+        return web.Response(status=503, text=json.dumps({
+            "message": str(ex),
+            "trace_id": current_context().trace_id,
+            "request_id": current_context().request_id
+        }))
+    except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+        log.info("Error connecting to counter at %s, %s", COUNTER_ENDPOINT, repr(ex))
+        return web.Response(status=500, text=json.dumps({
+            "message": repr(ex),
+            "trace_id": current_context().trace_id,
+            "request_id": current_context().request_id
+        }))
+
+
+async def fail(request):
+    code = request.query.get("code")
+    log.info("/fail?code=%s called! Relaying to counter service", code, extra={
+        "route": "/fail"
+    })
+    try:
+        # The failures are asked for, so they mustn't open the circuit
+        async with counter_get(request.app, "/fail", params={"code": code or ""}, record=False) as resp:
+            await resp.read()
+            status_code = resp.status
+    except CircuitOpenError:
+        status_code = 503
+    except asyncio.TimeoutError:
+        status_code = 504
+    except aiohttp.ClientError:
+        status_code = 502
+    return web.Response(status=status_code, text=json.dumps({
+        "message": "Received code={} on {}/fail?code={}".format(
+            status_code, COUNTER_ENDPOINT, code
+        )
+    }))
+
+
+async def count(request):
+    try:
+        resp = await request.app["count_cache"].get()
+    except CircuitOpenError as ex:
+        return web.Response(status=503, text=json.dumps({
+            "message": str(ex),
+            "trace_id": current_context().trace_id,
+            "request_id": current_context().request_id
+        }))
+    except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+        log.info("Error reading count from counter at %s, %s", COUNTER_ENDPOINT, repr(ex))
+        return web.Response(status=500, text=json.dumps({
+            "message": repr(ex),
+            "trace_id": current_context().trace_id,
+            "request_id": current_context().request_id
+        }))
+    return web.Response(text=json.dumps({
+        "count": resp["count"],
+        "counter_service_id": resp["counter_service_id"],
+        "dashboard_service_id": socket.gethostname()
+    }))
+
+
+async def counts(request):
+    """ Returns the count of every healthy counter instance and their sum.
+    Instances that don't answer within the deadline are listed in errors.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        instances = await loop.run_in_executor(None, request.app["counter_catalog"].instances)
+    except requests.exceptions.RequestException as ex:
+        log.info("Error looking up %s instances in consul, %s", COUNTER_SERVICE_NAME, ex)
+        return web.Response(status=500, text=json.dumps({
+            "message": str(ex),
+            "trace_id": current_context().trace_id,
+            "request_id": current_context().request_id
+        }))
+    results, errors = await request.app["fanout"].get(
+        instances, "/count",
+        deadline_s=current_context().timeout_s(FANOUT_DEADLINE_S)
+    )
+    return web.Response(text=json.dumps({
+        "total": sum(r["count"] for r in results.values()),
+        "instances": dict((i, r["count"]) for i, r in results.items()),
+        "errors": errors,
+        "partial": bool(errors),
+        "dashboard_service_id": socket.gethostname()
+    }))
+
+
+async def cache_stats(request):
+    cache = request.app["count_cache"]
+    stats = cache.stats.as_dict()
+    stats["ttl_s"] = cache.ttl_s
+    return web.Response(text=json.dumps(stats))
+
+
+async def upstream_stats(request):
+    policy = request.app["counter_hedge_policy"]
+    return web.Response(text=json.dumps({
+        "circuit": request.app["counter_breaker"].as_dict(),
+        "hedging": None if policy is None else policy.as_dict(),
+    }))
+
+
+def check_counter():
+    """ Runs in the deep health check's thread, off the event loop """
+    requests.get("{}/health".format(COUNTER_ENDPOINT), timeout=(0.5, 1.0)).raise_for_status()
+
+
+def create_app():
+    """ The dashboard served by an asyncio event loop, so a slow counter
+    call waits on a socket instead of pinning an OS thread.
+    """
+    configure_tracing(xray_recorder, 'dashboard', context=AsyncContext())
+    patch_all()
+
+    setup_logging(log_level_from_env())
+
+    app = web.Application(middlewares=[aiohttp_middleware(), xray_middleware])
+    app.middlewares.insert(1, metrics.aiohttp_middleware(app))
+    # First, so health probes skip everything else
+    app.middlewares.insert(0, health.aiohttp_middleware(
+        LIVENESS_BODY, health.DeepHealthCheck.from_env({"counter": check_counter})
+    ))
+    app.on_startup.append(_on_startup)
+    app.on_cleanup.append(_on_cleanup)
+    app.router.add_get("/", hello)
+    app.router.add_get("/fail", fail)
+    app.router.add_get("/count", count)
+    app.router.add_get("/counts", counts)
+    app.router.add_get("/cache/stats", cache_stats)
+    app.router.add_get("/upstream/stats", upstream_stats)
+    return app
+
+
+def main(port):
+    web.run_app(create_app(), host="0.0.0.0", port=int(port), access_log=None)
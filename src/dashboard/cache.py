@@ -0,0 +1,140 @@
+import time
+import asyncio
+import threading
+
+
+class _CacheStats(object):
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.errors = 0
+
+    def as_dict(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "errors": self.errors,
+        }
+
+
+class CoalescingCache(object):
+    """ Caches the result of `loader` for `ttl_s` seconds.
+
+    When the value is stale, the first caller becomes the leader and calls
+    `loader` while every concurrent caller waits for the leader's result, so
+    at most one upstream call goes out per refresh window (single-flight).
+    Errors are not cached, they are raised to the leader and its followers.
+    """
+
+    def __init__(self, loader, ttl_s=1.0):
+        self.loader = loader
+        self.ttl_s = ttl_s
+        self.stats = _CacheStats()
+        self._lock = threading.Lock()
+        self._value = None
+        self._expires_at = 0
+        self._inflight = None
+
+    def get(self):
+        with self._lock:
+            if time.time() < self._expires_at:
+                self.stats.hits += 1
+                return self._value
+            inflight = self._inflight
+            leader = inflight is None
+            if leader:
+                self.stats.misses += 1
+                inflight = self._inflight = _Flight()
+            else:
+                self.stats.coalesced += 1
+        if not leader:
+            return inflight.wait()
+
+        try:
+            value = self.loader()
+        except Exception as ex:
+            with self._lock:
+                self.stats.errors += 1
+                self._inflight = None
+            inflight.set_error(ex)
+            raise
+        with self._lock:
+            self._value = value
+            self._expires_at = time.time() + self.ttl_s
+            self._inflight = None
+        inflight.set_result(value)
+        return value
+
+
+class _Flight(object):
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._value = None
+        self._error = None
+
+    def set_result(self, value):
+        self._value = value
+        self._done.set()
+
+    def set_error(self, error):
+        self._error = error
+        self._done.set()
+
+    def wait(self):
+        self._done.wait()
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+
+class AsyncCoalescingCache(object):
+    """ The asyncio counterpart of `CoalescingCache`. The load runs in a
+    task of its own that the leader and its followers await, so a caller
+    that's cancelled, e.g. by a client disconnect, leaves it running for
+    the others.
+    """
+
+    def __init__(self, loader, ttl_s=1.0):
+        self.loader = loader
+        self.ttl_s = ttl_s
+        self.stats = _CacheStats()
+        self._value = None
+        self._expires_at = 0
+        self._inflight = None
+
+    async def get(self):
+        if time.time() < self._expires_at:
+            self.stats.hits += 1
+            return self._value
+        inflight = self._inflight
+        if inflight is not None:
+            self.stats.coalesced += 1
+        else:
+            self.stats.misses += 1
+            inflight = self._inflight = asyncio.ensure_future(self._load())
+            inflight.add_done_callback(_retrieve_exception)
+        return await asyncio.shield(inflight)
+
+    async def _load(self):
+        try:
+            value = await self.loader()
+        except Exception:
+            self.stats.errors += 1
+            raise
+        finally:
+            self._inflight = None
+        self._value = value
+        self._expires_at = time.time() + self.ttl_s
+        return value
+
+
+def _retrieve_exception(task):
+    """ Marks the exception of a load as retrieved, for when every caller
+    was cancelled before it failed
+    """
+    if not task.cancelled():
+        task.exception()
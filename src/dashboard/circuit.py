@@ -0,0 +1,131 @@
+import os
+import time
+import threading
+
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """ Raised instead of calling an upstream whose circuit is open """
+
+
+class CircuitBreaker(object):
+    """ Fails calls to an upstream fast once too many of them fail or are slow.
+
+    Outcomes are counted in one second buckets over the last `window_s`.
+    Once there have been at least `min_calls`, the circuit opens when the
+    share of failed calls reaches `failure_rate` or the share of calls slower
+    than `slow_call_s` reaches `slow_rate`. After `open_s` one probe call is
+    let through: the circuit closes if it succeeds and opens again if not.
+    """
+
+    def __init__(self,
+                 name,
+                 failure_rate=0.5,
+                 slow_call_s=1.0,
+                 slow_rate=0.8,
+                 min_calls=20,
+                 window_s=10,
+                 open_s=5.0):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.slow_call_s = slow_call_s
+        self.slow_rate = slow_rate
+        self.min_calls = min_calls
+        self.window_s = int(window_s)
+        self.open_s = open_s
+        self.state = STATE_CLOSED
+        self.rejected = 0
+        self.opened = 0
+        self._opened_at = None
+        self._probing = False
+        # [second, calls, failures, slow] per bucket
+        self._buckets = [[0, 0, 0, 0] for _ in range(self.window_s)]
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, name):
+        return cls(
+            name,
+            failure_rate=float(os.environ.get("CIRCUIT_FAILURE_RATE", 0.5)),
+            slow_call_s=float(os.environ.get("CIRCUIT_SLOW_CALL_S", 1.0)),
+            slow_rate=float(os.environ.get("CIRCUIT_SLOW_RATE", 0.8)),
+            min_calls=int(os.environ.get("CIRCUIT_MIN_CALLS", 20)),
+            window_s=int(os.environ.get("CIRCUIT_WINDOW_S", 10)),
+            open_s=float(os.environ.get("CIRCUIT_OPEN_S", 5.0))
+        )
+
+    def allow(self):
+        """ Raises CircuitOpenError unless a call may be made now. Returns
+        whether the call is the probe of a half-open circuit.
+        """
+        with self._lock:
+            if self.state == STATE_CLOSED:
+                return False
+            if self.state == STATE_OPEN and time.time() - self._opened_at >= self.open_s:
+                self.state = STATE_HALF_OPEN
+                self._probing = False
+            if self.state == STATE_HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self.rejected += 1
+        raise CircuitOpenError("Circuit to %s is %s" % (self.name, self.state))
+
+    def release(self):
+        """ Lets another call probe the circuit, when the probe was given up
+        without an outcome, e.g. cancelled. Otherwise only `record` would.
+        """
+        with self._lock:
+            if self.state == STATE_HALF_OPEN:
+                self._probing = False
+
+    def record(self, success, duration_s):
+        now = time.time()
+        with self._lock:
+            if self.state == STATE_HALF_OPEN:
+                self._probing = False
+                if success and duration_s < self.slow_call_s:
+                    self._close()
+                else:
+                    self._open(now)
+                return
+            second = int(now)
+            bucket = self._buckets[second % self.window_s]
+            if bucket[0] != second:
+                bucket[:] = [second, 0, 0, 0]
+            bucket[1] += 1
+            bucket[2] += 0 if success else 1
+            bucket[3] += 1 if duration_s >= self.slow_call_s else 0
+            if self.state == STATE_CLOSED and self._tripped(second):
+                self._open(now)
+
+    def _tripped(self, second):
+        calls = failures = slow = 0
+        for bucket_second, bucket_calls, bucket_failures, bucket_slow in self._buckets:
+            if second - bucket_second < self.window_s:
+                calls += bucket_calls
+                failures += bucket_failures
+                slow += bucket_slow
+        if calls < self.min_calls:
+            return False
+        return failures >= calls * self.failure_rate or slow >= calls * self.slow_rate
+
+    def _open(self, now):
+        self.state = STATE_OPEN
+        self._opened_at = now
+        self.opened += 1
+
+    def _close(self):
+        self.state = STATE_CLOSED
+        self._buckets = [[0, 0, 0, 0] for _ in range(self.window_s)]
+
+    def as_dict(self):
+        return {
+            "name": self.name,
+            "state": self.state,
+            "opened": self.opened,
+            "rejected": self.rejected,
+        }
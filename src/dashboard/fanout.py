@@ -0,0 +1,165 @@
+import os
+import json
+import time
+import asyncio
+from concurrent import futures
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+from cache import CoalescingCache
+from common.context import current_context
+
+
+CONSUL_HTTP_ADDR = os.environ.get("CONSUL_HTTP_ADDR", "127.0.0.1:8500")
+
+
+def _consul_url(consul_addr):
+    if not consul_addr.startswith("http"):
+        consul_addr = "http://%s" % consul_addr
+    return consul_addr.rstrip("/")
+
+
+class ServiceCatalog(object):
+    """ Looks up the healthy instances of a service in the Consul catalog.
+
+    Instances are selected by the `ServiceName:<name>` tag that the service
+    configurator registers, so the sidecar proxies are left out. Results are
+    cached for `ttl_s` and concurrent lookups are coalesced.
+    """
+
+    def __init__(self, service_name, consul_addr=CONSUL_HTTP_ADDR,
+                 ttl_s=5.0, timeout_s=1.0):
+        self.service_name = service_name
+        self.consul_url = _consul_url(consul_addr)
+        self.timeout_s = timeout_s
+        self._session = requests.Session()
+        self._cache = CoalescingCache(self._load, ttl_s=ttl_s)
+
+    def _load(self):
+        resp = self._session.get(
+            "{}/v1/health/service/{}".format(self.consul_url, self.service_name),
+            params={"passing": "true", "tag": "ServiceName:%s" % self.service_name},
+            timeout=self.timeout_s
+        )
+        resp.raise_for_status()
+        return [
+            {
+                "id": entry["Service"]["ID"],
+                "address": entry["Service"]["Address"] or entry["Node"]["Address"],
+                "port": entry["Service"]["Port"],
+            }
+            for entry in json.loads(resp.text)
+        ]
+
+    def instances(self):
+        return self._cache.get()
+
+    @property
+    def stats(self):
+        return self._cache.stats
+
+
+class FanOut(object):
+    """ Calls the same path on every instance concurrently.
+
+    All calls share one deadline, so the total latency tracks the slowest
+    instance that answers in time instead of the sum of all of them.
+    Instances that don't answer before the deadline are reported as timed
+    out, along with the partial results of those that did.
+
+    NOTE: Instances are called on their registered address and port, which
+    bypasses the sidecar proxies, so the calls are neither encrypted with
+    mTLS nor checked against intentions. An upstream listener only reaches
+    one instance picked by Envoy, so it can't be used to call them all.
+    """
+
+    def __init__(self, max_workers=32, connect_timeout_s=0.5):
+        self.connect_timeout_s = connect_timeout_s
+        self._executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self._session.mount("http://", adapter)
+
+    def _call(self, instance, path, headers, deadline_s):
+        resp = self._session.get(
+            "http://{}:{}{}".format(instance["address"], instance["port"], path),
+            headers=headers,
+            timeout=(min(self.connect_timeout_s, deadline_s), deadline_s)
+        )
+        resp.raise_for_status()
+        return json.loads(resp.text)
+
+    def get(self, instances, path, headers=None, deadline_s=1.0):
+        """ Returns (results, errors), both keyed by instance id """
+        start = time.time()
+        # The context doesn't follow the calls into the executor's threads
+        outbound = current_context().outbound_headers()
+        outbound.update(headers or {})
+        headers = outbound
+        pending = dict(
+            (self._executor.submit(self._call, i, path, headers, deadline_s), i)
+            for i in instances
+        )
+        done, not_done = futures.wait(pending, timeout=deadline_s)
+        results, errors = {}, {}
+        for future in done:
+            instance_id = pending[future]["id"]
+            try:
+                results[instance_id] = future.result()
+            except Exception as ex:
+                errors[instance_id] = str(ex)
+        for future in not_done:
+            future.cancel()
+            errors[pending[future]["id"]] = "Timed out after %.3fs" % (time.time() - start)
+        return results, errors
+
+
+class AsyncFanOut(object):
+    """ The asyncio counterpart of FanOut, calling every instance with the
+    aiohttp `session` instead of from a thread pool. Calls still running at
+    the deadline are cancelled.
+    """
+
+    def __init__(self, session, connect_timeout_s=0.5):
+        self.session = session
+        self.connect_timeout_s = connect_timeout_s
+
+    async def _call(self, instance, path, headers, deadline_s):
+        async with self.session.get(
+                "http://{}:{}{}".format(instance["address"], instance["port"], path),
+                headers=headers,
+                timeout=aiohttp.ClientTimeout(
+                    total=deadline_s,
+                    sock_connect=min(self.connect_timeout_s, deadline_s)
+                )) as resp:
+            resp.raise_for_status()
+            return json.loads(await resp.text())
+
+    async def get(self, instances, path, headers=None, deadline_s=1.0):
+        """ Returns (results, errors), both keyed by instance id """
+        start = time.time()
+        outbound = current_context().outbound_headers()
+        outbound.update(headers or {})
+        pending = dict(
+            (asyncio.ensure_future(self._call(i, path, outbound, deadline_s)), i)
+            for i in instances
+        )
+        results, errors = {}, {}
+        if not pending:
+            return results, errors
+        done, not_done = await asyncio.wait(pending, timeout=deadline_s)
+        for task in done:
+            instance_id = pending[task]["id"]
+            try:
+                results[instance_id] = task.result()
+            except Exception as ex:
+                errors[instance_id] = str(ex) or repr(ex)
+        for task in not_done:
+            task.cancel()
+            errors[pending[task]["id"]] = "Timed out after %.3fs" % (time.time() - start)
+        if not_done:
+            # The client's own timeout may have ended a call in the meantime
+            await asyncio.gather(*not_done, return_exceptions=True)
+        return results, errors
@@ -0,0 +1,194 @@
+import os
+import math
+import time
+import asyncio
+import threading
+import contextvars
+from concurrent import futures
+
+from common import metrics
+
+
+class HedgePolicy(object):
+    """ Decides when, and whether, to hedge a call to an upstream.
+
+    The latencies of recent calls are kept in a ring of `window` samples and
+    a call that hasn't answered within their `percentile` gets one hedge,
+    once there are `min_samples` of them. Hedges are paid for from a budget:
+    every call adds `budget_percent` / 100 of a hedge to it, up to
+    `max_tokens`, so hedges stay at about `budget_percent` of the calls even
+    when the upstream is slow across the board.
+    """
+
+    def __init__(self,
+                 percentile=95.0,
+                 budget_percent=5.0,
+                 min_delay_s=0.002,
+                 window=1000,
+                 min_samples=100,
+                 max_tokens=10.0,
+                 registry=metrics.REGISTRY):
+        self.percentile = percentile
+        self.budget_percent = budget_percent
+        self.min_delay_s = min_delay_s
+        self.window = window
+        self.min_samples = min_samples
+        self.max_tokens = max_tokens
+        self.calls = 0
+        self.hedges = 0
+        self.hedges_won = 0
+        self.budget_exhausted = 0
+        self._samples = []
+        self._next = 0
+        self._observed = 0
+        self._delay_s = None
+        self._tokens = 0.0
+        self._lock = threading.Lock()
+        self._hedges = registry.counter(
+            "upstream_hedges_total", "Hedged upstream calls, by the attempt that answered first",
+            ("result",)
+        )
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            percentile=float(os.environ.get("HEDGE_PERCENTILE", 95.0)),
+            budget_percent=float(os.environ.get("HEDGE_BUDGET_PERCENT", 5.0)),
+            min_delay_s=float(os.environ.get("HEDGE_MIN_DELAY_S", 0.002))
+        )
+
+    def observe(self, duration_s):
+        with self._lock:
+            self._observed += 1
+            if len(self._samples) < self.window:
+                self._samples.append(duration_s)
+            else:
+                self._samples[self._next] = duration_s
+                self._next = (self._next + 1) % self.window
+            # Sorting the ring on every call would cost more than the calls
+            if len(self._samples) >= self.min_samples and (
+                    self._delay_s is None or self._observed % 50 == 0):
+                ordered = sorted(self._samples)
+                rank = int(math.ceil(self.percentile / 100.0 * len(ordered))) - 1
+                self._delay_s = max(ordered[max(rank, 0)], self.min_delay_s)
+
+    def start_call(self):
+        """ Returns how long to wait before hedging the call, or None """
+        with self._lock:
+            self.calls += 1
+            self._tokens = min(self._tokens + self.budget_percent / 100.0, self.max_tokens)
+            return self._delay_s
+
+    def try_hedge(self):
+        with self._lock:
+            if self._tokens < 1.0:
+                self.budget_exhausted += 1
+                return False
+            self._tokens -= 1.0
+            self.hedges += 1
+        return True
+
+    def hedge_finished(self, won):
+        with self._lock:
+            if won:
+                self.hedges_won += 1
+        self._hedges.inc(1, ("hedge" if won else "primary",))
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "percentile": self.percentile,
+                "delay_ms": None if self._delay_s is None else round(self._delay_s * 1000, 3),
+                "calls": self.calls,
+                "hedges": self.hedges,
+                "hedges_won": self.hedges_won,
+                "budget_exhausted": self.budget_exhausted,
+            }
+
+
+def _timed(policy, call):
+    start = time.perf_counter()
+    try:
+        return call()
+    finally:
+        policy.observe(time.perf_counter() - start)
+
+
+def _first_answer(done, pending, primary):
+    """ The attempt to answer with, or None to keep waiting for `pending` """
+    answered = [f for f in done if not f.exception()]
+    if answered:
+        return answered[0]
+    if not pending:
+        return primary if primary in done else done.pop()
+    return None
+
+
+def hedged_call(policy, executor, call):
+    """ Runs `call` on `executor` and, if it's slow, a hedge alongside it.
+
+    Returns the result of whichever attempt answers first, unless it failed
+    while the other is still running. A thread can't be interrupted mid-call,
+    so the other attempt runs to completion in the background, bounded by
+    its timeout, and its result is dropped.
+    """
+    delay_s = policy.start_call()
+    if delay_s is None:
+        return _timed(policy, call)
+    # Each attempt runs in its own copy of the context of the caller
+    primary = executor.submit(contextvars.copy_context().run, _timed, policy, call)
+    try:
+        return primary.result(timeout=delay_s)
+    except futures.TimeoutError:
+        pass
+    if not policy.try_hedge():
+        return primary.result()
+    hedge = executor.submit(contextvars.copy_context().run, _timed, policy, call)
+    pending = {primary, hedge}
+    while True:
+        done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+        first = _first_answer(done, pending, primary)
+        if first is not None:
+            policy.hedge_finished(first is hedge)
+            return first.result()
+
+
+async def _timed_async(policy, call):
+    start = time.perf_counter()
+    try:
+        result = await call()
+    except asyncio.CancelledError:
+        # Lost the race, so its latency is unknown
+        raise
+    except Exception:
+        policy.observe(time.perf_counter() - start)
+        raise
+    policy.observe(time.perf_counter() - start)
+    return result
+
+
+async def hedged_call_async(policy, call):
+    """ The asyncio counterpart of `hedged_call`, where `call` returns a
+    coroutine. The attempt that loses the race is cancelled.
+    """
+    delay_s = policy.start_call()
+    if delay_s is None:
+        return await _timed_async(policy, call)
+    primary = asyncio.ensure_future(_timed_async(policy, call))
+    hedge = None
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=delay_s)
+        if done or not policy.try_hedge():
+            return await primary
+        hedge = asyncio.ensure_future(_timed_async(policy, call))
+        pending = {primary, hedge}
+        while True:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            first = _first_answer(done, pending, primary)
+            if first is not None:
+                policy.hedge_finished(first is hedge)
+                return first.result()
+    finally:
+        for task in (primary, hedge):
+            if task is not None and not task.done():
+                task.cancel()
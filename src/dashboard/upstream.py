@@ -0,0 +1,147 @@
+import os
+import time
+import threading
+
+from concurrent import futures
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from common.context import current_context
+from common.metrics import HttpMetrics
+from circuit import CircuitBreaker
+from hedging import HedgePolicy, hedged_call
+
+
+class DeadlineExceeded(requests.exceptions.Timeout):
+    """ Raised instead of calling the upstream once the deadline of the
+    current request has passed
+    """
+
+
+class UpstreamClient(object):
+    """ A shared HTTP client for calls to one upstream, e.g. the counter
+    service via the local Envoy upstream listener.
+
+    Connections are kept alive in a bounded pool of `pool_size` connections.
+    When the pool is exhausted callers block for a free connection instead of
+    opening new ones. Every call has a connect and read timeout, capped by
+    what's left until the deadline of the current request, and fails fast
+    while the circuit `breaker` of the upstream is open. If the client sits
+    idle for longer than `idle_timeout_s` the pooled connections are closed
+    so we never reuse one the proxy has already dropped.
+
+    Idempotent reads can be hedged with `get_hedged` when a `hedge_policy`
+    is set. The hedge goes through the same Envoy upstream listener, whose
+    load balancer sends it to another instance than the stalled one, bar
+    a single healthy instance.
+    """
+
+    def __init__(self,
+                 endpoint,
+                 pool_size=10,
+                 connect_timeout_s=0.5,
+                 read_timeout_s=5.0,
+                 idle_timeout_s=60.0,
+                 breaker=None,
+                 hedge_policy=None):
+        self.endpoint = endpoint.rstrip("/")
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout_s, read_timeout_s)
+        self.idle_timeout_s = idle_timeout_s
+        self.breaker = breaker
+        self.hedge_policy = hedge_policy
+        self._hedge_executor = None
+        if hedge_policy is not None:
+            self._hedge_executor = futures.ThreadPoolExecutor(max_workers=pool_size)
+        self._lock = threading.Lock()
+        self._last_used = time.time()
+        self._session = self._new_session()
+        self._metrics = HttpMetrics()
+
+    @classmethod
+    def from_env(cls, endpoint):
+        return cls(
+            endpoint,
+            pool_size=int(os.environ.get("UPSTREAM_POOL_SIZE", 10)),
+            connect_timeout_s=float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT_S", 0.5)),
+            read_timeout_s=float(os.environ.get("UPSTREAM_READ_TIMEOUT_S", 5.0)),
+            idle_timeout_s=float(os.environ.get("UPSTREAM_IDLE_TIMEOUT_S", 60.0)),
+            breaker=CircuitBreaker.from_env(endpoint),
+            hedge_policy=HedgePolicy.from_env() if os.environ.get("HEDGING") == "true" else None
+        )
+
+    def _new_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.pool_size,
+            pool_block=True,
+            max_retries=0
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def _evict_if_idle(self):
+        now = time.time()
+        with self._lock:
+            if now - self._last_used > self.idle_timeout_s:
+                self._session.close()
+                self._session = self._new_session()
+            self._last_used = now
+            return self._session
+
+    def get(self, path, headers=None, params=None, timeout=None, record=True):
+        """ Calls the upstream, continuing the trace of the current request.
+        Calls made with `record=False`, e.g. failures asked for on purpose,
+        are kept out of the circuit breaker.
+        """
+        breaker = self.breaker if record else None
+        ctx = current_context()
+        remaining_s = ctx.remaining_s()
+        if remaining_s is not None and remaining_s <= 0:
+            raise DeadlineExceeded("Deadline exceeded before calling %s%s" % (self.endpoint, path))
+        if breaker is not None:
+            breaker.allow()
+        connect_timeout_s, read_timeout_s = timeout or self.timeout
+        session = self._evict_if_idle()
+        outbound = ctx.outbound_headers()
+        outbound.update(headers or {})
+        start = time.perf_counter()
+        code = "error"
+        try:
+            resp = session.get(
+                "{}{}".format(self.endpoint, path),
+                headers=outbound,
+                params=params,
+                timeout=(ctx.timeout_s(connect_timeout_s), ctx.timeout_s(read_timeout_s))
+            )
+            code = resp.status_code
+            return resp
+        finally:
+            duration_s = time.perf_counter() - start
+            self._metrics.record_upstream(self.endpoint, code, duration_s)
+            if breaker is not None:
+                breaker.record(code != "error" and code < 500, duration_s)
+
+    def get_hedged(self, path, headers=None, params=None, timeout=None):
+        """ Same as `get`, hedged when it's slow. Only for idempotent reads. """
+        if self.hedge_policy is None:
+            return self.get(path, headers=headers, params=params, timeout=timeout)
+        return hedged_call(
+            self.hedge_policy, self._hedge_executor,
+            lambda: self.get(path, headers=headers, params=params, timeout=timeout)
+        )
+
+    def stats(self):
+        return {
+            "circuit": None if self.breaker is None else self.breaker.as_dict(),
+            "hedging": None if self.hedge_policy is None else self.hedge_policy.as_dict(),
+        }
+
+    def close(self):
+        with self._lock:
+            self._session.close()
+        if self._hedge_executor is not None:
+            self._hedge_executor.shutdown(wait=False)
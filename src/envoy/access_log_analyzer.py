@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# ------------------------------------------------------------------------------
+# Summarizes the JSON access logs Envoy writes for the public listener, see
+# envoy_public_listener_json in proxy-defaults.hcl, without a log backend.
+#
+# Lines are parsed as they arrive and folded into per upstream and per route
+# latency sketches, error rates and response flag counts, all in fixed
+# memory. A summary of the last interval is printed every -interval seconds
+# and a summary of everything when the input ends.
+#
+# To analyze the logs of a running proxy, or a saved log file:
+#
+#       consul connect envoy ... | python /access_log_analyzer.py -interval 10
+#       python /access_log_analyzer.py -file proxy.log -follow
+# ------------------------------------------------------------------------------
+
+import sys
+import math
+import json
+import time
+import argparse
+import threading
+from collections import Counter
+
+
+# Routes and upstreams past this many are counted under OTHER, so memory
+# stays bounded whatever the traffic looks like
+MAX_KEYS = 1000
+OTHER = "<other>"
+
+QUANTILES = (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("p999", 0.999))
+
+# Bucket indexes of the values seen so far, shared by all the sketches of
+# one accuracy. Envoy logs integer milliseconds, so most are looked up.
+MAX_INDEX_CACHE_SIZE = 100000
+_index_caches = {}
+
+
+def _index_cache(relative_accuracy):
+    return _index_caches.setdefault(relative_accuracy, {})
+
+
+class QuantileSketch(object):
+    """ A log-bucketed quantile sketch, in the style of HDR histograms and
+    DDSketch.
+
+    Values are counted in buckets whose bounds grow geometrically, so any
+    quantile is within `relative_accuracy` of the true value. Memory depends
+    on the range of the values, not on how many there are: from 1ms to an
+    hour at 1% accuracy is under 800 buckets. Sketches can be merged.
+    """
+
+    __slots__ = ("relative_accuracy", "_log_gamma", "_index_cache",
+                 "buckets", "zeros", "count", "total", "min", "max")
+
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(gamma)
+        self._index_cache = _index_cache(relative_accuracy)
+        self.buckets = {}
+        self.zeros = 0
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if value <= 0:
+            self.zeros += 1
+            return
+        index = self._index_cache.get(value)
+        if index is None:
+            index = int(math.ceil(math.log(value) / self._log_gamma))
+            if len(self._index_cache) < MAX_INDEX_CACHE_SIZE:
+                self._index_cache[value] = index
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                # The midpoint of the bucket, in relative terms
+                value = 2 * math.exp(index * self._log_gamma) / (1 + math.exp(self._log_gamma))
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def merge(self, other):
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+        self.total += other.total
+        for attr, pick in (("min", min), ("max", max)):
+            theirs = getattr(other, attr)
+            if theirs is not None:
+                ours = getattr(self, attr)
+                setattr(self, attr, theirs if ours is None else pick(ours, theirs))
+
+
+class _Stats(object):
+
+    __slots__ = ("requests", "errors", "resets", "codes", "flags", "duration", "upstream_time")
+
+    def __init__(self, relative_accuracy):
+        self.requests = 0
+        # Responses with a 5xx code
+        self.errors = 0
+        # Requests without a response, Envoy logs these with code 0
+        self.resets = 0
+        self.codes = Counter()
+        self.flags = Counter()
+        self.duration = QuantileSketch(relative_accuracy)
+        self.upstream_time = QuantileSketch(relative_accuracy)
+
+    def merge(self, other):
+        self.requests += other.requests
+        self.errors += other.errors
+        self.resets += other.resets
+        self.codes.update(other.codes)
+        self.flags.update(other.flags)
+        self.duration.merge(other.duration)
+        self.upstream_time.merge(other.upstream_time)
+
+    def summary(self, elapsed_s):
+        summary = {
+            "requests": self.requests,
+            "rps": round(self.requests / elapsed_s, 1) if elapsed_s else None,
+            "error_rate": round((self.errors + self.resets) / self.requests, 4) if self.requests else 0.0,
+            "codes": dict(self.codes.most_common()),
+            "flags": dict(self.flags.most_common()),
+        }
+        for name, sketch in (("duration_ms", self.duration), ("upstream_time_ms", self.upstream_time)):
+            summary[name] = dict(
+                (label, _round(sketch.quantile(q))) for label, q in QUANTILES
+            )
+            summary[name]["max"] = sketch.max
+        return summary
+
+
+def _round(value):
+    return None if value is None else round(value, 1)
+
+
+class _Window(object):
+    """ The stats of a span of time, by upstream and by route """
+
+    def __init__(self, relative_accuracy):
+        self.relative_accuracy = relative_accuracy
+        self.started_at = time.time()
+        self.lines = 0
+        self.skipped = 0
+        self.upstreams = {}
+        self.routes = {}
+
+    def stats(self, table, key):
+        stats = table.get(key)
+        if stats is None:
+            if len(table) >= MAX_KEYS:
+                key = OTHER
+                stats = table.get(key)
+            if stats is None:
+                stats = table[key] = _Stats(self.relative_accuracy)
+        return stats
+
+    def merge(self, other):
+        self.lines += other.lines
+        self.skipped += other.skipped
+        for name in ("upstreams", "routes"):
+            table, theirs = getattr(self, name), getattr(other, name)
+            for key, stats in theirs.items():
+                self.stats(table, key).merge(stats)
+
+
+class AccessLogAnalyzer(object):
+    """ Folds access log lines into the current window and, when a window is
+    rotated out, into the running totals.
+    """
+
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.window = _Window(relative_accuracy)
+        self.totals = _Window(relative_accuracy)
+        self._lock = threading.Lock()
+        # Merging into the totals doesn't hold up feed()
+        self._totals_lock = threading.Lock()
+
+    def feed(self, line):
+        """ Adds one log line, as bytes. Lines that aren't access logs are
+        skipped.
+        """
+        with self._lock:
+            window = self.window
+            window.lines += 1
+            # Envoy's own log lines are interleaved on stdout
+            if line[:1] != b"{":
+                window.skipped += 1
+                return False
+            # With typed_json_format the numbers are numbers, else strings
+            try:
+                entry = json.loads(line)
+                code = int(entry["response_code"])
+                duration = int(entry["duration"])
+                upstream_time = entry.get("upstream_service_time")
+                # "-" when no upstream was called
+                upstream_time = None if upstream_time in (None, "", "-") else int(str(upstream_time))
+            except (ValueError, KeyError, TypeError):
+                window.skipped += 1
+                return False
+            flags = entry.get("response_flags")
+            route = str(entry.get("origin_path") or "-").split("?", 1)[0]
+            upstream = str(entry.get("upstream") or "-")
+
+            for stats in (window.stats(window.upstreams, upstream),
+                          window.stats(window.routes, route)):
+                stats.requests += 1
+                stats.codes[code] += 1
+                if code >= 500:
+                    stats.errors += 1
+                elif code == 0:
+                    stats.resets += 1
+                if flags and flags != "-":
+                    for flag in flags.split(","):
+                        stats.flags[flag] += 1
+                stats.duration.add(duration)
+                if upstream_time is not None:
+                    stats.upstream_time.add(upstream_time)
+            return True
+
+    def rotate(self):
+        """ Starts a new window and returns the summary of the last one """
+        with self._lock:
+            window, self.window = self.window, _Window(self.relative_accuracy)
+        with self._totals_lock:
+            self.totals.merge(window)
+        return summarize(window, time.time())
+
+    def summary(self):
+        """ Rotates the window out and returns the summary of the totals """
+        with self._lock:
+            window, self.window = self.window, _Window(self.relative_accuracy)
+        with self._totals_lock:
+            self.totals.merge(window)
+            return summarize(self.totals, time.time())
+
+
+def summarize(window, now):
+    elapsed_s = now - window.started_at
+    return {
+        "elapsed_s": round(elapsed_s, 3),
+        "lines": window.lines,
+        "skipped": window.skipped,
+        "upstreams": dict((k, s.summary(elapsed_s)) for k, s in sorted(window.upstreams.items())),
+        "routes": dict((k, s.summary(elapsed_s)) for k, s in sorted(window.routes.items())),
+    }
+
+
+def format_summary(summary, title):
+    lines = ["== %s: %s lines over %.1fs, %s skipped" % (
+        title, summary["lines"], summary["elapsed_s"], summary["skipped"])]
+    for table in ("upstreams", "routes"):
+        if not summary[table]:
+            continue
+        lines.append("%-32s %8s %8s %7s %8s %8s %8s %8s  %s" % (
+            table[:-1], "reqs", "rps", "err%", "p50", "p90", "p99", "p999", "flags"))
+        for key, stats in summary[table].items():
+            duration = stats["duration_ms"]
+            lines.append("%-32s %8d %8s %7.2f %8s %8s %8s %8s  %s" % (
+                key[:32], stats["requests"], stats["rps"], stats["error_rate"] * 100,
+                duration["p50"], duration["p90"], duration["p99"], duration["p999"],
+                ",".join("%s=%s" % item for item in stats["flags"].items()) or "-"))
+    return "\n".join(lines)
+
+
+def _lines(args):
+    if not args.file or args.file == "-":
+        for line in sys.stdin.buffer:
+            yield line
+        return
+    with open(args.file, "rb") as f:
+        while True:
+            line = f.readline()
+            if line:
+                yield line
+            elif args.follow:
+                time.sleep(0.2)
+            else:
+                return
+
+
+def _report_forever(analyzer, args, stopped):
+    while not stopped.wait(args.interval):
+        _print(analyzer.rotate(), "last %ss" % args.interval, args)
+
+
+def _print(summary, title, args):
+    if args.format == "json":
+        print(json.dumps(dict(summary, title=title)))
+    else:
+        print(format_summary(summary, title))
+    sys.stdout.flush()
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(
+        prog='access_log_analyzer',
+        description='Summarizes Envoy JSON access logs from stdin or a file.'
+    )
+    parser.add_argument('-file', type=str, default=None, help='Log file to read, stdin by default.')
+    parser.add_argument('-follow', action='store_true', help='Keep reading the file as it grows.')
+    parser.add_argument('-interval', type=float, default=10.0,
+                        help='Seconds between rolling summaries, 0 to only print the totals.')
+    parser.add_argument('-accuracy', type=float, default=0.01,
+                        help='Relative accuracy of the latency quantiles.')
+    parser.add_argument('-format', type=str, default="text", choices=("text", "json"))
+    return parser
+
+
+def main():
+    args = _parse_args().parse_args()
+    analyzer = AccessLogAnalyzer(args.accuracy)
+    stopped = threading.Event()
+    reporter = None
+    if args.interval:
+        reporter = threading.Thread(target=_report_forever, args=(analyzer, args, stopped))
+        reporter.daemon = True
+        reporter.start()
+    try:
+        for line in _lines(args):
+            analyzer.feed(line)
+    except KeyboardInterrupt:
+        pass
+    stopped.set()
+    # So the last rolling summary isn't printed after the totals
+    if reporter is not None:
+        reporter.join()
+    _print(analyzer.summary(), "total", args)
+
+
+if __name__ == '__main__':
+    main()
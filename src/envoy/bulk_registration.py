@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# ------------------------------------------------------------------------------
+# Registers many instances of a service into Consul to see how Consul and the
+# config pipeline behave at mesh scale.
+#
+# The instance configs are generated from the SERVICE_CONFIG template, the
+# same way service_configurator.py does for a single task, each with a unique
+# id, address and AZ. They are registered and then deregistered with bounded
+# concurrency at a fixed rate, and the throughput and latency of both are
+# reported.
+#
+# To register and deregister 5000 instances over the agent API:
+#
+#       python /bulk_registration.py -count 5000 -concurrency 32 -rate 500
+#
+# Or with the instances listed in a manifest, a JSON list of
+# {"address": ..., "az": ..., "family": ...} objects:
+#
+#       python /bulk_registration.py -manifest instances.json
+# ------------------------------------------------------------------------------
+
+import math
+import json
+import time
+import uuid
+import argparse
+import ipaddress
+import itertools
+import threading
+from concurrent import futures
+
+import requests
+
+from service_configurator import (
+    log, ConsulAgent, BootstrapError, load_service_config, regenerate_service_config
+)
+
+
+API_AGENT = "agent"
+API_CATALOG = "catalog"
+
+# Tag that marks the instances of one run, so they can be cleaned up
+RUN_TAG = "BulkRun"
+
+
+def generate_instances(service_config,
+                       count=None,
+                       manifest=None,
+                       cidr="10.128.0.0/10",
+                       azs=("eu-west-1a", "eu-west-1b", "eu-west-1c"),
+                       run_id=None,
+                       keep_checks=False):
+    """ Returns the service definitions of `count` instances, or of the
+    instances in `manifest`, all tagged with the run id. Raises ValueError
+    when `cidr` has fewer addresses than `count`.
+    """
+    run_id = run_id or uuid.uuid4().hex[:8]
+    family = json.loads(service_config)["service"]["name"]
+    if manifest is None:
+        addresses = list(itertools.islice(ipaddress.ip_network(cidr).hosts(), count))
+        if len(addresses) < count:
+            raise ValueError("cidr=%s only has %s addresses for %s instances" % (cidr, len(addresses), count))
+        manifest = [
+            {"address": str(address), "az": azs[i % len(azs)]}
+            for i, address in enumerate(addresses)
+        ]
+    instances = []
+    for i, entry in enumerate(manifest):
+        metadata = {
+            "task_id": "%s-%06d" % (run_id, i),
+            "family": entry.get("family", family),
+            "ip": entry["address"],
+            "az": entry.get("az", azs[i % len(azs)]),
+        }
+        service = json.loads(regenerate_service_config(metadata, service_config))["service"]
+        service["tags"].append("%s:%s" % (RUN_TAG, run_id))
+        if not keep_checks:
+            # The checks would all point at addresses nothing listens on
+            service.pop("check", None)
+            service.pop("checks", None)
+        instances.append(service)
+    return run_id, instances
+
+
+class RateLimiter(object):
+    """ Spaces out calls shared by many threads to `rate` per second """
+
+    def __init__(self, rate):
+        self.interval_s = 1.0 / rate if rate else 0.0
+        self._next_at = time.time()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval_s:
+            return
+        with self._lock:
+            now = time.time()
+            at = max(self._next_at, now)
+            self._next_at = at + self.interval_s
+        if at > now:
+            time.sleep(at - now)
+
+
+def percentile(sorted_values, pct):
+    """ Nearest rank percentile of an already sorted list """
+    if not sorted_values:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(sorted_values))) - 1
+    return sorted_values[min(max(rank, 0), len(sorted_values) - 1)]
+
+
+class BulkRegistration(object):
+    """ Registers and deregisters instances with `concurrency` calls in
+    flight, at most `rate` calls per second.
+
+    Over the agent API the instances are registered with the local agent,
+    sidecars included. Over the catalog API they're registered directly
+    into the catalog, spread over synthetic nodes of `per_node` instances,
+    which skips the agent's anti-entropy sync. Deregistering them removes
+    the synthetic nodes too.
+    """
+
+    def __init__(self, agent, api=API_AGENT, concurrency=16, rate=None, per_node=100):
+        self.agent = agent
+        self.api = api
+        self.concurrency = concurrency
+        self.rate = rate
+        self.per_node = per_node
+
+    def _node(self, i, run_id):
+        return "%s%04d" % (node_prefix(run_id), i // self.per_node)
+
+    def _register(self, i, service, run_id):
+        if self.api == API_CATALOG:
+            self.agent.catalog_register({
+                "Node": self._node(i, run_id),
+                "Address": service["address"],
+                "SkipNodeUpdate": True,
+                "Service": {
+                    "ID": service["id"],
+                    "Service": service["name"],
+                    "Address": service["address"],
+                    "Port": service.get("port", 0),
+                    "Tags": service["tags"],
+                },
+            })
+        else:
+            self.agent.register(service)
+
+    def _deregister(self, i, service, run_id):
+        if self.api == API_CATALOG:
+            self.agent.catalog_deregister(self._node(i, run_id), service["id"])
+        else:
+            self.agent.deregister(service["id"])
+
+    def register(self, instances, run_id):
+        return self._run("register", self._register, instances, run_id)
+
+    def deregister(self, instances, run_id):
+        report = self._run("deregister", self._deregister, instances, run_id)
+        if self.api == API_CATALOG:
+            nodes = sorted(set(self._node(i, run_id) for i in range(len(instances))))
+            report["nodes_deregistered"] = deregister_nodes(self.agent, nodes, self.concurrency)
+        return report
+
+    def _run(self, phase, call, instances, run_id):
+        limiter = RateLimiter(self.rate)
+        latencies, errors = [], []
+
+        def timed(i, service):
+            limiter.wait()
+            start = time.time()
+            try:
+                call(i, service, run_id)
+            except (BootstrapError, requests.exceptions.RequestException) as ex:
+                errors.append(str(ex))
+                return
+            latencies.append(time.time() - start)
+
+        start = time.time()
+        with futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for _ in executor.map(lambda args: timed(*args), enumerate(instances)):
+                pass
+        elapsed_s = time.time() - start
+
+        latencies_ms = sorted(l * 1000 for l in latencies)
+        report = {
+            "phase": phase,
+            "api": self.api,
+            "instances": len(instances),
+            "ok": len(latencies_ms),
+            "errors": len(errors),
+            "elapsed_s": round(elapsed_s, 3),
+            "per_s": round(len(latencies_ms) / elapsed_s, 1) if elapsed_s else 0.0,
+            "latency_ms": dict(
+                (name, None if percentile(latencies_ms, pct) is None
+                 else round(percentile(latencies_ms, pct), 2))
+                for name, pct in (("p50", 50), ("p90", 90), ("p99", 99), ("max", 100))
+            ),
+        }
+        if errors:
+            report["first_error"] = errors[0]
+        return report
+
+
+def node_prefix(run_id):
+    """ The synthetic catalog nodes of a run are named after it """
+    return "bulk-%s-" % run_id
+
+
+def deregister_nodes(agent, nodes, concurrency=16):
+    """ Deregisters catalog nodes with all their services, returns how many
+    were deregistered
+    """
+    def call(node):
+        try:
+            agent.catalog_deregister(node)
+            return True
+        except (BootstrapError, requests.exceptions.RequestException) as ex:
+            log.warning("Error deregistering node=%s, %s" % (node, ex))
+            return False
+
+    with futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return sum(executor.map(call, nodes))
+
+
+def cleanup(agent, run_id, concurrency=16):
+    """ Deregisters the instances of a run, e.g. after an interrupted run.
+    Returns (agent instances, catalog nodes) deregistered.
+    """
+    services = agent.services('"%s:%s" in Tags' % (RUN_TAG, run_id))
+    for service_id in services:
+        agent.deregister(service_id)
+    nodes = [node for node in agent.catalog_nodes() if node.startswith(node_prefix(run_id))]
+    return len(services), deregister_nodes(agent, nodes, concurrency)
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(
+        prog='consul_bulk_registration',
+        usage='%(prog)s [options]',
+        description='Registers many service instances into Consul and reports the throughput.'
+    )
+    parser.add_argument('-count', type=int, default=1000,
+                        help='Number of instances to generate from the SERVICE_CONFIG template.')
+    parser.add_argument('-manifest', type=str, default=None,
+                        help='JSON list of instances with an address, and optionally an az and family.')
+    parser.add_argument('-cidr', type=str, default="10.128.0.0/10",
+                        help='Addresses of the generated instances.')
+    parser.add_argument('-azs', type=str, default="eu-west-1a,eu-west-1b,eu-west-1c")
+    parser.add_argument('-api', type=str, default=API_AGENT, choices=(API_AGENT, API_CATALOG))
+    parser.add_argument('-concurrency', type=int, default=16)
+    parser.add_argument('-rate', type=float, default=None, help='Maximum calls per second.')
+    parser.add_argument('-hold', type=float, default=0.0,
+                        help='Seconds to keep the instances registered before deregistering them.')
+    parser.add_argument('-keep', action='store_true', help='Leave the instances registered.')
+    parser.add_argument('-checks', action='store_true', help='Register the health checks too.')
+    parser.add_argument('-cleanup', type=str, default=None, metavar='RUN_ID',
+                        help='Only deregister the instances and catalog nodes of an earlier run.')
+    return parser
+
+
+def main():
+    parser = _parse_args()
+    args = parser.parse_args()
+    agent = ConsulAgent(pool_size=args.concurrency)
+    if args.cleanup:
+        services, nodes = cleanup(agent, args.cleanup, args.concurrency)
+        log.info("Deregistered %s agent instances and %s catalog nodes of run_id=%s" % (
+            services, nodes, args.cleanup))
+        return
+
+    manifest = None
+    if args.manifest:
+        with open(args.manifest) as f:
+            manifest = json.load(f)
+    try:
+        run_id, instances = generate_instances(
+            load_service_config(),
+            count=args.count,
+            manifest=manifest,
+            cidr=args.cidr,
+            azs=args.azs.split(","),
+            keep_checks=args.checks
+        )
+    except ValueError as ex:
+        parser.error(str(ex))
+    log.info("Generated %s instances, run_id=%s" % (len(instances), run_id))
+
+    bulk = BulkRegistration(agent, api=args.api, concurrency=args.concurrency, rate=args.rate)
+    reports = [bulk.register(instances, run_id)]
+    log.info(json.dumps(reports[-1]))
+    if not args.keep:
+        time.sleep(args.hold)
+        reports.append(bulk.deregister(instances, run_id))
+        log.info(json.dumps(reports[-1]))
+    print(json.dumps({"run_id": run_id, "reports": reports}, indent=2))
+
+
+if __name__=='__main__':
+    main()
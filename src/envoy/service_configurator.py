@@ -10,6 +10,11 @@
 #
 #       python /service_configurator.py -saveto <FILENAME>
 #
+# To also register the service, run its Envoy sidecar and deregister the
+# service when stopped:
+#
+#       python /service_configurator.py -saveto <FILENAME> -bootstrap -- <ENVOY_ARGS>
+#
 # More about consul service configs
 # https://learn.hashicorp.com/consul/developer-mesh/connect-services
 # ------------------------------------------------------------------------------
@@ -17,50 +22,49 @@
 import os
 import sys
 import json
-import logging
-from collections import defaultdict
-from logging.config import dictConfig
+import time
+import base64
+import signal
+import threading
+import subprocess
+from concurrent import futures
+from collections import defaultdict, OrderedDict
 
 import argparse
 import requests
+from requests.adapters import HTTPAdapter
 
+from common.backoff import backoff_delays
+from common.logs import setup_logging, log_level_from_env
+from common.task_metadata import get_task_metadata
 
-log_levels = {
-    'DEBUG': logging.DEBUG,
-    'INFO': logging.INFO,
-    'WARNING': logging.WARNING,
-    'ERROR': logging.ERROR,
-    'CRITICAL': logging.CRITICAL
-}
 
 PLACEHOLDER = "<PLACEHOLDER>"
 
+# Path the service exposes its own Prometheus metrics on, empty if it doesn't
+APP_METRICS_PATH = os.environ.get("APP_METRICS_PATH", "")
+
+CONSUL_HTTP_ADDR = os.environ.get("CONSUL_HTTP_ADDR", "http://127.0.0.1:8500")
+CONSUL_WAIT_DEADLINE_S = float(os.environ.get("CONSUL_WAIT_DEADLINE_S", 300))
+ENVOY_ADMIN_ADDR = os.environ.get("ENVOY_ADMIN_ADDR", "127.0.0.1:19000")
+ENVOY_READY_DEADLINE_S = float(os.environ.get("ENVOY_READY_DEADLINE_S", 120))
+
+# Upstream calls go to instances in the task's own AZ first, unless "none"
+LOCALITY_ZONE = "zone"
+LOCALITY_NONE = "none"
+UPSTREAM_LOCALITY = os.environ.get("UPSTREAM_LOCALITY", LOCALITY_ZONE)
+# When an AZ has no healthy instance left, calls fail over to every AZ of the
+# upstream, and then to these datacenters in order
+UPSTREAM_FAILOVER_DATACENTERS = [
+    dc for dc in os.environ.get("UPSTREAM_FAILOVER_DATACENTERS", "").split(",") if dc
+]
+# Instances failing this many calls in a row are ejected by Envoy, so an AZ
+# fails over before Consul's health checks catch up
+UPSTREAM_MAX_FAILURES = int(os.environ.get("UPSTREAM_MAX_FAILURES", 5))
+UPSTREAM_FAILURE_INTERVAL_S = int(os.environ.get("UPSTREAM_FAILURE_INTERVAL_S", 10))
 
-def setup_logging(log_level):
-    logging_config = dict(
-        version = 1,
-        formatters = {
-            'simple': {
-                'format': '%(asctime)s %(levelname)-8s %(message)s'
-            }
-        },
-        handlers = {
-            'console': {
-                'class': 'logging.StreamHandler',
-                'formatter': 'simple',
-                'level': log_level,
-                'stream': 'ext://sys.stdout'
-            }
-        },
-        root = {
-            'handlers': ['console'],
-            'level': log_level,
-        },
-    )
-    dictConfig(logging_config)
-    return logging.getLogger(__name__)
 
-log = setup_logging(log_levels.get(os.environ.get("LOG_LEVEL", "INFO")))
+log = setup_logging(log_level_from_env(), __name__)
 
 
 def generate_instance_id(task_metadata):
@@ -71,23 +75,18 @@ def generate_instance_id(task_metadata):
     )
 
 
-def get_task_metadata():
-    metadata_uri = os.environ["ECS_CONTAINER_METADATA_URI"]
-    resp = requests.get("{}/task".format(metadata_uri))
-    log.info("Original Task Metadata \n%s" % resp.text)
-    resp = json.loads(resp.text)
-    ip = resp["Containers"][0]["Networks"][0]["IPv4Addresses"][0]
-    task_id =  resp['TaskARN'].split("/")[2]
-    #TODO: Get AZ
-    az = resp.get('AvailabilityZone', "eu-west-1a")
-    return {"task_id": task_id, "family": resp['Family'], "ip": ip, "az": az}
-
-
 def regenerate_service_config(task_metadata, service_config):
     service_config = json.loads(service_config)
     service_config["service"]["id"] = generate_instance_id(task_metadata)
     service_config["service"]["address"] = task_metadata["ip"]
-    service_config["service"]["tags"].append("AZ:%s" % task_metadata["az"])
+    if task_metadata["az"]:
+        service_config["service"]["tags"].append("AZ:%s" % task_metadata["az"])
+        # What the AZ subsets of the service's resolver select on
+        service_config["service"].setdefault("meta", {})["az"] = task_metadata["az"]
+    if APP_METRICS_PATH:
+        # Lets prometheus discover the service's metrics, see prometheus.yml
+        service_config["service"]["tags"].append("Metrics:yes")
+        service_config["service"]["tags"].append("MetricsPath:%s" % APP_METRICS_PATH)
     return json.dumps(service_config)
 
 
@@ -97,6 +96,374 @@ def dump_config(config, filename):
         f.write(config)
 
 
+def load_service_config():
+    """ The service config template, as set by the consul mesh adapter """
+    if "SERVICE_CONFIG" in os.environ:
+        return os.environ["SERVICE_CONFIG"]
+    return base64.b64decode(os.environ["SERVICE_CONFIG_B64"]).decode("utf-8")
+
+
+def generate_service_config(filename):
+    """ Generates the service config, saves it to `filename` and returns it """
+    service_config = load_service_config()
+    metadata = get_task_metadata()
+    log.info("Got Task Metadata \n%s " % json.dumps(metadata))
+    log.info("Received service_config \n%s" % service_config.replace("\n", "").replace("\r", ""))
+    config = regenerate_service_config(metadata, service_config)
+    log.info("Generated config \n%s " % config)
+    dump_config(config, filename)
+    log.info("Saved to file, filename==%s" % filename)
+    return config
+
+
+def zone_upstream_name(upstream, az):
+    """ The name the sidecars in `az` call `upstream` by """
+    return "%s-%s" % (upstream, az)
+
+
+def with_zone_subset(resolver, upstream, az, failover_datacenters=()):
+    """ Returns the service-resolver of `upstream`, `resolver` if it exists,
+    with a subset for its passing instances in `az` that fails over to all
+    of its instances.
+    """
+    resolver = json.loads(json.dumps(resolver)) if resolver else {
+        "Kind": "service-resolver",
+        "Name": upstream,
+    }
+    resolver.setdefault("Subsets", {})[az] = {
+        "Filter": 'Service.Meta.az == "%s"' % az,
+        "OnlyPassing": True,
+    }
+    failover = {"Service": upstream}
+    if failover_datacenters:
+        failover["Datacenters"] = list(failover_datacenters)
+    resolver.setdefault("Failover", {})[az] = failover
+    return resolver
+
+
+def zone_redirect(upstream, az):
+    """ The service-resolver that routes the zone name of `upstream` to its
+    subset in `az`
+    """
+    return {
+        "Kind": "service-resolver",
+        "Name": zone_upstream_name(upstream, az),
+        "Redirect": {"Service": upstream, "ServiceSubset": az},
+    }
+
+
+def localize_upstream(upstream, az,
+                      max_failures=UPSTREAM_MAX_FAILURES,
+                      failure_interval_s=UPSTREAM_FAILURE_INTERVAL_S):
+    """ Points a sidecar upstream at the instances in `az`, see
+    `configure_upstream_locality`. The local bind port stays the same.
+    """
+    upstream["destination_name"] = zone_upstream_name(upstream["destination_name"], az)
+    upstream.setdefault("config", {})["passive_health_check"] = {
+        "interval": "%ss" % failure_interval_s,
+        "max_failures": max_failures,
+    }
+    return upstream
+
+
+class BootstrapError(Exception):
+    pass
+
+
+class ConsulAgent(object):
+    """ A client of the local Consul agent's HTTP API """
+
+    def __init__(self, addr=CONSUL_HTTP_ADDR, timeout_s=2.0, pool_size=10):
+        if not addr.startswith("http"):
+            addr = "http://%s" % addr
+        self.url = addr.rstrip("/")
+        self.timeout_s = timeout_s
+        self._session = requests.Session()
+        self._session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+
+    def leader(self):
+        resp = self._session.get("%s/v1/status/leader" % self.url, timeout=self.timeout_s)
+        resp.raise_for_status()
+        return json.loads(resp.text)
+
+    def wait_for_leader(self, deadline_s=CONSUL_WAIT_DEADLINE_S, stopping=None):
+        """ Waits, backing off, until the agent has joined a cluster with a
+        leader. Gives up as soon as the `stopping` event is set.
+        """
+        stopping = stopping or threading.Event()
+        start = time.time()
+        for delay_s in backoff_delays(initial_s=0.1, max_s=1.0):
+            try:
+                leader = self.leader()
+                if leader:
+                    log.info("Consul is up, leader=%s" % leader)
+                    return leader
+            except (requests.exceptions.RequestException, ValueError):
+                pass
+            if time.time() - start + delay_s > deadline_s:
+                raise BootstrapError("Consul had no leader after %.1f(s)" % (time.time() - start))
+            log.info("Waiting for Consul to start")
+            if stopping.wait(delay_s):
+                raise BootstrapError("Stopped while waiting for Consul")
+
+    def register(self, service):
+        resp = self._session.put("%s/v1/agent/service/register" % self.url,
+                                 data=json.dumps(service), timeout=self.timeout_s)
+        if resp.status_code != 200:
+            raise BootstrapError("Error registering service, code=%s, %s" % (resp.status_code, resp.text))
+
+    def deregister(self, service_id):
+        resp = self._session.put("%s/v1/agent/service/deregister/%s" % (self.url, service_id),
+                                 timeout=self.timeout_s)
+        if resp.status_code != 200:
+            raise BootstrapError("Error deregistering service, code=%s, %s" % (resp.status_code, resp.text))
+
+    def services(self, filter_expr=None):
+        """ The services registered with this agent, keyed by id """
+        resp = self._session.get("%s/v1/agent/services" % self.url,
+                                 params={"filter": filter_expr} if filter_expr else None,
+                                 timeout=self.timeout_s)
+        resp.raise_for_status()
+        return json.loads(resp.text)
+
+    def config_entry(self, kind, name):
+        """ The config entry, or None if it doesn't exist """
+        resp = self._session.get("%s/v1/config/%s/%s" % (self.url, kind, name),
+                                 timeout=self.timeout_s)
+        if resp.status_code == 404:
+            return None
+        resp.raise_for_status()
+        return json.loads(resp.text)
+
+    def write_config_entry(self, entry, cas=None):
+        """ Returns whether the entry was written, which with `cas` is only
+        if its ModifyIndex still matches
+        """
+        resp = self._session.put("%s/v1/config" % self.url,
+                                 params={"cas": cas} if cas is not None else None,
+                                 data=json.dumps(entry), timeout=self.timeout_s)
+        if resp.status_code != 200:
+            raise BootstrapError("Error writing config entry, code=%s, %s" % (resp.status_code, resp.text))
+        return json.loads(resp.text)
+
+    def update_config_entry(self, kind, name, update, attempts=5):
+        """ Replaces a config entry by `update(entry)`, retrying when it's
+        changed by someone else in between
+        """
+        delays = backoff_delays(initial_s=0.05, max_s=1.0)
+        for _ in range(attempts):
+            entry = self.config_entry(kind, name)
+            index = 0
+            if entry:
+                index = entry.pop("ModifyIndex", 0)
+                entry.pop("CreateIndex", None)
+            updated = update(entry)
+            if updated == entry or self.write_config_entry(updated, cas=index):
+                return updated
+            time.sleep(next(delays))
+        raise BootstrapError("Config entry kept changing, kind=%s, name=%s" % (kind, name))
+
+    def catalog_register(self, registration):
+        resp = self._session.put("%s/v1/catalog/register" % self.url,
+                                 data=json.dumps(registration), timeout=self.timeout_s)
+        if resp.status_code != 200:
+            raise BootstrapError("Error registering in catalog, code=%s, %s" % (resp.status_code, resp.text))
+
+    def catalog_deregister(self, node, service_id=None):
+        """ Deregisters a service of `node`, or without `service_id` the
+        node itself along with all of its services and checks
+        """
+        registration = {"Node": node}
+        if service_id is not None:
+            registration["ServiceID"] = service_id
+        resp = self._session.put("%s/v1/catalog/deregister" % self.url,
+                                 data=json.dumps(registration), timeout=self.timeout_s)
+        if resp.status_code != 200:
+            raise BootstrapError("Error deregistering from catalog, code=%s, %s" % (resp.status_code, resp.text))
+
+    def catalog_nodes(self):
+        """ The names of all nodes in the catalog """
+        resp = self._session.get("%s/v1/catalog/nodes" % self.url, timeout=self.timeout_s)
+        resp.raise_for_status()
+        return [node["Node"] for node in json.loads(resp.text)]
+
+
+def configure_upstream_locality(agent, service, failover_datacenters=UPSTREAM_FAILOVER_DATACENTERS):
+    """ Makes the sidecar of `service` prefer upstream instances in its own AZ.
+
+    Consul hands Envoy the endpoints without their zone, so the preference
+    is made with config entries instead. Each upstream's resolver gets a
+    subset for the AZ, and a redirect resolver named after the AZ routes to
+    that subset. The sidecar's upstream is then pointed at the redirect.
+
+    When the subset has no healthy instance left, Envoy fails over to every
+    AZ. Instances that fail calls are ejected first, so this happens before
+    Consul's health checks catch up. An upstream whose entries can't be
+    written keeps using every AZ.
+    """
+    az = service.get("meta", {}).get("az")
+    upstreams = service.get("connect", {}).get("sidecar_service", {}).get("proxy", {}).get("upstreams", [])
+    if not az:
+        log.warning("The AZ of the task is unknown, upstreams use every AZ")
+        return []
+    localized = []
+    for upstream in upstreams:
+        name = upstream["destination_name"]
+        try:
+            agent.update_config_entry(
+                "service-resolver", name,
+                lambda resolver: with_zone_subset(resolver, name, az, failover_datacenters)
+            )
+            agent.write_config_entry(zone_redirect(name, az))
+        except (BootstrapError, requests.exceptions.RequestException, ValueError) as ex:
+            log.warning("Could not route upstream=%s by AZ, it uses every AZ, %s" % (name, ex))
+            continue
+        localize_upstream(upstream, az)
+        localized.append(name)
+    log.info("Upstreams prefer az=%s, upstreams=%s" % (az, ",".join(localized)))
+    return localized
+
+
+def wait_for_envoy(process, admin_addr=ENVOY_ADMIN_ADDR, deadline_s=ENVOY_READY_DEADLINE_S):
+    """ Waits until the Envoy admin API reports the proxy as ready """
+    start = time.time()
+    session = requests.Session()
+    for delay_s in backoff_delays(initial_s=0.05, max_s=1.0):
+        if process.poll() is not None:
+            raise BootstrapError("Envoy exited with code=%s before it was ready" % process.returncode)
+        try:
+            resp = session.get("http://%s/ready" % admin_addr, timeout=1.0)
+            if resp.status_code == 200:
+                return
+        except requests.exceptions.RequestException:
+            pass
+        if time.time() - start + delay_s > deadline_s:
+            raise BootstrapError("Envoy was not ready after %.1f(s)" % (time.time() - start))
+        time.sleep(delay_s)
+
+
+class SidecarBootstrapper(object):
+    """ Registers the service and runs its Envoy sidecar, in one process.
+
+    Generating the service config and waiting for Consul run concurrently.
+    Once both are done the service is registered over the agent's HTTP API
+    and Envoy is started, and readiness is taken from the Envoy admin API.
+    Before registering, the upstreams are pointed at the task's AZ, see
+    `configure_upstream_locality`.
+
+    On SIGTERM or SIGINT the service is deregistered and Envoy is stopped.
+    The handlers are installed first, so a task stopped while bootstrapping
+    doesn't leave its service registered.
+    """
+
+    def __init__(self, filename, envoy_args, agent=None,
+                 envoy_command=("consul", "connect", "envoy"),
+                 envoy_admin_addr=ENVOY_ADMIN_ADDR):
+        self.filename = filename
+        self.envoy_args = list(envoy_args)
+        self.agent = agent or ConsulAgent()
+        self.envoy_command = list(envoy_command)
+        self.envoy_admin_addr = envoy_admin_addr
+        self.service_id = None
+        self.envoy = None
+        self.timings = OrderedDict()
+        self._registered = False
+        self._stopping = threading.Event()
+        # Reentrant, as the signal handlers run on the main thread, which
+        # may be deregistering already
+        self._lock = threading.RLock()
+
+    def _timed(self, name, fn, *args):
+        start = time.time()
+        try:
+            return fn(*args)
+        finally:
+            self.timings[name] = round((time.time() - start) * 1000, 1)
+
+    def _raise_if_stopping(self, step):
+        if self._stopping.is_set():
+            raise BootstrapError("Stopped before %s" % step)
+
+    def start(self):
+        start = time.time()
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+
+        with futures.ThreadPoolExecutor(max_workers=2) as executor:
+            config = executor.submit(self._timed, "generate_config_ms", generate_service_config, self.filename)
+            leader = executor.submit(self._timed, "wait_for_consul_ms",
+                                     self.agent.wait_for_leader, CONSUL_WAIT_DEADLINE_S, self._stopping)
+            service = json.loads(config.result())["service"]
+            leader.result()
+        self.service_id = service["id"]
+
+        # Before registering, so the sidecar never calls an AZ's upstream
+        # name that doesn't resolve yet
+        if UPSTREAM_LOCALITY == LOCALITY_ZONE:
+            if self._timed("upstream_locality_ms", configure_upstream_locality, self.agent, service):
+                dump_config(json.dumps({"service": service}), self.filename)
+
+        self._raise_if_stopping("registering")
+        self._timed("register_ms", self.agent.register, service)
+        with self._lock:
+            self._registered = True
+        log.info("Registered service with consul, service_id=%s" % self.service_id)
+
+        # A signal received while registering found nothing to deregister
+        self._raise_if_stopping("starting Envoy")
+        command = self.envoy_command + ["-sidecar-for", self.service_id] + self.envoy_args
+        log.info("Running proxy: %s" % " ".join(command))
+        envoy_start = time.time()
+        self.envoy = subprocess.Popen(command)
+        wait_for_envoy(self.envoy, self.envoy_admin_addr)
+        self.timings["envoy_ready_ms"] = round((time.time() - envoy_start) * 1000, 1)
+        self.timings["total_ms"] = round((time.time() - start) * 1000, 1)
+        log.info("Sidecar ready, timings=%s" % json.dumps(self.timings), extra=dict(self.timings))
+        self._dump_envoy_config()
+
+    def _dump_envoy_config(self):
+        try:
+            resp = requests.get("http://%s/config_dump" % self.envoy_admin_addr, timeout=5)
+            log.info("Envoy config %s" % json.dumps(json.loads(resp.text), separators=(",", ":")))
+        except (requests.exceptions.RequestException, ValueError) as ex:
+            log.warning("Could not dump the envoy config, %s" % ex)
+
+    def _on_signal(self, signum, frame):
+        log.info("Received signal=%s, shutting down" % signum)
+        self._stopping.set()
+        self.deregister()
+        if self.envoy is not None and self.envoy.poll() is None:
+            self.envoy.terminate()
+
+    def deregister(self):
+        with self._lock:
+            if not self._registered:
+                return
+            self._registered = False
+        try:
+            self.agent.deregister(self.service_id)
+            log.info("Deregistered service from consul, service_id=%s" % self.service_id)
+        except (BootstrapError, requests.exceptions.RequestException) as ex:
+            log.error("Error deregistering service, %s" % ex)
+
+    def run(self):
+        """ Bootstraps and blocks until Envoy exits, returns its exit code """
+        try:
+            self.start()
+            return self.envoy.wait()
+        except BootstrapError as ex:
+            if self.envoy is not None and self.envoy.poll() is None:
+                self.envoy.terminate()
+                self.envoy.wait()
+            if self._stopping.is_set():
+                log.info(str(ex))
+                return 0
+            log.error(str(ex))
+            return 1
+        finally:
+            self.deregister()
+
+
 def _parse_args():
     parser = argparse.ArgumentParser(
         prog='consul_service_configurator',
@@ -112,6 +479,12 @@ def _parse_args():
         default="/consul/config/service.json",
         help='Absolute path of (JSON) filename to store the consul service configuration.'
     )
+    parser.add_argument(
+        '-bootstrap',
+        action='store_true',
+        help='Also register the service and run its Envoy sidecar, '
+             'the arguments after -- are passed to Envoy.'
+    )
     return parser
 
 
@@ -120,24 +493,25 @@ def main():
 
     To run:
         python /service_configurator.py -saveto <FILENAME>
+
+    To also register the service and run its sidecar:
+        python /service_configurator.py -saveto <FILENAME> -bootstrap -- <ENVOY_ARGS>
     """
+    argv = sys.argv[1:]
+    envoy_args = argv[argv.index("--"):] if "--" in argv else []
+    argv = argv[:len(argv) - len(envoy_args)]
     try:
         parser = _parse_args()
-        args = vars(parser.parse_args())
+        args = vars(parser.parse_args(argv))
         filename = args['saveto'][0]
     except SystemExit:
         parser.print_help()
         exit(1)
 
     log.info("Running script.")
-    service_config = os.environ["SERVICE_CONFIG"]
-    metadata = get_task_metadata()
-    log.info("Got Task Metadata \n%s " % json.dumps(metadata))
-    log.info("Received service_config \n%s" % service_config.replace("\n", "").replace("\r", ""))
-    config = regenerate_service_config(metadata, service_config)
-    log.info("Generated config \n%s " % config)
-    dump_config(config, filename)
-    log.info("Saved to file, filename==%s" % filename)
+    if args['bootstrap']:
+        sys.exit(SidecarBootstrapper(filename, envoy_args).run())
+    generate_service_config(filename)
 
 
 if __name__=='__main__':
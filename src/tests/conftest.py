@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The shared modules are imported from ./src, and each service imports its
+# own modules by name, as it's run from its own directory. Only app.py is in
+# more than one of them, so the apps are run as processes instead
+sys.path.insert(0, SRC_DIR)
+for service in ("counter", "dashboard", "envoy", "consul"):
+    sys.path.append(os.path.join(SRC_DIR, service))
+
+
+@pytest.fixture(scope="module")
+def counter_service(tmp_path_factory):
+    """ A counter served by the development server """
+    from bench.services import ServiceProcess
+
+    log_path = str(tmp_path_factory.mktemp("counter") / "counter.log")
+    with ServiceProcess("counter", "dev", {"ADMISSION_CONTROL": "false"}, log_path) as service:
+        yield service
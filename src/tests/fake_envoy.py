@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# ------------------------------------------------------------------------------
+# Stands in for `consul connect envoy` in the tests. It serves the parts of the
+# Envoy admin API the bootstrapper uses, and exits on SIGTERM.
+#
+#       python fake_envoy.py -sidecar-for <SERVICE_ID> -- -admin-bind <ADDR> \
+#                            [-ready-after-s <SECONDS>] [-exit-code <CODE>]
+# ------------------------------------------------------------------------------
+
+import sys
+import json
+import time
+import signal
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+def _arg(name, default=None):
+    return sys.argv[sys.argv.index(name) + 1] if name in sys.argv else default
+
+
+def main():
+    host, port = _arg("-admin-bind").rsplit(":", 1)
+    ready_at = time.time() + float(_arg("-ready-after-s", 0))
+    exit_code = _arg("-exit-code")
+    if exit_code is not None:
+        sys.exit(int(exit_code))
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path == "/ready":
+                status, body = (200, "LIVE") if time.time() >= ready_at else (503, "PRE_INITIALIZING")
+            else:
+                status, body = 200, json.dumps({"configs": [], "sidecar_for": _arg("-sidecar-for")})
+            self.send_response(status)
+            self.end_headers()
+            self.wfile.write(body.encode("utf-8"))
+
+    server = HTTPServer((host, int(port)), Handler)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
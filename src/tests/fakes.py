@@ -0,0 +1,242 @@
+import re
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+
+class FakeHTTPServer(object):
+    """ Serves `handle(method, path, params, body)` on a free local port.
+    The handler returns (status, body), with bodies that aren't bytes sent
+    as JSON. Every request is recorded in `requests` as (method, path).
+    """
+
+    def __init__(self):
+        self.requests = []
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self._server.daemon_threads = True
+        self.address = "%s:%s" % self._server.server_address[:2]
+        self.url = "http://%s" % self.address
+
+    def __enter__(self):
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def handle(self, method, path, params, body):
+        raise NotImplementedError()
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                pass
+
+            def _dispatch(self):
+                url = urlsplit(self.path)
+                params = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+                raw = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                fake.requests.append((self.command, url.path))
+                status, body = fake.handle(
+                    self.command, url.path, params, json.loads(raw) if raw else None
+                )
+                if not isinstance(body, bytes):
+                    body = json.dumps(body).encode("utf-8")
+                try:
+                    self.send_response(status)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client gave up waiting
+                    pass
+
+            do_GET = do_PUT = do_POST = do_DELETE = _dispatch
+
+        return Handler
+
+
+class FakeInstance(FakeHTTPServer):
+    """ A service instance answering every path with `body` after `delay_s` """
+
+    def __init__(self, body, status=200, delay_s=0.0):
+        super(FakeInstance, self).__init__()
+        self.body = body
+        self.status = status
+        self.delay_s = delay_s
+
+    def handle(self, method, path, params, body):
+        time.sleep(self.delay_s)
+        return self.status, self.body
+
+
+class FakeMetadataEndpoint(FakeHTTPServer):
+    """ The ECS task metadata endpoint, failing the first `failures` calls
+    with a 503, and answering the others after `delay_s`
+    """
+
+    def __init__(self, task, failures=0, delay_s=0.0):
+        super(FakeMetadataEndpoint, self).__init__()
+        self.task = task
+        self.failures = failures
+        self.delay_s = delay_s
+
+    def handle(self, method, path, params, body):
+        if path != "/task":
+            return 404, {"message": "Not found"}
+        if self.failures:
+            self.failures -= 1
+            return 503, {"message": "Unavailable"}
+        time.sleep(self.delay_s)
+        return 200, self.task
+
+
+def _field(service, name):
+    """ Service definitions are accepted in either case, like Consul does """
+    return service.get(name, service.get(name.lower()))
+
+
+class FakeConsul(FakeHTTPServer):
+    """ The parts of the Consul HTTP API the services use, kept in dicts.
+
+    The agent answers without a leader to the first `leaderless_calls`
+    leader queries, as it does until it joins the cluster. Config entries
+    are kept by (kind, name), and the next `config_conflicts` CAS writes of
+    an entry fail as if someone else had changed it just before. Writes of
+    the entries named in `failing_config_entries` fail with a 500.
+    """
+
+    def __init__(self, leaderless_calls=0):
+        super(FakeConsul, self).__init__()
+        self.leaderless_calls = leaderless_calls
+        self.instances = {}
+        self.agent_services = {}
+        self.nodes = {}
+        self.config_entries = {}
+        self.config_conflicts = 0
+        self.failing_config_entries = set()
+        self._index = 0
+        self._lock = threading.Lock()
+
+    def add_instance(self, service, service_id, address, port, tags=(), passing=True,
+                     node="node-1", node_address="127.0.0.1"):
+        with self._lock:
+            self.instances[service_id] = {
+                "Node": {"Node": node, "Address": node_address},
+                "Service": {
+                    "ID": service_id,
+                    "Service": service,
+                    "Address": address,
+                    "Port": port,
+                    "Tags": list(tags),
+                },
+                "Checks": [{"Status": "passing" if passing else "critical"}],
+            }
+
+    def handle(self, method, path, params, body):
+        with self._lock:
+            if method == "GET" and path.startswith("/v1/health/service/"):
+                return 200, self._health(path[len("/v1/health/service/"):], params)
+            if method == "GET" and path == "/v1/status/leader":
+                if self.leaderless_calls:
+                    self.leaderless_calls -= 1
+                    return 200, ""
+                return 200, "127.0.0.1:8300"
+            if method == "PUT" and path == "/v1/agent/service/register":
+                return self._agent_register(body)
+            if method == "PUT" and path.startswith("/v1/agent/service/deregister/"):
+                service_id = path[len("/v1/agent/service/deregister/"):]
+                if self.agent_services.pop(service_id, None) is None:
+                    return 404, b"Unknown service ID"
+                self.agent_services.pop(service_id + "-sidecar-proxy", None)
+                return 200, None
+            if method == "GET" and path == "/v1/agent/services":
+                return 200, self._agent_services(params.get("filter"))
+            if method == "PUT" and path == "/v1/catalog/register":
+                node = self.nodes.setdefault(body["Node"], {"Address": body["Address"], "Services": {}})
+                if body.get("Service"):
+                    service = body["Service"]
+                    node["Services"][service.get("ID") or service["Service"]] = service
+                return 200, True
+            if method == "PUT" and path == "/v1/catalog/deregister":
+                if "ServiceID" in body:
+                    self.nodes.get(body["Node"], {"Services": {}})["Services"].pop(body["ServiceID"], None)
+                else:
+                    self.nodes.pop(body["Node"], None)
+                return 200, True
+            if method == "GET" and path == "/v1/catalog/nodes":
+                return 200, [{"Node": name, "Address": node["Address"]} for name, node in self.nodes.items()]
+            if method == "GET" and path.startswith("/v1/config/"):
+                entry = self.config_entries.get(tuple(path[len("/v1/config/"):].split("/", 1)))
+                return (200, entry) if entry else (404, b"Config entry not found")
+            if method == "PUT" and path == "/v1/config":
+                return self._write_config_entry(body, params.get("cas"))
+        return 404, {"message": "Not served by the fake: %s %s" % (method, path)}
+
+    def _health(self, service, params):
+        return [
+            entry for entry in self.instances.values()
+            if entry["Service"]["Service"] == service
+            and ("tag" not in params or params["tag"] in entry["Service"]["Tags"])
+            and (params.get("passing") != "true"
+                 or all(c["Status"] == "passing" for c in entry["Checks"]))
+        ]
+
+    def _agent_register(self, service):
+        name = _field(service, "Name")
+        if not name:
+            return 400, b"Missing service name"
+        service_id = _field(service, "ID") or name
+        self.agent_services[service_id] = {
+            "ID": service_id,
+            "Service": name,
+            "Tags": list(_field(service, "Tags") or []),
+            "Address": _field(service, "Address") or "",
+            "Port": _field(service, "Port") or 0,
+            "Meta": dict(_field(service, "Meta") or {}),
+        }
+        if (_field(service, "Connect") or {}).get("sidecar_service") is not None:
+            self.agent_services[service_id + "-sidecar-proxy"] = {
+                "ID": service_id + "-sidecar-proxy",
+                "Service": name + "-sidecar-proxy",
+                "Tags": [],
+                "Address": "",
+                "Port": 21000,
+                "Meta": {},
+            }
+        return 200, None
+
+    def _agent_services(self, filter_expr):
+        # Only the `"<tag>" in Tags` filters are supported
+        tag = re.match(r'^"(.*)" in Tags$', filter_expr).group(1) if filter_expr else None
+        return dict(
+            (service_id, service) for service_id, service in self.agent_services.items()
+            if tag is None or tag in service["Tags"]
+        )
+
+    def _write_config_entry(self, entry, cas):
+        key = (entry["Kind"], entry["Name"])
+        if entry["Name"] in self.failing_config_entries:
+            return 500, b"Internal error"
+        current = self.config_entries.get(key)
+        self._index += 1
+        if cas is not None and self.config_conflicts:
+            self.config_conflicts -= 1
+            if current:
+                current["ModifyIndex"] = self._index
+            return 200, False
+        if cas is not None and int(cas) != (current["ModifyIndex"] if current else 0):
+            return 200, False
+        self.config_entries[key] = dict(
+            entry, CreateIndex=current["CreateIndex"] if current else self._index, ModifyIndex=self._index
+        )
+        return 200, True
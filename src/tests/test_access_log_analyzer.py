@@ -0,0 +1,81 @@
+import json
+import random
+import threading
+
+from access_log_analyzer import AccessLogAnalyzer, QuantileSketch
+
+
+def _line(code=200, duration=10, upstream="counter", path="/count"):
+    return json.dumps({
+        "response_code": code,
+        "duration": duration,
+        "upstream_service_time": str(duration),
+        "response_flags": "-",
+        "upstream": upstream,
+        "origin_path": path,
+    }).encode("utf-8")
+
+
+def test_sketch_quantiles_are_within_the_relative_accuracy():
+    sketch = QuantileSketch(0.01)
+    values = list(range(1, 10001))
+    random.shuffle(values)
+    for value in values:
+        sketch.add(value)
+
+    for q in (0.5, 0.9, 0.99):
+        exact = q * 9999 + 1
+        assert abs(sketch.quantile(q) - exact) <= exact * 0.011
+
+
+def test_sketches_of_one_accuracy_share_their_index_cache():
+    a, b, other = QuantileSketch(0.01), QuantileSketch(0.01), QuantileSketch(0.02)
+    assert a._index_cache is b._index_cache
+    assert a._index_cache is not other._index_cache
+
+    a.add(123)
+    assert 123 in b._index_cache
+    b.add(123)
+    assert a.buckets == b.buckets
+
+
+def test_rotating_while_feeding_loses_no_lines():
+    analyzer = AccessLogAnalyzer()
+    rotated, stopped = [], threading.Event()
+
+    def rotate():
+        while not stopped.is_set():
+            rotated.append(analyzer.rotate()["lines"])
+
+    rotator = threading.Thread(target=rotate)
+    rotator.start()
+    for i in range(20000):
+        analyzer.feed(_line(code=503 if i % 10 == 0 else 200))
+    analyzer.feed(b"[info] not an access log")
+    stopped.set()
+    rotator.join()
+
+    summary = analyzer.summary()
+    assert summary["lines"] == 20001
+    assert sum(rotated) <= 20001
+    assert summary["skipped"] == 1
+    counter = summary["upstreams"]["counter"]
+    assert counter["requests"] == 20000
+    assert counter["error_rate"] == 0.1
+
+
+def test_typed_json_lines():
+    analyzer = AccessLogAnalyzer()
+    # As written with typed_json_format
+    assert analyzer.feed(b'{"response_code":200,"duration":5,"upstream_service_time":3,"upstream":"counter"}')
+    assert analyzer.feed(b'{"response_code":503,"duration":7,"upstream_service_time":null,"origin_path":"/count?x=1"}')
+    assert analyzer.feed(_line(upstream="counter"))
+    assert not analyzer.feed(b'{"response_code":200,"duration":5,"upstream_service_time":"3ms"}')
+    assert not analyzer.feed(b'{"response_code":200,"duration":5,"upstream_service_time":[3]}')
+
+    window = analyzer.window
+    assert (window.lines, window.skipped) == (5, 2)
+    assert window.upstreams["counter"].requests == 2
+    assert window.upstreams["counter"].upstream_time.count == 2
+    assert window.upstreams["-"].upstream_time.count == 0
+    assert window.routes["/count"].requests == 2
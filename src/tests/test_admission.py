@@ -0,0 +1,152 @@
+import time
+
+import pytest
+from flask import Flask
+
+import admission
+from admission import SHED_DEADLINE, SHED_OVER_LIMIT, AdmissionController
+from app import ADMISSION_PRIORITY_PATHS
+from common import context, metrics
+
+
+class FakeClock(object):
+    """ Stands in for the time module of the admission controller """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def perf_counter(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(admission, "time", clock)
+    return clock
+
+
+def _controller(**kwargs):
+    kwargs.setdefault("window_s", 1.0)
+    return AdmissionController(registry=metrics.Registry(), **kwargs)
+
+
+def _window(controller, clock, latency_s, requests):
+    """ Handles `requests` at once that each take `latency_s`, and ends the
+    window with the last one
+    """
+    assert all(controller.try_acquire() for _ in range(requests))
+    for _ in range(requests - 1):
+        controller.release(latency_s)
+    clock.now += controller.window_s
+    controller.release(latency_s)
+
+
+def test_limit_grows_while_latency_is_tolerated(clock):
+    controller = _controller(initial_limit=10, tolerance=2.0, slack_s=0.005)
+    _window(controller, clock, 0.010, 10)
+    assert controller.min_rtt == 0.010
+    assert controller.limit == 11
+
+    # Up to tolerance * min_rtt
+    _window(controller, clock, 0.019, 10)
+    _window(controller, clock, 0.020, 10)
+    assert controller.limit == 13
+
+
+def test_limit_grows_within_the_slack_of_fast_requests(clock):
+    controller = _controller(initial_limit=10, tolerance=2.0, slack_s=0.005)
+    _window(controller, clock, 0.001, 10)
+    # Over tolerance * min_rtt, but within min_rtt + slack_s
+    _window(controller, clock, 0.005, 10)
+    assert controller.limit == 12
+
+
+def test_limit_backs_off_when_latency_isnt_tolerated(clock):
+    controller = _controller(initial_limit=10, tolerance=2.0, slack_s=0.005, backoff=0.9)
+    _window(controller, clock, 0.010, 10)
+    _window(controller, clock, 0.021, 10)
+    assert controller.limit == pytest.approx(11 * 0.9)
+    _window(controller, clock, 0.050, 9)
+    assert controller.limit == pytest.approx(11 * 0.9 * 0.9)
+
+
+def test_limit_follows_the_median_not_a_few_stalled_requests(clock):
+    controller = _controller(initial_limit=10, tolerance=2.0)
+    _window(controller, clock, 0.010, 10)
+    assert all(controller.try_acquire() for _ in range(10))
+    for latency_s in [1.0] * 4 + [0.010] * 5:
+        controller.release(latency_s)
+    clock.now += controller.window_s
+    controller.release(0.010)
+    assert controller.limit == 12
+
+
+def test_limit_stays_within_bounds(clock):
+    controller = _controller(initial_limit=3, min_limit=2, max_limit=4, backoff=0.5)
+    for _ in range(3):
+        _window(controller, clock, 0.010, 3)
+    assert controller.limit == 4
+    for _ in range(3):
+        _window(controller, clock, 1.0, 2)
+    assert controller.limit == 2
+
+
+@pytest.fixture
+def shedding_app():
+    """ A Flask app in front of a controller admitting two requests at once """
+    controller = _controller(initial_limit=2, min_limit=2)
+    app = Flask(__name__)
+    context.init_flask(app)
+    metrics.init_flask(app, metrics.Registry())
+    admission.init_flask(app, controller, priority_paths=ADMISSION_PRIORITY_PATHS)
+
+    @app.route("/count")
+    def count():
+        return "1"
+
+    @app.route("/boom")
+    def boom():
+        raise RuntimeError("boom")
+
+    return app, controller
+
+
+def test_requests_over_the_limit_are_shed(shedding_app):
+    app, controller = shedding_app
+    client = app.test_client()
+    assert client.get("/count").status_code == 200
+
+    assert controller.try_acquire() and controller.try_acquire()
+    resp = client.get("/count")
+    assert resp.status_code == 503
+    assert resp.headers["X-Envoy-Overloaded"] == "true"
+    assert controller._shed.collect() == {(SHED_OVER_LIMIT,): 1}
+
+    # Never shed
+    assert client.get("/metrics").status_code == 200
+    assert controller.in_flight == 2
+
+
+def test_requests_past_their_deadline_are_shed(shedding_app):
+    app, controller = shedding_app
+    resp = app.test_client().get("/count", headers={
+        context.DEADLINE_HEADER: "100",
+        context.REQUEST_START_HEADER: "t=%.3f" % (time.time() - 1),
+    })
+    assert resp.status_code == 503
+    assert resp.headers["X-Envoy-Overloaded"] == "true"
+    assert controller._shed.collect() == {(SHED_DEADLINE,): 1}
+    assert controller.in_flight == 0
+
+
+def test_failed_requests_are_released(shedding_app):
+    app, controller = shedding_app
+    client = app.test_client()
+    for _ in range(3):
+        assert client.get("/boom").status_code == 500
+    assert controller.in_flight == 0
+    assert len(controller._window_samples) == 3
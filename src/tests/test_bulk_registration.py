@@ -0,0 +1,82 @@
+import json
+import time
+
+import pytest
+
+from bulk_registration import (
+    API_AGENT, API_CATALOG, RUN_TAG, BulkRegistration, cleanup, generate_instances
+)
+from fakes import FakeConsul
+from service_configurator import ConsulAgent
+
+
+TEMPLATE = json.dumps({
+    "service": {
+        "name": "counter",
+        "tags": ["ServiceName:counter"],
+        "port": 5000,
+        "check": {"http": "http://localhost:5000/health", "interval": "10s"},
+    }
+})
+
+
+def test_generate_instances():
+    run_id, instances = generate_instances(TEMPLATE, count=7, cidr="10.0.0.0/24", azs=("a", "b"))
+
+    assert len(set(i["id"] for i in instances)) == 7
+    assert [i["address"] for i in instances] == ["10.0.0.%d" % n for n in range(1, 8)]
+    assert [i["meta"]["az"] for i in instances] == ["a", "b", "a", "b", "a", "b", "a"]
+    assert all("%s:%s" % (RUN_TAG, run_id) in i["tags"] for i in instances)
+    assert all("check" not in i for i in instances)
+
+
+def test_generate_instances_rejects_a_count_the_cidr_cant_hold():
+    with pytest.raises(ValueError, match="only has 2 addresses"):
+        generate_instances(TEMPLATE, count=3, cidr="10.0.0.0/30")
+
+
+def test_agent_registration():
+    run_id, instances = generate_instances(TEMPLATE, count=20, cidr="10.0.0.0/24")
+    with FakeConsul() as consul:
+        bulk = BulkRegistration(ConsulAgent(consul.address), api=API_AGENT, concurrency=4)
+        report = bulk.register(instances, run_id)
+        assert len(consul.agent_services) == 20
+
+        assert (report["ok"], report["errors"]) == (20, 0)
+        report = bulk.deregister(instances, run_id)
+        assert (report["ok"], report["errors"]) == (20, 0)
+        assert consul.agent_services == {}
+
+
+def test_catalog_deregistration_removes_the_synthetic_nodes():
+    run_id, instances = generate_instances(TEMPLATE, count=25, cidr="10.0.0.0/24")
+    with FakeConsul() as consul:
+        bulk = BulkRegistration(ConsulAgent(consul.address), api=API_CATALOG, concurrency=4, per_node=10)
+        bulk.register(instances, run_id)
+        assert sorted(consul.nodes) == ["bulk-%s-%04d" % (run_id, n) for n in range(3)]
+
+        report = bulk.deregister(instances, run_id)
+        assert (report["ok"], report["nodes_deregistered"]) == (25, 3)
+        assert consul.nodes == {}
+
+
+def test_cleanup_removes_only_the_run():
+    run_id, instances = generate_instances(TEMPLATE, count=4, cidr="10.0.0.0/24")
+    other_id, others = generate_instances(TEMPLATE, count=4, cidr="10.0.1.0/24")
+    with FakeConsul() as consul:
+        agent = ConsulAgent(consul.address)
+        BulkRegistration(agent, api=API_AGENT).register(instances[:2], run_id)
+        BulkRegistration(agent, api=API_CATALOG, per_node=1).register(instances[2:], run_id)
+        BulkRegistration(agent, api=API_CATALOG).register(others, other_id)
+
+        assert cleanup(agent, run_id) == (2, 2)
+        assert consul.agent_services == {}
+        assert sorted(consul.nodes) == ["bulk-%s-0000" % other_id]
+
+
+def test_registration_is_rate_limited():
+    run_id, instances = generate_instances(TEMPLATE, count=10, cidr="10.0.0.0/24")
+    with FakeConsul() as consul:
+        start = time.time()
+        BulkRegistration(ConsulAgent(consul.address), concurrency=8, rate=50).register(instances, run_id)
+    assert time.time() - start >= 9 / 50.0
@@ -0,0 +1,64 @@
+import asyncio
+
+import pytest
+
+from cache import AsyncCoalescingCache
+
+
+def test_async_cache_coalesces_concurrent_loads():
+    loads = []
+
+    async def loader():
+        loads.append(1)
+        await asyncio.sleep(0.01)
+        return len(loads)
+
+    async def run():
+        cache = AsyncCoalescingCache(loader, ttl_s=60)
+        return await asyncio.gather(*[cache.get() for _ in range(10)]), cache
+
+    values, cache = asyncio.run(run())
+    assert values == [1] * 10
+    assert len(loads) == 1
+    assert (cache.stats.misses, cache.stats.coalesced) == (1, 9)
+
+
+def test_async_cache_cancelled_leader_leaves_the_load_to_its_followers():
+    loads = []
+
+    async def loader():
+        loads.append(1)
+        await asyncio.sleep(0.05)
+        return "loaded"
+
+    async def run():
+        cache = AsyncCoalescingCache(loader, ttl_s=60)
+        leader = asyncio.ensure_future(cache.get())
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(cache.get())
+        await asyncio.sleep(0)
+        # E.g. the leader's client disconnected
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        value = await asyncio.wait_for(follower, 1)
+        return value, await cache.get(), cache
+
+    value, cached, cache = asyncio.run(run())
+    assert value == cached == "loaded"
+    assert len(loads) == 1
+    assert (cache.stats.misses, cache.stats.coalesced, cache.stats.hits) == (1, 1, 1)
+
+
+def test_async_cache_loader_error_reaches_followers():
+    async def loader():
+        await asyncio.sleep(0.01)
+        raise ValueError("boom")
+
+    async def run():
+        cache = AsyncCoalescingCache(loader, ttl_s=60)
+        return await asyncio.gather(cache.get(), cache.get(), return_exceptions=True), cache
+
+    results, cache = asyncio.run(run())
+    assert [type(r) for r in results] == [ValueError, ValueError]
+    assert cache.stats.errors == 1
@@ -0,0 +1,84 @@
+import os
+import sys
+import asyncio
+import importlib
+
+import aiohttp
+import pytest
+
+from circuit import STATE_HALF_OPEN, STATE_OPEN, CircuitBreaker, CircuitOpenError
+from fakes import FakeInstance
+
+
+@pytest.fixture
+def async_app(monkeypatch):
+    """ The dashboard's async_app.py, imported with the dashboard's app.py,
+    which the counter's app.py otherwise shadows on the path
+    """
+    monkeypatch.setenv("COUNTER_ENDPOINT", "http://127.0.0.1:1")
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "dashboard", "app.py")
+    spec = importlib.util.spec_from_file_location("app", path)
+    dashboard_app = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(dashboard_app)
+    monkeypatch.setitem(sys.modules, "app", dashboard_app)
+    sys.modules.pop("async_app", None)
+    yield importlib.import_module("async_app")
+    sys.modules.pop("async_app", None)
+
+
+def _opened_breaker():
+    breaker = CircuitBreaker("counter", min_calls=1, open_s=0)
+    breaker.record(False, 0.0)
+    assert breaker.state == STATE_OPEN
+    return breaker
+
+
+def test_half_open_circuit_lets_one_probe_through():
+    breaker = _opened_breaker()
+    assert breaker.allow() is True
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+
+    breaker.record(True, 0.0)
+    assert breaker.allow() is False
+
+
+def test_released_probe_lets_the_next_call_probe():
+    breaker = _opened_breaker()
+    breaker.allow()
+    breaker.release()
+    assert breaker.allow() is True
+    assert breaker.rejected == 0
+
+
+def test_cancelled_probe_lets_the_next_call_probe(async_app, monkeypatch):
+    breaker = _opened_breaker()
+
+    async def run(url):
+        monkeypatch.setattr(async_app, "COUNTER_ENDPOINT", url)
+        app = {
+            "counter_breaker": breaker,
+            "counter_timeout": aiohttp.ClientTimeout(sock_connect=1.0, sock_read=5.0),
+            "counter": aiohttp.ClientSession(),
+        }
+
+        async def probe():
+            async with async_app.counter_get(app, "/count") as resp:
+                return await resp.text()
+
+        try:
+            # E.g. the hedge that lost the race
+            task = asyncio.ensure_future(probe())
+            await asyncio.sleep(0.2)
+            assert breaker.state == STATE_HALF_OPEN
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+        finally:
+            await app["counter"].close()
+
+    with FakeInstance({"count": 1}, delay_s=1.0) as counter:
+        asyncio.run(run(counter.url))
+
+    assert breaker.state == STATE_HALF_OPEN
+    assert breaker.allow() is True
@@ -0,0 +1,159 @@
+import io
+import time
+import base64
+import threading
+
+import pytest
+
+from common.consul_kv_stub import ConsulKVStub, TXN_PATH
+from consul_counter import ConsulCounter
+
+
+KEY = "counter/count"
+
+
+class LossyKVStub(ConsulKVStub):
+    """ Drops the connection of the next `lose_responses` transactions after
+    making them, or of the next `lose_requests` before making them
+    """
+
+    lose_responses = 0
+    lose_requests = 0
+
+    def _handler_class(self):
+        stub = self
+        base = super(LossyKVStub, self)._handler_class()
+
+        class Handler(base):
+
+            def do_PUT(self):
+                if self.path.startswith(TXN_PATH):
+                    if stub.lose_requests:
+                        stub.lose_requests -= 1
+                        self.close_connection = True
+                        return
+                    if stub.lose_responses:
+                        stub.lose_responses -= 1
+                        self.wfile, self.close_connection = io.BytesIO(), True
+                base.do_PUT(self)
+
+        return Handler
+
+
+@pytest.fixture
+def stub():
+    stub = LossyKVStub("127.0.0.1:0").start()
+    yield stub
+    stub.stop()
+
+
+def _count(stub):
+    entry, _ = stub.get(KEY)
+    return int(base64.b64decode(entry["Value"])) if entry else 0
+
+
+def _counter(stub, **kwargs):
+    counter = ConsulCounter(KEY, consul_addr=stub.address, flush_interval_s=0.05, wait_s=1, **kwargs)
+    counter.start()
+    return counter
+
+
+def _eventually(condition, timeout_s=5):
+    deadline = time.time() + timeout_s
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_concurrent_replicas_add_up(stub):
+    replicas = [_counter(stub) for _ in range(3)]
+
+    def increment(counter):
+        for _ in range(500):
+            counter.increment()
+
+    threads = [threading.Thread(target=increment, args=(c,)) for c in replicas for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for counter in replicas:
+        counter.stop()
+
+    assert _count(stub) == 3000
+    assert all(c.pending() == 0 for c in replicas)
+    # Far fewer writes than increments
+    assert stub.writes < 300
+
+
+def test_conflicting_flush_is_retried_on_the_new_count(stub):
+    counter = _counter(stub)
+    counter._stop.set()
+    stub.put(KEY, b"10", cas=0)
+    counter.increment(5)
+
+    counter.flush()
+    assert _count(stub) == 15
+    assert counter.stats()["conflicts"] == 1
+    assert counter.pending() == 0
+
+
+def test_written_flush_whose_response_is_lost_is_not_repeated(stub):
+    counter = _counter(stub)
+    counter._stop.set()
+    counter.increment(5)
+
+    stub.lose_responses = 1
+    counter.flush()
+    assert counter.stats()["errors"] == 1
+    assert counter.pending() == 0
+    assert counter._in_doubt is None
+
+    counter.increment(3)
+    counter.flush()
+    assert _count(stub) == 8
+    assert _eventually(lambda: counter.value == 8)
+
+
+def test_lost_flush_is_repeated(stub):
+    counter = _counter(stub)
+    counter._stop.set()
+    counter.increment(5)
+
+    # The write and the retry settling it are both lost
+    stub.lose_requests = 2
+    counter.flush()
+    assert counter.pending() == 5
+    assert _count(stub) == 0
+    assert counter._in_doubt is not None
+
+    counter.flush()
+    assert counter._in_doubt is None
+    assert _count(stub) == 5
+    assert counter.pending() == 0
+
+
+def test_flush_in_doubt_is_settled_before_flushing_again(stub):
+    counter = _counter(stub, timeout_s=0.2)
+    counter._stop.set()
+    counter.increment(5)
+
+    # The write and the retry settling it both time out, and are then made
+    # late, in either order
+    with stub._changed:
+        counter.flush()
+    assert counter._in_doubt is not None
+
+    counter.increment(1)
+    counter.flush()
+    assert _count(stub) == 6
+    assert counter._in_doubt is None
+    assert counter.pending() == 0
+
+
+def test_stop_removes_the_flush_id(stub):
+    counter = _counter(stub)
+    counter.increment()
+    counter.stop()
+    assert _count(stub) == 1
+    assert list(stub.entries) == [KEY]
@@ -0,0 +1,37 @@
+import pytest
+import requests
+
+from counter_store import CounterStore, StoreFullError
+
+
+def test_increment_many_returns_new_values():
+    store = CounterStore(max_keys=16)
+    assert store.increment_many([("a", 1), ("b", 5), ("a", 2)]) == {"a": 3, "b": 5}
+    assert store.get_many(["a", "b", "c"]) == {"a": 3, "b": 5, "c": 0}
+    assert len(store) == 2
+
+
+def test_increment_many_is_all_or_nothing_when_full():
+    store = CounterStore(max_keys=3)
+    store.increment_many([("a", 1), ("b", 1)])
+
+    with pytest.raises(StoreFullError):
+        store.increment_many([("a", 1), ("c", 1), ("d", 1)])
+
+    assert store.get_many(["a", "b", "c", "d"]) == {"a": 1, "b": 1, "c": 0, "d": 0}
+    assert len(store) == 2
+    # Existing and repeated keys don't need room
+    assert store.increment_many([("a", 1), ("b", 1), ("c", 1), ("c", 1)]) == {"a": 2, "b": 2, "c": 2}
+
+
+@pytest.mark.parametrize("body", ["[1]", '"increments"', "3", "null", "not json"])
+def test_bulk_increment_rejects_bodies_that_are_not_objects(counter_service, body):
+    resp = requests.post(counter_service.endpoint + "/counters", data=body)
+    assert resp.status_code == 400
+
+
+def test_bulk_increment(counter_service):
+    resp = requests.post(counter_service.endpoint + "/counters",
+                         json={"increments": {"bulk-a": 2, "bulk-b": 3}})
+    assert resp.status_code == 200
+    assert resp.json() == {"counters": {"bulk-a": 2, "bulk-b": 3}}
@@ -0,0 +1,58 @@
+import time
+import random
+
+import pytest
+import requests
+
+from bench.services import ServiceProcess
+from fakes import FakeInstance
+
+
+@pytest.fixture(scope="module", params=["dev", "async"])
+def dashboard(request, counter_service, tmp_path_factory):
+    """ A dashboard calling the counter, in both serving modes """
+    log_path = str(tmp_path_factory.mktemp("dashboard") / ("dashboard-%s.log" % request.param))
+    env = {"COUNTER_ENDPOINT": counter_service.endpoint, "CIRCUIT_MIN_CALLS": "5"}
+    with ServiceProcess("dashboard", request.param, env, log_path) as service:
+        yield service
+
+
+def test_requested_failures_dont_open_the_circuit(dashboard):
+    for _ in range(20):
+        assert requests.get(dashboard.endpoint + "/fail", params={"code": 500}).status_code == 500
+
+    assert requests.get(dashboard.endpoint + "/upstream/stats").json()["circuit"]["state"] == "closed"
+    assert requests.get(dashboard.endpoint + "/").status_code == 200
+    assert requests.get(dashboard.endpoint + "/count").status_code == 200
+
+
+class JitteryCounter(FakeInstance):
+    """ A counter whose reads are slow one time in four """
+
+    def __init__(self):
+        super(JitteryCounter, self).__init__({"count": 1, "counter_service_id": "counter-1"})
+
+    def handle(self, method, path, params, body):
+        time.sleep(random.choice((0.002, 0.002, 0.002, 0.1)))
+        return 200, self.body
+
+
+def test_cancelled_hedges_are_not_counted_as_failures(tmp_path):
+    env = {
+        "HEDGING": "true",
+        "HEDGE_PERCENTILE": "50",
+        "HEDGE_BUDGET_PERCENT": "100",
+        "COUNT_CACHE_TTL_S": "0",
+        "CIRCUIT_MIN_CALLS": "5",
+        "CIRCUIT_FAILURE_RATE": "0.05",
+    }
+    with JitteryCounter() as counter:
+        env["COUNTER_ENDPOINT"] = counter.url
+        with ServiceProcess("dashboard", "async", env, str(tmp_path / "dashboard.log")) as dashboard:
+            # The hedge delay is only known after 100 calls
+            codes = [requests.get(dashboard.endpoint + "/count").status_code for _ in range(200)]
+            stats = requests.get(dashboard.endpoint + "/upstream/stats").json()
+
+    assert stats["hedging"]["hedges"] > 0
+    assert stats["circuit"]["opened"] == 0
+    assert set(codes) == {200}
@@ -0,0 +1,171 @@
+import os
+import json
+
+import boto3
+import pytest
+from botocore.stub import Stubber
+
+os.environ.setdefault("AWS_REGION", "eu-west-1")
+
+import discovery  # noqa: E402
+
+
+CLUSTER, FAMILY = "consul", "consul-server"
+
+
+class FakeClock(object):
+    """ Stands in for the time module, sleeping without waiting """
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(discovery, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def ecs():
+    client = boto3.client("ecs", "eu-west-1", aws_access_key_id="test", aws_secret_access_key="test")
+    with Stubber(client) as stubber:
+        client.stubber = stubber
+        yield client
+        stubber.assert_no_pending_responses()
+
+
+def _arn(i):
+    return "arn:aws:ecs:eu-west-1:123456789012:task/consul/%032x" % i
+
+
+def _task(i, status="RUNNING"):
+    return {
+        "taskArn": _arn(i),
+        "lastStatus": status,
+        "containers": [{"networkInterfaces": [{"privateIpv4Address": "10.0.%d.%d" % (i // 250, i % 250 + 1)}]}],
+    }
+
+
+def _expect_running(ecs, tasks, page_size=100):
+    """ Queues the responses of one discovery that finds `tasks` """
+    arns = [t["taskArn"] for t in tasks]
+    pages = [arns[i:i + page_size] for i in range(0, len(arns), page_size)] or [[]]
+    for n, page in enumerate(pages):
+        resp = {"taskArns": page}
+        params = {"cluster": CLUSTER, "family": FAMILY, "desiredStatus": "RUNNING"}
+        if n + 1 < len(pages):
+            resp["nextToken"] = "page-%d" % (n + 1)
+        if n:
+            params["nextToken"] = "page-%d" % n
+        ecs.stubber.add_response("list_tasks", resp, params)
+    for i in range(0, len(tasks), discovery.DESCRIBE_TASKS_BATCH_SIZE):
+        batch = tasks[i:i + discovery.DESCRIBE_TASKS_BATCH_SIZE]
+        ecs.stubber.add_response(
+            "describe_tasks", {"tasks": batch},
+            {"cluster": CLUSTER, "tasks": [t["taskArn"] for t in batch]}
+        )
+
+
+def _ips(tasks):
+    return sorted(t["containers"][0]["networkInterfaces"][0]["privateIpv4Address"] for t in tasks)
+
+
+def test_list_server_ips_pages_and_batches(ecs):
+    tasks = [_task(i) for i in range(250)]
+    _expect_running(ecs, tasks, page_size=90)
+    # A task that stopped between the two calls is left out
+    tasks[7]["lastStatus"] = "STOPPED"
+
+    ips = discovery.list_server_ips(ecs, CLUSTER, FAMILY)
+    assert ips == _ips(tasks[:7] + tasks[8:])
+
+
+def test_discovery_accepts_more_servers_than_expected(ecs, clock, tmp_path):
+    tasks = [_task(i) for i in range(5)]
+    _expect_running(ecs, tasks)
+
+    ips = discovery.discover_server_ips(CLUSTER, FAMILY, min_ips=3, ecs=ecs,
+                                        cache_filename=str(tmp_path / "cache.json"))
+    assert ips == _ips(tasks)
+    # Configured without waiting at all
+    assert clock.sleeps == []
+    assert discovery.load_cached_ips(str(tmp_path / "cache.json")) == ips
+
+
+def test_discovery_backs_off_until_enough_servers_run(ecs, clock, tmp_path):
+    tasks = [_task(i) for i in range(3)]
+    for running in (0, 1, 2, 3):
+        _expect_running(ecs, tasks[:running])
+
+    ips = discovery.discover_server_ips(CLUSTER, FAMILY, min_ips=3, ecs=ecs,
+                                        cache_filename=str(tmp_path / "cache.json"))
+    assert ips == _ips(tasks)
+    assert len(clock.sleeps) == 3
+    # Far below the fixed 30(s) per attempt discovery used to sleep
+    assert sum(clock.sleeps) < 10
+
+
+def test_discovery_retries_ecs_errors(ecs, clock, tmp_path):
+    ecs.stubber.add_client_error("list_tasks", "ThrottlingException")
+    _expect_running(ecs, [_task(0)])
+
+    ips = discovery.discover_server_ips(CLUSTER, FAMILY, min_ips=1, ecs=ecs,
+                                        cache_filename=str(tmp_path / "cache.json"))
+    assert ips == _ips([_task(0)])
+    assert len(clock.sleeps) == 1
+
+
+def test_discovery_returns_what_it_found_at_the_deadline(clock, tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(discovery, "list_server_ips", lambda *args: calls.append(args) or ["10.0.0.1"])
+    start = clock.now
+
+    ips = discovery.discover_server_ips(CLUSTER, FAMILY, min_ips=3, deadline_s=60, ecs=object(),
+                                        cache_filename=str(tmp_path / "cache.json"))
+    assert ips == ["10.0.0.1"]
+    assert clock.now - start <= 60
+    assert len(calls) == len(clock.sleeps) + 1 > 3
+
+
+def test_discovery_joins_cached_servers_right_away(ecs, clock, tmp_path):
+    cache_filename = str(tmp_path / "cache.json")
+    discovery.save_cached_ips(["10.0.9.1", "10.0.9.2"], cache_filename)
+    _expect_running(ecs, [_task(0)])
+
+    ips = discovery.discover_server_ips(CLUSTER, FAMILY, min_ips=3, ecs=ecs,
+                                        cache_filename=cache_filename)
+    assert ips == sorted(_ips([_task(0)]) + ["10.0.9.1", "10.0.9.2"])
+    assert clock.sleeps == []
+
+
+def test_watcher_rewrites_config_and_debounces_reloads(ecs, tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(discovery.subprocess, "check_call", calls.append)
+    monkeypatch.setattr(discovery, "save_cached_ips", lambda ips: None)
+    filename = str(tmp_path / "discovery.json")
+    metadata = {"ip": "10.0.0.100", "family": "consul-client", "task_id": "abc"}
+    discovery.dump_config(discovery.generate_config(
+        discovery.MODE_CLIENT, metadata, _ips([_task(0)])), filename)
+    watcher = discovery.DiscoveryWatcher(discovery.MODE_CLIENT, metadata, CLUSTER, FAMILY,
+                                         filename, debounce_s=10, ecs=ecs)
+
+    _expect_running(ecs, [_task(0), _task(1)])
+    _expect_running(ecs, [_task(0), _task(1), _task(2)])
+    assert watcher.poll(now=100)
+    assert watcher.poll(now=105)
+    assert not watcher.reload_if_due(now=114)
+    assert watcher.reload_if_due(now=115)
+
+    with open(filename) as f:
+        assert json.load(f)["retry_join"] == _ips([_task(0), _task(1), _task(2)])
+    assert calls == [["consul", "reload"], ["consul", "join"] + _ips([_task(1), _task(2)])]
@@ -0,0 +1,90 @@
+import time
+import asyncio
+import contextlib
+
+import aiohttp
+import pytest
+
+from fakes import FakeConsul, FakeInstance
+from fanout import AsyncFanOut, FanOut, ServiceCatalog
+
+
+DEADLINE_S = 0.5
+
+
+@pytest.fixture
+def counters():
+    """ Three healthy counter instances, the last one slower than the
+    deadline, plus an unhealthy one and a sidecar that must be left out
+    """
+    with contextlib.ExitStack() as stack:
+        consul = stack.enter_context(FakeConsul())
+        instances = [
+            stack.enter_context(FakeInstance({"count": 1})),
+            stack.enter_context(FakeInstance({"count": 2})),
+            stack.enter_context(FakeInstance({"count": 4}, delay_s=DEADLINE_S * 3)),
+            stack.enter_context(FakeInstance({"count": 8})),
+        ]
+        for i, instance in enumerate(instances):
+            host, port = instance.address.split(":")
+            consul.add_instance(
+                "counter", "counter-%d" % i, host if i else "", int(port),
+                tags=["ServiceName:counter"], passing=i != 3, node_address=host
+            )
+        consul.add_instance("counter", "counter-sidecar-proxy", "127.0.0.1", 1)
+        yield consul, instances
+
+
+def test_catalog_returns_the_passing_tagged_instances(counters):
+    consul, instances = counters
+    catalog = ServiceCatalog("counter", consul_addr=consul.address, ttl_s=60)
+
+    found = sorted(catalog.instances(), key=lambda i: i["id"])
+    assert [i["id"] for i in found] == ["counter-0", "counter-1", "counter-2"]
+    # An instance without an address of its own is reached on its node's
+    assert found[0]["address"] == "127.0.0.1"
+
+    catalog.instances()
+    assert len(consul.requests) == 1
+
+
+def _assert_partial(results, errors, elapsed_s):
+    assert results == {"counter-0": {"count": 1}, "counter-1": {"count": 2}}
+    assert list(errors) == ["counter-2"]
+    assert elapsed_s < DEADLINE_S * 2
+
+
+def test_fanout_returns_partial_results_at_the_deadline(counters):
+    consul, _ = counters
+    instances = ServiceCatalog("counter", consul_addr=consul.address).instances()
+
+    start = time.time()
+    results, errors = FanOut(max_workers=4).get(instances, "/count", deadline_s=DEADLINE_S)
+    _assert_partial(results, errors, time.time() - start)
+
+
+def test_async_fanout_returns_partial_results_at_the_deadline(counters):
+    consul, _ = counters
+    instances = ServiceCatalog("counter", consul_addr=consul.address).instances()
+
+    async def run():
+        async with aiohttp.ClientSession() as session:
+            start = time.time()
+            results, errors = await AsyncFanOut(session).get(
+                instances, "/count", deadline_s=DEADLINE_S
+            )
+            return results, errors, time.time() - start
+
+    _assert_partial(*asyncio.run(run()))
+
+
+def test_fanout_reports_failed_instances():
+    with FakeInstance({"count": 1}) as ok, FakeInstance({"message": "boom"}, status=500) as failing:
+        instances = [
+            {"id": "ok", "address": "127.0.0.1", "port": int(ok.address.split(":")[1])},
+            {"id": "failing", "address": "127.0.0.1", "port": int(failing.address.split(":")[1])},
+        ]
+        results, errors = FanOut(max_workers=2).get(instances, "/count", deadline_s=DEADLINE_S)
+
+    assert results == {"ok": {"count": 1}}
+    assert "500" in errors["failing"]
@@ -0,0 +1,52 @@
+import json
+
+import pytest
+import requests
+
+from faults import FaultInjector, InvalidFaultConfig, validate_config
+
+
+def test_validate_config_fills_in_defaults():
+    config = validate_config({"latency": {"type": "fixed", "ms": 10}, "errors": {"503": 5}})
+    assert config["latency"]["percent"] == 100.0
+    assert config["errors"] == {503: 5.0}
+    assert config["reset_percent"] == 0.0
+
+
+@pytest.mark.parametrize("config", [
+    {"latency": "slow"},
+    {"latency": {"type": "fixed", "ms": 10, "percent": "x"}},
+    {"latency": {"type": "fixed", "ms": 10, "percent": 101}},
+    {"latency": {"type": "fixed", "ms": 10, "percent": True}},
+    {"latency": {"type": "uniform", "min_ms": 20, "max_ms": 10}},
+    {"errors": {"503": -1}},
+    {"errors": {"503": "5"}},
+    {"errors": {"200": 5}},
+    {"errors": {"503": 60, "500": 50}},
+    {"reset_percent": "x"},
+    {"reset_percent": 100.5},
+    {"errors": {"503": 90}, "reset_percent": 20},
+])
+def test_validate_config_rejects_malformed_fields(config):
+    with pytest.raises(InvalidFaultConfig):
+        validate_config(config)
+
+
+def test_decide_only_injects_configured_faults():
+    faults = FaultInjector()
+    assert not faults.decide()
+
+    faults.configure({"errors": {"503": 100}, "latency": {"type": "fixed", "ms": 5}})
+    fault = faults.decide()
+    assert (fault.status_code, fault.delay_s, fault.reset) == (503, 0.005, False)
+
+
+def test_malformed_config_is_rejected_and_not_applied(counter_service):
+    resp = requests.put(counter_service.endpoint + "/faults", data=json.dumps(
+        {"latency": {"type": "fixed", "ms": 1, "percent": "x"}}
+    ))
+    assert resp.status_code == 400
+    assert "latency.percent" in resp.json()["message"]
+
+    assert requests.get(counter_service.endpoint + "/faults").json()["latency"] is None
+    assert requests.get(counter_service.endpoint + "/").status_code == 200
@@ -0,0 +1,55 @@
+import gc
+import threading
+
+from common.metrics import Counter, Histogram
+
+
+def _in_threads(n, target):
+    for _ in range(n):
+        thread = threading.Thread(target=target)
+        thread.start()
+        thread.join()
+    gc.collect()
+
+
+def test_shards_of_exited_threads_are_retired():
+    requests = Counter("requests_total", "Requests", ("route",))
+    latency = Histogram("latency_seconds", "Latency", buckets=(0.1, 1.0))
+    requests.inc(labels=("/",))
+
+    def handle_request():
+        requests.inc(labels=("/",))
+        requests.inc(2, labels=("/count",))
+        latency.observe(0.5)
+
+    _in_threads(50, handle_request)
+
+    # Only the shard of this thread is left, next to the retired one
+    assert len(requests._shards) == 1
+    assert len(latency._shards) == 0
+    assert requests.collect() == {("/",): 51, ("/count",): 100}
+    assert latency.collect() == {(): [0, 50, 0, 25.0, 50]}
+
+
+def test_live_threads_keep_their_shards():
+    requests = Counter("requests_total", "Requests")
+    started, release = threading.Barrier(5), threading.Event()
+
+    def hold():
+        requests.inc()
+        started.wait()
+        release.wait()
+
+    threads = [threading.Thread(target=hold) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    started.wait()
+    assert len(requests._shards) == 4
+    assert requests.collect() == {(): 4}
+
+    release.set()
+    for thread in threads:
+        thread.join()
+    gc.collect()
+    assert len(requests._shards) == 0
+    assert requests.collect() == {(): 4}
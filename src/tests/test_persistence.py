@@ -0,0 +1,99 @@
+import os
+
+import pytest
+
+from persistence import RECORD_SIZE, WriteBehindPersister
+
+
+class FakeCounter(object):
+
+    def __init__(self, value=0):
+        self.value = value
+
+
+@pytest.fixture
+def state_dir(tmp_path):
+    return str(tmp_path / "state")
+
+
+def _persist(state_dir, values, **kwargs):
+    """ Flushes each of `values` in turn, as the background thread would """
+    kwargs.setdefault("flush_interval_s", 3600)
+    persister = WriteBehindPersister(state_dir, **kwargs)
+    counter = FakeCounter(persister.recover())
+    persister.start(counter)
+    for value in values:
+        counter.value = value
+        persister.flush()
+    persister.stop()
+    return persister
+
+
+def _recover(state_dir):
+    return WriteBehindPersister(state_dir).recover()
+
+
+def test_recovers_zero_without_state(state_dir):
+    assert _recover(state_dir) == 0
+    assert os.path.isdir(state_dir)
+
+
+def test_only_changed_counts_are_logged(state_dir):
+    persister = _persist(state_dir, [5, 5, 7])
+    assert os.path.getsize(persister.log_path) == 2 * RECORD_SIZE
+    assert _recover(state_dir) == 7
+
+
+def test_torn_tail_is_ignored(state_dir):
+    persister = _persist(state_dir, [1, 2, 3])
+    with open(persister.log_path, "r+b") as f:
+        f.truncate(3 * RECORD_SIZE - 3)
+    assert _recover(state_dir) == 2
+
+
+def test_corrupt_tail_is_ignored(state_dir):
+    persister = _persist(state_dir, [1, 2, 3])
+    with open(persister.log_path, "r+b") as f:
+        f.seek(2 * RECORD_SIZE)
+        byte = f.read(1)
+        f.seek(2 * RECORD_SIZE)
+        f.write(bytes([byte[0] ^ 0xff]))
+    assert _recover(state_dir) == 2
+
+
+def test_snapshot_and_log_are_replayed_after_compaction(state_dir):
+    persister = _persist(state_dir, [1, 2, 3, 4], compact_after=3)
+    assert os.path.getsize(persister.snapshot_path) == RECORD_SIZE
+    assert os.path.getsize(persister.log_path) == RECORD_SIZE
+    assert _recover(state_dir) == 4
+
+    # A torn log leaves the snapshot
+    with open(persister.log_path, "r+b") as f:
+        f.truncate(RECORD_SIZE - 1)
+    assert _recover(state_dir) == 3
+
+
+def test_recovery_continues_the_log(state_dir):
+    _persist(state_dir, [1, 2])
+    persister = _persist(state_dir, [3])
+    assert os.path.getsize(persister.log_path) == 3 * RECORD_SIZE
+    assert _recover(state_dir) == 3
+
+
+def test_unflushed_counts_the_increments_a_crash_would_lose(state_dir):
+    persister = WriteBehindPersister(state_dir, flush_interval_s=3600)
+    assert persister.unflushed() == 0
+    counter = FakeCounter(persister.recover())
+    persister.start(counter)
+
+    counter.value = 7
+    persister.flush()
+    counter.value = 10
+    assert persister.unflushed() == 3
+    assert persister.stats()["flushed_count"] == 7
+
+    # A crash now: the last flush is all that's left
+    assert _recover(state_dir) == 7
+    persister.stop()
+    assert persister.unflushed() == 0
+    assert _recover(state_dir) == 10
@@ -0,0 +1,63 @@
+import tracemalloc
+
+import pytest
+from flask import Flask
+
+from common import profiling
+
+
+@pytest.fixture
+def client():
+    app = Flask(__name__)
+    profiling.init_flask(app, token="secret")
+
+    @app.route("/work")
+    def work():
+        return str(sum(range(1000)))
+
+    yield app.test_client()
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def _get(client, path, method="GET", **headers):
+    headers.setdefault(profiling.TOKEN_HEADER, "secret")
+    return client.open(path, method=method, headers=headers)
+
+
+def test_debug_endpoints_require_the_token(client):
+    assert _get(client, "/debug/profiles", **{profiling.TOKEN_HEADER: "wrong"}).status_code == 404
+    assert _get(client, "/debug/profiles").status_code == 200
+
+
+@pytest.mark.parametrize("query", ["frames=x", "frames=0", "frames=100000"])
+def test_tracemalloc_start_rejects_bad_frames(client, query):
+    assert _get(client, "/debug/tracemalloc/start?" + query, method="POST").status_code == 400
+    assert not tracemalloc.is_tracing()
+
+
+@pytest.mark.parametrize("path", ["/debug/tracemalloc/snapshot", "/debug/tracemalloc/diff"])
+def test_tracemalloc_snapshot_rejects_a_bad_limit(client, path):
+    assert _get(client, path + "?limit=x").status_code == 400
+
+
+def test_tracemalloc_snapshots(client):
+    assert _get(client, "/debug/tracemalloc/snapshot").status_code == 409
+    assert _get(client, "/debug/tracemalloc/start?frames=2", method="POST").status_code == 200
+
+    resp = _get(client, "/debug/tracemalloc/snapshot?limit=5")
+    assert resp.status_code == 200
+    assert resp.data.startswith(b"traced=")
+    assert _get(client, "/debug/tracemalloc/diff?limit=5").status_code == 200
+
+    assert _get(client, "/debug/tracemalloc/stop", method="POST").status_code == 200
+    assert not tracemalloc.is_tracing()
+
+
+def test_profiled_request(client):
+    resp = _get(client, "/work", **{profiling.PROFILE_HEADER: "1"})
+    profile_id = resp.headers[profiling.PROFILE_HEADER]
+
+    resp = _get(client, "/debug/profiles/%s" % profile_id)
+    assert resp.status_code == 200
+    assert resp.data.startswith(b"GET /work ")
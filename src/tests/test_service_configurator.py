@@ -0,0 +1,116 @@
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import threading
+
+import pytest
+
+import service_configurator
+from fakes import FakeConsul
+from service_configurator import ConsulAgent, SidecarBootstrapper
+
+
+FAKE_ENVOY = [sys.executable, os.path.join(os.path.dirname(__file__), "fake_envoy.py")]
+
+METADATA = {"task_id": "abc", "family": "counter", "ip": "10.0.1.23", "az": None}
+SERVICE_ID = "counter-10-0-1-23-abc"
+TEMPLATE = {
+    "service": {
+        "name": "counter",
+        "tags": ["ServiceName:counter"],
+        "port": 5000,
+        "connect": {"sidecar_service": {"proxy": {"upstreams": []}}},
+    }
+}
+
+
+def _free_address():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return "127.0.0.1:%s" % s.getsockname()[1]
+
+
+@pytest.fixture
+def bootstrapper(tmp_path, monkeypatch):
+    """ Builds bootstrappers for the task above, and restores the signal
+    handlers they install
+    """
+    monkeypatch.setenv("SERVICE_CONFIG", json.dumps(TEMPLATE))
+    monkeypatch.setattr(service_configurator, "get_task_metadata", lambda: dict(METADATA))
+    handlers = dict((s, signal.getsignal(s)) for s in (signal.SIGTERM, signal.SIGINT))
+
+    def build(consul, *envoy_args):
+        admin_addr = _free_address()
+        return SidecarBootstrapper(
+            str(tmp_path / "service.json"),
+            ["--", "-admin-bind", admin_addr] + list(envoy_args),
+            agent=ConsulAgent(consul.address),
+            envoy_command=FAKE_ENVOY,
+            envoy_admin_addr=admin_addr
+        )
+
+    yield build
+    for signum, handler in handlers.items():
+        signal.signal(signum, handler)
+
+
+def _signal_when(condition, signum=signal.SIGTERM, timeout_s=10):
+    def run():
+        deadline = time.time() + timeout_s
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        os.kill(os.getpid(), signum)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def test_bootstraps_and_deregisters_on_sigterm(bootstrapper):
+    with FakeConsul(leaderless_calls=2) as consul:
+        sidecar = bootstrapper(consul, "-ready-after-s", "0.3")
+        registered = []
+
+        def ready():
+            if "total_ms" in sidecar.timings:
+                registered.append(sorted(consul.agent_services))
+                return True
+            return False
+
+        _signal_when(ready)
+        assert sidecar.run() == 0
+
+    assert registered == [[SERVICE_ID, SERVICE_ID + "-sidecar-proxy"]]
+    assert consul.agent_services == {}
+    assert consul.requests.count(("GET", "/v1/status/leader")) == 3
+    # Readiness is probed rather than waited out
+    assert 300 <= sidecar.timings["envoy_ready_ms"] < 5000
+    assert set(sidecar.timings) >= {"generate_config_ms", "wait_for_consul_ms", "register_ms",
+                                    "envoy_ready_ms", "total_ms"}
+    with open(sidecar.filename) as f:
+        assert json.load(f)["service"]["id"] == SERVICE_ID
+
+
+def test_sigterm_while_waiting_for_consul_never_registers(bootstrapper):
+    with FakeConsul(leaderless_calls=1000) as consul:
+        sidecar = bootstrapper(consul)
+        _signal_when(lambda: len(consul.requests) >= 2)
+        start = time.time()
+        assert sidecar.run() == 0
+        assert time.time() - start < 5
+
+    assert ("PUT", "/v1/agent/service/register") not in consul.requests
+    assert sidecar.envoy is None
+
+
+def test_envoy_failing_to_start_deregisters(bootstrapper):
+    with FakeConsul() as consul:
+        sidecar = bootstrapper(consul, "-exit-code", "3")
+        assert sidecar.run() == 1
+
+    assert ("PUT", "/v1/agent/service/register") in consul.requests
+    assert consul.agent_services == {}
@@ -0,0 +1,68 @@
+import time
+
+import pytest
+import requests
+
+from common.task_metadata import TaskMetadataClient
+from fakes import FakeMetadataEndpoint
+
+
+TASK = {
+    "TaskARN": "arn:aws:ecs:eu-west-1:123456789012:task/mesh/0123456789abcdef",
+    "Family": "counter",
+    "AvailabilityZone": "eu-west-1b",
+    "Containers": [{"Networks": [{"IPv4Addresses": ["10.0.1.23"]}]}],
+}
+
+
+def test_summary(tmp_path):
+    with FakeMetadataEndpoint(TASK) as endpoint:
+        client = TaskMetadataClient(endpoint.url, cache_file=str(tmp_path / "task.json"))
+        assert client.summary() == {
+            "task_id": "0123456789abcdef",
+            "family": "counter",
+            "ip": "10.0.1.23",
+            "az": "eu-west-1b",
+        }
+        client.summary()
+    assert endpoint.requests == [("GET", "/task")]
+
+
+def test_siblings_read_the_cached_metadata_without_waiting(tmp_path):
+    cache_file = str(tmp_path / "shared" / "task.json")
+    with FakeMetadataEndpoint(TASK, delay_s=0.3) as endpoint:
+        start = time.time()
+        TaskMetadataClient(endpoint.url, cache_file=cache_file).task()
+        first_s = time.time() - start
+
+        start = time.time()
+        assert TaskMetadataClient(endpoint.url, cache_file=cache_file).task() == TASK
+        sibling_s = time.time() - start
+    assert len(endpoint.requests) == 1
+    assert sibling_s < first_s / 10
+
+
+def test_retries_unavailable_endpoint(tmp_path):
+    with FakeMetadataEndpoint(TASK, failures=2) as endpoint:
+        client = TaskMetadataClient(endpoint.url, cache_file=None, backoff_s=0.01)
+        assert client.task() == TASK
+    assert len(endpoint.requests) == 3
+
+
+def test_times_out_on_a_hanging_endpoint():
+    with FakeMetadataEndpoint(TASK, delay_s=1.0) as endpoint:
+        client = TaskMetadataClient(endpoint.url, cache_file=None, read_timeout_s=0.1, retries=0)
+        start = time.time()
+        with pytest.raises(requests.exceptions.RequestException):
+            client.task()
+        assert time.time() - start < 0.5
+
+
+def test_availability_zone_falls_back_to_the_environment(monkeypatch):
+    task = dict(TASK)
+    del task["AvailabilityZone"]
+    with FakeMetadataEndpoint(task) as endpoint:
+        client = TaskMetadataClient(endpoint.url, cache_file=None)
+        assert client.availability_zone() is None
+        monkeypatch.setenv("AVAILABILITY_ZONE", "eu-west-1c")
+        assert client.availability_zone() == "eu-west-1c"
@@ -0,0 +1,142 @@
+import os
+import json
+
+import pytest
+
+from fakes import FakeConsul
+from service_configurator import ConsulAgent, configure_upstream_locality, regenerate_service_config
+
+
+TEMPLATE_PATH = os.path.join(
+    os.path.dirname(__file__), "..", "..", "terraform", "modules", "consul-mesh-adapter",
+    "ecs-fargate", "templates", "consul-service-config.json"
+)
+
+AZS = ("eu-west-1a", "eu-west-1b", "eu-west-1c")
+
+
+@pytest.fixture(scope="module")
+def template():
+    """ The service config template of a dashboard, as rendered by terraform """
+    with open(TEMPLATE_PATH) as f:
+        template = f.read()
+    variables = {
+        "service_name": "dashboard",
+        "container_port": "5000",
+        "region": "eu-west-1",
+        "health_check_port": "5000",
+        "health_check_path": "/health",
+        "health_check_interval": "10s",
+        "health_check_timeout": "2s",
+        "envoy_tracing_json": "{}",
+        "upstreams": json.dumps([
+            {"destination_name": "counter", "local_bind_port": 5001},
+            {"destination_name": "cache", "local_bind_port": 5002},
+        ]),
+    }
+    for name, value in variables.items():
+        template = template.replace("${%s}" % name, value)
+    return template
+
+
+def _service(template, n, az):
+    metadata = {"task_id": "task-%s" % n, "family": "dashboard", "ip": "10.0.0.%s" % n, "az": az}
+    return json.loads(regenerate_service_config(metadata, template))["service"]
+
+
+def _upstreams(service):
+    return service["connect"]["sidecar_service"]["proxy"]["upstreams"]
+
+
+def _config_writes(consul):
+    return sum(1 for request in consul.requests if request == ("PUT", "/v1/config"))
+
+
+def test_tasks_in_three_azs_get_a_subset_each(template):
+    with FakeConsul() as consul:
+        agent = ConsulAgent(consul.address)
+        services = [_service(template, n, az) for n, az in enumerate(AZS)]
+        for service in services:
+            assert configure_upstream_locality(agent, service, failover_datacenters=[]) == ["counter", "cache"]
+
+        for upstream in ("counter", "cache"):
+            resolver = consul.config_entries[("service-resolver", upstream)]
+            assert resolver["Subsets"] == dict(
+                (az, {"Filter": 'Service.Meta.az == "%s"' % az, "OnlyPassing": True}) for az in AZS
+            )
+            assert resolver["Failover"] == dict((az, {"Service": upstream}) for az in AZS)
+            for az in AZS:
+                redirect = consul.config_entries[("service-resolver", "%s-%s" % (upstream, az))]
+                assert redirect["Redirect"] == {"Service": upstream, "ServiceSubset": az}
+
+        for service, az in zip(services, AZS):
+            assert service["meta"] == {"az": az}
+            assert "AZ:%s" % az in service["tags"]
+            counter, cache = _upstreams(service)
+            assert (counter["destination_name"], counter["local_bind_port"]) == ("counter-%s" % az, 5001)
+            assert (cache["destination_name"], cache["local_bind_port"]) == ("cache-%s" % az, 5002)
+            assert counter["config"]["passive_health_check"] == {"interval": "10s", "max_failures": 5}
+
+
+def test_another_task_in_a_known_az_leaves_the_resolver_unchanged(template):
+    with FakeConsul() as consul:
+        agent = ConsulAgent(consul.address)
+        configure_upstream_locality(agent, _service(template, 1, AZS[0]), failover_datacenters=[])
+        index = consul.config_entries[("service-resolver", "counter")]["ModifyIndex"]
+        writes = _config_writes(consul)
+
+        service = _service(template, 2, AZS[0])
+        assert configure_upstream_locality(agent, service, failover_datacenters=[]) == ["counter", "cache"]
+        assert consul.config_entries[("service-resolver", "counter")]["ModifyIndex"] == index
+        # Only the redirects are written again
+        assert _config_writes(consul) - writes == 2
+        assert _upstreams(service)[0]["destination_name"] == "counter-%s" % AZS[0]
+
+
+def test_failover_to_other_datacenters(template):
+    with FakeConsul() as consul:
+        agent = ConsulAgent(consul.address)
+        for n, az in enumerate(AZS[:2]):
+            configure_upstream_locality(agent, _service(template, n, az), failover_datacenters=["dc2", "dc3"])
+
+        resolver = consul.config_entries[("service-resolver", "counter")]
+        assert resolver["Failover"] == dict(
+            (az, {"Service": "counter", "Datacenters": ["dc2", "dc3"]}) for az in AZS[:2]
+        )
+
+
+def test_existing_resolver_is_kept_and_conflicts_are_retried(template):
+    with FakeConsul() as consul:
+        agent = ConsulAgent(consul.address)
+        agent.write_config_entry({"Kind": "service-resolver", "Name": "counter", "ConnectTimeout": "2s"})
+        configure_upstream_locality(agent, _service(template, 1, AZS[0]), failover_datacenters=[])
+
+        consul.config_conflicts = 1
+        configure_upstream_locality(agent, _service(template, 2, AZS[1]), failover_datacenters=[])
+
+        resolver = consul.config_entries[("service-resolver", "counter")]
+        assert resolver["ConnectTimeout"] == "2s"
+        assert sorted(resolver["Subsets"]) == list(AZS[:2])
+        assert sorted(resolver["Failover"]) == list(AZS[:2])
+
+
+def test_unknown_az_keeps_plain_upstreams(template):
+    with FakeConsul() as consul:
+        service = _service(template, 1, None)
+        assert configure_upstream_locality(ConsulAgent(consul.address), service) == []
+
+        assert consul.config_entries == {}
+        assert "meta" not in service
+        assert [u["destination_name"] for u in _upstreams(service)] == ["counter", "cache"]
+        assert all("config" not in u for u in _upstreams(service))
+
+
+def test_upstream_whose_entries_cant_be_written_uses_every_az(template):
+    with FakeConsul() as consul:
+        consul.failing_config_entries.add("cache-%s" % AZS[0])
+        service = _service(template, 1, AZS[0])
+        assert configure_upstream_locality(ConsulAgent(consul.address), service) == ["counter"]
+
+        counter, cache = _upstreams(service)
+        assert counter["destination_name"] == "counter-%s" % AZS[0]
+        assert cache == {"destination_name": "cache", "local_bind_port": 5002}
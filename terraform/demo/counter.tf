@@ -41,6 +41,7 @@ module "counter_mesh_adapter" {
   service_name               = local.counter["service_name"]
   tags                       = local.counter_tags
   enable_tracing             = true
+  metrics_path               = "/metrics"
 }
 
 # ---------------
@@ -52,6 +53,7 @@ module "counter_service" {
 
   cluster_name           = module.ecs_cluster.cluster_name
   container_definitions  = module.counter_mesh_adapter.updated_container_definitions_json
+  volume_names           = module.counter_mesh_adapter.volume_names
   container_port         = local.counter["container_port"]
   desired_count_of_tasks = local.counter["desired_count_tasks"]
   environment            = var.environment
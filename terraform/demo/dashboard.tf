@@ -43,6 +43,7 @@ module "dashboard_mesh_adapter" {
   tags                       = local.dashboard_tags
   upstream_connections       = split(",", local.dashboard["upstream_connections"])
   enable_tracing             = true
+  metrics_path               = "/metrics"
 }
 
 # -----------------
@@ -54,6 +55,7 @@ module "dashboard_service" {
 
   cluster_name           = module.ecs_cluster.cluster_name
   container_definitions  = module.dashboard_mesh_adapter.updated_container_definitions_json
+  volume_names           = module.dashboard_mesh_adapter.volume_names
   container_port         = local.dashboard["container_port"]
   desired_count_of_tasks = local.dashboard["desired_count_tasks"]
   environment            = var.environment
@@ -54,6 +54,7 @@ module "grafana_service" {
 
   cluster_name           = module.ecs_cluster.cluster_name
   container_definitions  = module.grafana_mesh_adapter.updated_container_definitions_json
+  volume_names           = module.grafana_mesh_adapter.volume_names
   container_port         = local.grafana["container_port"]
   desired_count_of_tasks = local.grafana["desired_count_tasks"]
   environment            = var.environment
@@ -51,6 +51,7 @@ module "ingress_gw_service" {
 
   cluster_name           = module.ecs_cluster.cluster_name
   container_definitions  = module.ingress_gw_mesh_adapter.updated_container_definitions_json
+  volume_names           = module.ingress_gw_mesh_adapter.volume_names
   container_port         = local.ingress_gw["envoy_port"]
   desired_count_of_tasks = local.ingress_gw["desired_count_tasks"]
   environment            = var.environment
@@ -51,6 +51,7 @@ module "prometheus_service" {
 
   cluster_name           = module.ecs_cluster.cluster_name
   container_definitions  = module.prometheus_mesh_adapter.updated_container_definitions_json
+  volume_names           = module.prometheus_mesh_adapter.volume_names
   container_port         = local.prometheus["container_port"]
   desired_count_of_tasks = local.prometheus["desired_count_tasks"]
   environment            = var.environment
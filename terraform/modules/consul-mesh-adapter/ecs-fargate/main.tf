@@ -9,6 +9,9 @@ locals {
   proxy_port     = 21000
   xray_port      = 2000
 
+  // Task volume where the first container to start caches the task metadata
+  task_metadata_volume = "task-metadata"
+
   # -------------------
   # Consul Config parts
   # -------------------
@@ -59,6 +62,7 @@ locals {
       region             = local.aws_region
       consul_ecs_cluster = var.consul_ecs_cluster
       consul_ecs_service = var.consul_ecs_service
+      metadata_volume    = local.task_metadata_volume
       consul_server_dns  = var.consul_server_dns
     }
   ))
@@ -72,6 +76,8 @@ locals {
       envoy_image               = var.envoy_image
       proxy_port                = local.proxy_port
       consul_service_config_b64 = base64encode(local.consul_service_config)
+      metrics_path              = var.metrics_path
+      metadata_volume           = local.task_metadata_volume
     }
   )) : []
 
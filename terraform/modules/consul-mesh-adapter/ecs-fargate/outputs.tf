@@ -7,3 +7,8 @@ output "consul_service_config_json" {
   value       = local.consul_service_config
   description = "The auto-generated service definition to register into Consul"
 }
+
+output "volume_names" {
+  value       = [local.task_metadata_volume]
+  description = "The task volumes the mesh containers mount, to be added to the task definition"
+}
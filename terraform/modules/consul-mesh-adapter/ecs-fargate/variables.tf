@@ -68,6 +68,12 @@ variable "health_check_timeout" {
   default     = "3s"
 }
 
+variable "metrics_path" {
+  type        = string
+  description = "The path the service exposes Prometheus metrics on, if any"
+  default     = ""
+}
+
 variable "service_name" {
   type        = string
   description = "Name of the service"
@@ -49,6 +49,13 @@ resource "aws_ecs_task_definition" "this" {
   task_role_arn            = aws_iam_role.task.arn
   execution_role_arn       = aws_iam_role.task.arn
   tags                     = var.tags
+
+  dynamic "volume" {
+    for_each = var.volume_names
+    content {
+      name = volume.value
+    }
+  }
 }
 
 resource "aws_ecs_service" "this" {
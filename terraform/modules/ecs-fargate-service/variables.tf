@@ -70,3 +70,9 @@ variable "target_groups" {
   description = "List of Target groups to associate with the service"
   default     = []
 }
+
+variable "volume_names" {
+  type        = list(string)
+  description = "Names of task scoped volumes that containers can mount"
+  default     = []
+}